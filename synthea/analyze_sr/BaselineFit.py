@@ -0,0 +1,102 @@
+""" Using the windows generated in BuildLSTMData.py, fit a fast non-sequence baseline
+    for Myocardial infarction: sparse logistic regression or histogram gradient
+    boosting on a summary of each window. Predictions are written as LSTMFit.py
+    writes them, for LSTMPredictionsROC.R, and compared against the LSTM's.
+
+    Author: Seth Rhoades
+"""
+
+import sys, time, argparse
+import pandas as pd
+import numpy as np
+from sklearn.metrics import roc_auc_score
+import setup_BuildLSTMData as data
+import setup_BaselineFit as util
+import setup_Profiling as profiling
+
+def main(xtrain, ytrain, xtest, ytest, model = 'logistic', features = 'summary',
+    C = 0.1, variables = None, seed = 10):
+
+    with profiling.stage('features', len(ytrain) + len(ytest)):
+        featureTrain = util.windowFeatures(xtrain, features)
+        featureTest = util.windowFeatures(xtest, features)
+
+    estimator = util.buildBaseline(model, C, seed)
+    start = time.perf_counter()
+    with profiling.stage('fit', len(ytrain)):
+        estimator.fit(featureTrain, np.asarray(ytrain))
+    fitTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with profiling.stage('predict', len(ytest)):
+        ypreds = estimator.predict_proba(featureTest)[:, 1]
+    predictTime = time.perf_counter() - start
+
+    accDF = pd.DataFrame([np.asarray(ytest), ypreds]).T
+    accDF.columns = ['yTest', 'yPredScores']
+    auc = None
+    if len(np.unique(ytest)) == 2:
+        auc = roc_auc_score(accDF.yTest, accDF.yPredScores)
+        print('Test AUC: {0:.3f}'.format(auc))
+
+    if variables is not None:
+        columnNames = util.featureColumnNames(variables, featureTrain.shape[1] //
+            len(variables), features)
+        for name, coef in util.nonzeroFeatures(estimator, columnNames):
+            print('{0:>8.3f} {1}'.format(coef, name))
+
+    run = {'auc': auc, 'fit': fitTime, 'predict': predictTime}
+    return accDF, estimator, run
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Fit a fast logistic regression or '
+        'gradient boosting baseline to windows from BuildLSTMData.py')
+    parser.add_argument('dataset', nargs = '?', default = 'LSTMData', help = 'dataset '
+        'directory from BuildLSTMData.py')
+    parser.add_argument('--target', default = None, help = 'target to fit, for a '
+        'dataset built with several --phenotypes or --steps')
+    parser.add_argument('--model', default = 'logistic', choices = ['logistic', 'hgb'],
+        help = 'L1 logistic regression, or histogram gradient boosting')
+    parser.add_argument('--features', default = 'summary', choices = ['summary',
+        'flatten'], help = 'last value, mean and trend of each variable, or every '
+        'step of the window side by side')
+    parser.add_argument('--C', type = float, default = 0.1, help = 'inverse L1 '
+        'strength of the logistic regression')
+    parser.add_argument('--out', default = 'yBaselinePredictions.csv', help = 'test '
+        'predictions, in the format of LSTMFit.py yPredictions.csv')
+    parser.add_argument('--model-dir', default = 'BaselineModel', help = 'the fitted '
+        'model, with the dataset manifest and vocabulary')
+    parser.add_argument('--lstm-predictions', default = None, metavar = 'CSV',
+        help = 'LSTMFit.py predictions on the same dataset, to compare AUCs')
+    parser.add_argument('--lstm-profile', default = None, metavar = 'JSON',
+        help = 'LSTMFit.py --profile JSON, to compare fit and predict times')
+    parser.add_argument('--seed', type = int, default = 10)
+    parser.add_argument('--profile', default = None, metavar = 'PREFIX',
+        help = 'write stage timings to PREFIX.json and a Chrome trace to '
+        'PREFIX.trace.json')
+    parser.add_argument('--profiler', default = None, choices = ['cprofile', 'sample'],
+        help = 'also profile functions, to PREFIX.prof (cProfile) or PREFIX.folded '
+        '(sampled stacks, for flame graphs)')
+    args = parser.parse_args()
+
+    prof = profiling.StageProfiler('BaselineFit', args.profile, args.profiler).activate()
+
+    with profiling.stage('load') as record:
+        xTrain, xTest, yTrain, yTest, manifest = data.loadTensorDataset(args.dataset,
+            target = args.target)
+        record['rows'] = len(yTrain) + len(yTest)
+
+    modelPredictions, model, run = main(xTrain, yTrain, xTest, yTest, args.model,
+        args.features, args.C, manifest.get('variables'), args.seed)
+    modelPredictions.to_csv(args.out)
+
+    with profiling.stage('save'):
+        util.saveBaseline(model, args.model_dir, args.features, args.dataset, manifest)
+
+    runs = {'baseline ({0})'.format(args.model): run}
+    if args.lstm_predictions is not None or args.lstm_profile is not None:
+        runs['LSTM'] = util.readLSTMRun(args.lstm_predictions, yTest, args.lstm_profile)
+    util.printComparison(runs)
+
+    prof.close()
@@ -0,0 +1,204 @@
+''' Benchmark optimized pipeline stages against the original implementations,
+    on simulated Synthea-shaped data.
+
+    Author: Seth Rhoades
+'''
+
+import sys, os, argparse, tempfile
+import importlib.util
+import pandas as pd
+import numpy as np
+import setup_BenchmarkPipeline as util
+import setup_PatientRecordAgg as agg
+import setup_BuildLSTMData as lstm
+import setup_Profiling as profiling
+
+def benchAggregation(patientCounts, loopMaxPatients):
+    """ Time AggregateQuantValuesVectorized across cohort sizes, checking it against
+        the looped AggregateQuantValues wherever the loop is still affordable
+    """
+    rowCounts, elapsedAll = [], []
+    for nPatients in patientCounts:
+        patientRecs, IDs = util.simulatePatientRecords(nPatients)
+        IDs = sorted(IDs)
+
+        vectorRecs, vectorTime = util.timeCall(agg.AggregateQuantValuesVectorized,
+            patientRecs, IDs)
+        rowCounts.append(len(patientRecs))
+        elapsedAll.append(vectorTime)
+
+        if nPatients <= loopMaxPatients:
+            loopRecs, loopTime = util.timeCall(agg.AggregateQuantValues,
+                patientRecs.copy(), IDs)
+            pd.testing.assert_frame_equal(loopRecs, vectorRecs)
+            loopReport = '{0:.2f}s (outputs equal)'.format(loopTime)
+        else:
+            loopReport = 'skipped'
+
+        print('patients: {0:>8d} rows: {1:>9d} vectorized: {2:.2f}s loop: {3}'.format(
+            nPatients, len(patientRecs), vectorTime, loopReport))
+
+    print('vectorized scaling exponent (1 = linear): {0:.2f}'.format(
+        util.scalingExponent(rowCounts, elapsedAll)))
+
+def runStage(stageName, func, *args):
+    """ Call func as a stage of the active profiler, counting rows of its result
+    """
+    with profiling.stage(stageName) as record:
+        result = func(*args)
+        record['rows'] = profiling.rowCount(result)
+    return(result)
+
+def reportEqual(comparisons, scale, stageName, candidate, baseline, equal):
+    comparisons.append({'patients': scale, 'stage': stageName, 'candidate': candidate,
+        'baseline': baseline, 'equal': bool(equal)})
+    print('{0} patients, {1}: {2} vs {3} {4}'.format(scale, stageName, candidate,
+        baseline, 'equal' if equal else 'DIFFERENT'))
+
+def benchPipeline(nPatients, dataDir, baselineMax, phenotype = 'Myocardial Infarction',
+    nSteps = 5, comparisons = None):
+    """ Run every stage on generated CSVs of nPatients patients with the original and
+        optimized implementations, each as a stage of the active profiler, and check
+        that they give the same output. The original loops only run up to
+        baselineMax patients
+
+    Returns:
+        comparisons: (patients, stage, candidate, baseline, equal) records
+    """
+    comparisons = [] if comparisons is None else comparisons
+    runBaseline = nPatients <= baselineMax
+    with profiling.stage('generate', nPatients):
+        fileNames = util.syntheaFiles(dataDir, nPatients)
+
+    #Load: whole-file reads and merges, or streamed chunks in compact dtypes
+    if runBaseline:
+        baseRecs, baseIDs = runStage('load: combineDatasets', agg.combineDatasets,
+            *fileNames)
+    patientRecs, IDs = runStage('load: streaming', agg.combineDatasetsStreaming,
+        *fileNames)
+    if runBaseline:
+        reportEqual(comparisons, nPatients, 'load', 'streaming', 'combineDatasets',
+            baseIDs == IDs and agg.compareRecords(baseRecs, patientRecs))
+
+    #Aggregate: per-patient loop, one groupby pass, or SQL
+    IDs = sorted(IDs)
+    aggRecs = runStage('aggregate: vectorized', agg.AggregateQuantValuesVectorized,
+        patientRecs, IDs)
+    if runBaseline:
+        loopRecs = runStage('aggregate: loop', agg.AggregateQuantValues, baseRecs,
+            IDs)
+        reportEqual(comparisons, nPatients, 'aggregate', 'vectorized', 'loop',
+            agg.compareRecords(loopRecs, aggRecs))
+        del baseRecs, loopRecs
+    if importlib.util.find_spec('duckdb') is not None:
+        patientFile, procFile, obsFile, conditionFile = fileNames
+        sqlRecs = runStage('aggregate: duckdb', agg.combineAggregateSql, patientFile,
+            procFile, obsFile, conditionFile, agg.duckdbConnection())
+        reportEqual(comparisons, nPatients, 'aggregate', 'duckdb', 'vectorized',
+            agg.compareRecords(aggRecs, sqlRecs))
+        del sqlRecs
+    del patientRecs
+
+    with profiling.stage('dictionary build', len(aggRecs)):
+        (raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict,
+            orderedRecs) = lstm.buildDictsSortHistories(aggRecs)
+    codeDicts = (zipDict, genderDict, raceDict, smokerDict, conditionDict,
+        procedureDict)
+
+    #Windows: per-window loop, sliding views over one feature matrix, or compact rows
+    with profiling.stage('windows: windowed') as record:
+        denseData = lstm.buildRNNDataWindowed(orderedRecs, nSteps, phenotype, 
+            *codeDicts)
+        record['rows'] = len(denseData[2]) + len(denseData[3])
+    with profiling.stage('windows: sparse') as record:
+        sparseData = lstm.buildRNNDataSparse(orderedRecs, nSteps, phenotype, 
+            *codeDicts)
+        record['rows'] = len(sparseData[2]) + len(sparseData[3])
+    #Compact windows are float32
+    reportEqual(comparisons, nPatients, 'windows', 'sparse', 'windowed',
+        np.array_equal(lstm.densifyWindows(sparseData[0]), denseData[0].astype(
+        np.float32)) and np.array_equal(lstm.densifyWindows(sparseData[1]), 
+        denseData[1].astype(np.float32)) and np.array_equal(sparseData[3], 
+        denseData[3]))
+    if runBaseline:
+        with profiling.stage('windows: loop') as record:
+            loopData = lstm.buildRNNData(orderedRecs, nSteps, phenotype, *codeDicts)
+            record['rows'] = len(loopData[2]) + len(loopData[3])
+        #The loop takes each patient's ages in set order rather than sorted, so only
+        #the labels and shapes are expected to match
+        reportEqual(comparisons, nPatients, 'windows (labels, shapes)', 'windowed',
+            'loop', np.shape(loopData[0]) == denseData[0].shape and np.array_equal(
+            loopData[2], denseData[2]) and np.array_equal(loopData[3], denseData[3]))
+        del loopData
+
+    #Write: text arrays, or .npy arrays with a manifest
+    variables = lstm.featureNames(conditionDict, procedureDict)
+    xTrain, xTest, yTrain, yTest = denseData[:4]
+    with tempfile.TemporaryDirectory() as outDir:
+        with profiling.stage('write: text', len(yTrain) + len(yTest)):
+            lstm.write3DArray(xTrain, os.path.join(outDir, 'xTrain.txt'))
+            lstm.write3DArray(xTest, os.path.join(outDir, 'xTest.txt'))
+            np.savetxt(os.path.join(outDir, 'yTrain.txt'), yTrain)
+            np.savetxt(os.path.join(outDir, 'yTest.txt'), yTest)
+        with profiling.stage('write: npy', len(yTrain) + len(yTest)):
+            lstm.writeTensorDataset(os.path.join(outDir, 'LSTMData'), xTrain, xTest,
+                yTrain, yTest, variables)
+
+        #Text is written to 2 decimals
+        npyData = lstm.loadTensorDataset(os.path.join(outDir, 'LSTMData'))
+        textTrain = lstm.read3DArray(os.path.join(outDir, 'xTrain.txt'))
+        reportEqual(comparisons, nPatients, 'write (to 2 decimals)', 'npy', 'text',
+            np.allclose(textTrain.reshape(npyData[0].shape), npyData[0], rtol = 0,
+            atol = 0.006) and np.array_equal(np.loadtxt(os.path.join(outDir,
+            'yTrain.txt')), npyData[2]))
+
+    return(comparisons)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark each pipeline stage, '
+        'original against optimized implementations, on generated Synthea-shaped '
+        'CSVs')
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1000, 10000],
+        help = 'numbers of patients to generate and benchmark, e.g. 1000 10000 100000')
+    parser.add_argument('--data-dir', default = 'BenchmarkData', help = 'generated '
+        'CSVs are kept here and reused by later runs')
+    parser.add_argument('--baseline-max', type = int, default = 300, help = 'run the '
+        'original per-patient loops only up to this many patients')
+    parser.add_argument('--profile', default = None, metavar = 'PREFIX',
+        help = 'write stage timings and equality checks to PREFIX.json and a Chrome '
+        'trace to PREFIX.trace.json')
+    parser.add_argument('--profiler', default = None, choices = ['cprofile', 'sample'],
+        help = 'also profile functions, to PREFIX.prof (cProfile) or PREFIX.folded '
+        '(sampled stacks, for flame graphs)')
+    parser.add_argument('--scaling', type = int, default = None, metavar = 'MAXPATIENTS',
+        help = 'instead, time aggregation alone on simulated records up to '
+        'MAXPATIENTS patients and report its scaling')
+    parser.add_argument('--compare', nargs = 2, default = None, metavar = ('BASE',
+        'NEW'), help = 'instead, compare the stage timings of two --profile JSON '
+        'files, e.g. before and after a change')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        profiling.printProfileComparison(profiling.compareProfiles(*args.compare))
+        sys.exit()
+
+    if args.scaling is not None:
+        patientCounts = [x for x in [100, 1000, 10000, 100000, 1000000] if x <=
+            args.scaling]
+        benchAggregation(patientCounts, loopMaxPatients = 100)
+        sys.exit()
+
+    prof = profiling.StageProfiler('BenchmarkPipeline', args.profile,
+        args.profiler).activate()
+    comparisons = []
+    for nPatients in args.scales:
+        with profiling.stage('{0} patients'.format(nPatients)):
+            benchPipeline(nPatients, args.data_dir, args.baseline_max,
+                comparisons = comparisons)
+
+    #Equality checks go into the JSON profile with the timings
+    prof.extra['comparisons'] = comparisons
+    prof.close()
+    if not all(x['equal'] for x in comparisons):
+        sys.exit('Some optimized stages differ from their baselines')
@@ -3,41 +3,240 @@
     Author: Seth Rhoades
 '''
 
-import sys, re
+import sys, re, os, argparse
 import pandas as pd
 import numpy as np
-import setup_PhenotypePredict as util
+import setup_BuildLSTMData as util
+import setup_FeatureStore as store
+import setup_Vocabulary as vocab
+import setup_Profiling as profiling
 
-def main(patientRecords, phenotype, nsteps):
+builders = {'windowed': util.buildRNNDataWindowed, 'loop': util.buildRNNData, 
+    'sparse': util.buildRNNDataSparse}
 
-    patientRecords.columns = ['PATIENT', 'GENDER', 'RACE', 'ZIP', 'Age',
-            'PROCEDURE_CODE', 'OBSERVATION_DESCRIPTION', 'OBSERVATION_VALUE',
-            'CONDITION_CODE', 'CONDITION_DESCRIPTION']
-    
-    (raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict, 
-        orderedRecs) = util.buildDictsSortHistories(patientRecords)
+def main(patientRecords, phenotype, nsteps, layout = 'wide', builder = 'windowed',
+    storeDir = None, vocabulary = None, extendVocab = True, workers = 0, nShards = 16,
+    sampling = 'random', capacity = 20000, seed = 10, padShort = False):
 
-    xtrain, xtest, ytrain, ytest = util.buildRNNData(orderedRecs, nsteps, phenotype,
-        zipDict, genderDict, raceDict, smokerDict, conditionDict, procedureDict, 'no')
+    if padShort and builder == 'loop':
+        raise ValueError('Padding short histories needs the windowed or sparse builder')
 
-    return xtrain, xtest, ytrain, ytest
+    #Sharded: histories are sorted and feature tables built in worker processes, or
+    #shard by shard here while windows stream into reservoirs
+    if workers > 0 or sampling == 'reservoir':
+        if builder == 'loop' or storeDir is not None:
+            raise ValueError('Workers and reservoir sampling need the windowed or '
+                'sparse builder, without the feature store')
+        if sampling == 'reservoir' and builder != 'windowed':
+            raise ValueError('Reservoir sampling keeps dense windows, use the '
+                'windowed builder')
+        with profiling.stage('dictionary build', len(patientRecords)):
+            if layout == 'events':
+                patientRecords = util.eventsToRecords(patientRecords)
+            else:
+                patientRecords.columns = util.recordColumns
+            (raceDict, genderDict, zipDict, smokerDict, conditionDict, 
+                procedureDict) = util.buildDicts(patientRecords, vocabulary, 
+                extendVocab)
+        with profiling.stage('build') as record:
+            if sampling == 'reservoir':
+                (xtrain, xtest, ytrain, ytest, ptrain, 
+                    ptest) = util.buildRNNDataReservoir(patientRecords, nsteps, 
+                    phenotype, zipDict, genderDict, raceDict, smokerDict, 
+                    conditionDict, procedureDict, capacity, 1, 0.25, seed, workers, 
+                    nShards, padShort)
+            else:
+                (xtrain, xtest, ytrain, ytest, ptrain, 
+                    ptest) = util.buildRNNDataSharded(patientRecords, nsteps, 
+                    phenotype, zipDict, genderDict, raceDict, smokerDict, 
+                    conditionDict, procedureDict, 'no', workers, nShards, 
+                    builder == 'sparse', padShort)
+            record['rows'] = len(ytrain) + len(ytest)
+        return xtrain, xtest, ytrain, ytest, ptrain, ptest, util.featureNames(
+            conditionDict, procedureDict)
 
-if __name__ == '__main__':
+    with profiling.stage('dictionary build', len(patientRecords)):
+        if layout == 'events':
+            (raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict, 
+                orderedRecs) = util.buildDictsSortHistoriesEvents(patientRecords, 
+                vocabulary, extendVocab)
+        else:
+            patientRecords.columns = ['PATIENT', 'GENDER', 'RACE', 'ZIP', 'Age',
+                    'PROCEDURE_CODE', 'OBSERVATION_DESCRIPTION', 'OBSERVATION_VALUE',
+                    'CONDITION_CODE', 'CONDITION_DESCRIPTION']
         
-    try:
-        patientFile = sys.argv[1]
-    except IndexError:
-        patientFile = 'AggregatePatientData.csv'
+            (raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict, 
+                orderedRecs) = util.buildDictsSortHistories(patientRecords, vocabulary,
+                extendVocab)
 
-    pheno = 'Myocardial Infarction'
-    nSteps = 5
-    
-    records = pd.read_csv(patientFile, header = None)
+    #Feature rows are only recomputed for patients whose records changed
+    if storeDir is not None:
+        if builder == 'loop':
+            raise ValueError('The feature store needs the windowed or sparse builder')
+        with profiling.stage('feature tables') as record:
+            featureTables = store.cachedFeatureTables(storeDir, orderedRecs, zipDict, 
+                genderDict, raceDict, smokerDict, conditionDict, procedureDict, 
+                util.buildFeatureTables)
+            record['rows'] = featureTables[0].shape[0]
+    else:
+        featureTables = None
+
+    #The windowed and sparse builders record their own steps within this stage
+    with profiling.stage('build') as record:
+        if builder == 'loop':
+            (xtrain, xtest, ytrain, ytest, ptrain, ptest) = builders[builder](
+                orderedRecs, nsteps, phenotype, zipDict, genderDict, raceDict, 
+                smokerDict, conditionDict, procedureDict, 'no')
+        else:
+            (xtrain, xtest, ytrain, ytest, ptrain, ptest) = builders[builder](
+                orderedRecs, nsteps, phenotype, zipDict, genderDict, raceDict, 
+                smokerDict, conditionDict, procedureDict, 'no', featureTables, 
+                padShort)
+        record['rows'] = len(ytrain) + len(ytest)
+    variables = util.featureNames(conditionDict, procedureDict)
+
+    return xtrain, xtest, ytrain, ytest, ptrain, ptest, variables
+
+def mainMulti(patientRecords, phenotypes, stepSizes, layout = 'wide', storeDir = None,
+    vocabulary = None, extendVocab = True, workers = 0, nShards = 16, padShort = False):
+    """ Compact windows for every (phenotype, nSteps) combination, from one set of
+        feature tables
+    """
+    if workers > 0 and storeDir is not None:
+        raise ValueError('Workers build the feature tables without the feature store')
+
+    with profiling.stage('dictionary build', len(patientRecords)):
+        if layout == 'events':
+            patientRecords = util.eventsToRecords(patientRecords)
+        else:
+            patientRecords.columns = util.recordColumns
+        (raceDict, genderDict, zipDict, smokerDict, conditionDict, 
+            procedureDict) = util.buildDicts(patientRecords, vocabulary, extendVocab)
+    codeDicts = (zipDict, genderDict, raceDict, smokerDict, conditionDict, 
+        procedureDict)
+
+    if workers > 0:
+        featureTables, patientOrder, firstAges = util.shardedFeatureTables(
+            patientRecords, phenotypes, codeDicts, workers, nShards)
+    else:
+        with profiling.stage('sort histories', len(patientRecords)):
+            orderedRecs = util.sortHistories(patientRecords)
+        with profiling.stage('feature tables') as record:
+            if storeDir is not None:
+                featureTables = store.cachedFeatureTables(storeDir, orderedRecs, 
+                    zipDict, genderDict, raceDict, smokerDict, conditionDict, 
+                    procedureDict, util.buildFeatureTables)
+            else:
+                featureTables = util.buildFeatureTables(orderedRecs, *codeDicts)
+            record['rows'] = featureTables[0].shape[0]
+        with profiling.stage('phenotype ages', len(orderedRecs)):
+            firstAges = np.column_stack([util.phenotypeAges(orderedRecs, x) for x in 
+                phenotypes])
+        patientOrder = [x[0] for x in orderedRecs]
+
+    targets = util.buildMultiTargetData(featureTables, patientOrder, firstAges, 
+        phenotypes, stepSizes, padShort)
+    variables = util.featureNames(conditionDict, procedureDict)
+
+    return featureTables[0], featureTables[1], targets, variables
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Build LSTM windows from '
+        'aggregated patient records')
+    parser.add_argument('patientFile', nargs = '?', default = 'AggregatePatientData')
+    parser.add_argument('--layout', default = 'wide', choices = ['wide', 'events'],
+        help = 'wide merged records, or the long event table')
+    parser.add_argument('--builder', default = 'windowed', 
+        choices = ['windowed', 'loop', 'sparse'], help = 'per-(patient, age) feature '
+        'matrix with sliding windows, the original per-window loop, or compact '
+        'windows over sparse feature tables')
+    parser.add_argument('--out', default = 'LSTMData', help = 'dataset directory of '
+        '.npy arrays and a manifest.json')
+    parser.add_argument('--phenotypes', nargs = '+', 
+        default = ['Myocardial Infarction'], help = 'phenotypes to predict; with '
+        'several phenotypes or --steps, every combination is a target of one '
+        'dataset, sharing its feature tables (--builder sparse)')
+    parser.add_argument('--steps', type = int, nargs = '+', default = [5], 
+        help = 'age-years in each window')
+    parser.add_argument('--pad-short', action = 'store_true', help = 'also take one '
+        'window of each history shorter than --steps, left-padded with zero steps, '
+        'for LSTMFit.py to mask (windowed or sparse builder)')
+    parser.add_argument('--text', action = 'store_true', help = 'also write the '
+        'x/yTrain.txt, x/yTest.txt text files (dense builders only)')
+    parser.add_argument('--store', default = None, help = 'feature store directory; '
+        'feature rows are reused for patients whose records did not change')
+    parser.add_argument('--vocab', default = None, help = 'vocabulary JSON file, '
+        'created if missing; new codes are appended to it so feature columns stay '
+        'the same from run to run')
+    parser.add_argument('--freeze-vocab', action = 'store_true', help = 'do not add '
+        'new codes to the vocabulary, send them to its out-of-vocabulary columns')
+    parser.add_argument('--workers', type = int, default = 0, help = 'worker '
+        'processes for sorting histories and building feature tables, by shards of '
+        'patients; 0 for a single process. The dataset is the same either way')
+    parser.add_argument('--shards', type = int, default = 16, help = 'patient shards '
+        'with --workers')
+    parser.add_argument('--sampling', default = 'random', 
+        choices = ['random', 'reservoir'], help = 'balance and split all windows at '
+        'the end (seeded shuffle, train_test_split), or keep per-class reservoirs '
+        'while windows stream in and split by patient (windowed builder)')
+    parser.add_argument('--capacity', type = int, default = 20000, help = 'windows '
+        'kept per class with --sampling reservoir')
+    parser.add_argument('--seed', type = int, default = 10, help = 'seed for '
+        '--sampling reservoir')
+    parser.add_argument('--profile', default = None, metavar = 'PREFIX', 
+        help = 'write stage timings to PREFIX.json and a Chrome trace to '
+        'PREFIX.trace.json')
+    parser.add_argument('--profiler', default = None, choices = ['cprofile', 'sample'],
+        help = 'also profile functions, to PREFIX.prof (cProfile) or PREFIX.folded '
+        '(sampled stacks, for flame graphs)')
+    args = parser.parse_args()
+
+    prof = profiling.StageProfiler('BuildLSTMData', args.profile, 
+        args.profiler).activate()
+
+    multiTarget = len(args.phenotypes)*len(args.steps) > 1
+    if multiTarget and (args.builder != 'sparse' or args.sampling != 'random'):
+        parser.error('several --phenotypes or --steps need --builder sparse and '
+            '--sampling random')
+    if args.pad_short and args.builder == 'loop':
+        parser.error('--pad-short needs the windowed or sparse builder')
+
+    with profiling.stage('read') as record:
+        records = util.readAggregateData(args.patientFile, args.layout)
+        record['rows'] = len(records)
+    vocabulary = vocab.readVocabulary(args.vocab) if args.vocab is not None else (
+        vocab.newVocabulary())
     
-    xTrain, xTest, yTrain, yTest = main(records, pheno, nSteps)
+    if multiTarget:
+        binaryRows, denseRows, targets, variables = mainMulti(records, 
+            args.phenotypes, args.steps, args.layout, args.store, vocabulary, 
+            not args.freeze_vocab, args.workers, args.shards, args.pad_short)
+    else:
+        (xTrain, xTest, yTrain, yTest, patientsTrain, patientsTest, 
+            variables) = main(records, args.phenotypes[0], 
+            args.steps[0], args.layout, args.builder, args.store, vocabulary, 
+            not args.freeze_vocab, args.workers, args.shards, args.sampling, 
+            args.capacity, args.seed, args.pad_short)
+
+    if args.vocab is not None and not args.freeze_vocab:
+        vocab.writeVocabulary(vocabulary, args.vocab)
+
+    #The vocabulary goes with the dataset, so models trained on it can be scored
+    with profiling.stage('write'):
+        os.makedirs(args.out, exist_ok = True)
+        vocab.writeVocabulary(vocabulary, os.path.join(args.out, 'vocabulary.json'))
+        if multiTarget:
+            util.writeMultiTargetDataset(args.out, binaryRows, denseRows, targets, 
+                variables, args.pad_short)
+        else:
+            util.writeTensorDataset(args.out, xTrain, xTest, yTrain, yTest, variables,
+                args.pad_short, patientsTrain, patientsTest)
 
-    util.write3DArray(xTrain, 'xTrain.txt')
-    util.write3DArray(xTest, 'xTest.txt')
-    np.savetxt('yTrain.txt', yTrain)
-    np.savetxt('yTest.txt', yTest)
+        if args.text and not multiTarget and args.builder != 'sparse':
+            util.write3DArray(xTrain, 'xTrain.txt')
+            util.write3DArray(xTest, 'xTest.txt')
+            np.savetxt('yTrain.txt', yTrain)
+            np.savetxt('yTest.txt', yTest)
 
+    prof.close()
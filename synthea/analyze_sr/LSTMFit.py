@@ -5,68 +5,211 @@
     Author: Seth Rhoades
 """
 
-import sys
+import sys, os, json, shutil, argparse
 import pandas as pd
 import numpy as np
-import tensorflow as tf
-
-def main(xtrain, ytrain, xtest, ytest, batchsize, nepochs):
-
-    model = tf.keras.models.Sequential([
-            tf.keras.layers.LSTM(256, return_sequences=True, 
-                input_shape = (xtrain.shape[1], xtrain.shape[2])),
-            tf.keras.layers.LSTM(64),
-            tf.keras.layers.Dense(64, activation=tf.nn.relu),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.Dropout(0.25),
-            tf.keras.layers.Dense(32, activation=tf.nn.relu),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.Dropout(0.25),
-            tf.keras.layers.Dense(1, activation='sigmoid'),
-    ])
-    optimizer = tf.train.AdamOptimizer(1e-4)
-    model.compile(optimizer=optimizer, loss='binary_crossentropy', 
-        metrics=['accuracy'])
-
-    with tf.device('/device:GPU:0'):
-        model.fit(xtrain, ytrain, epochs=nepochs, batch_size=batchsize, verbose=1)
-
-    ypreds = model.predict(xtest)
+from sklearn.metrics import roc_auc_score
+import setup_BuildLSTMData as data
+import setup_Vocabulary as vocab
+import setup_Profiling as profiling
+
+def main(xtrain, ytrain, xtest, ytest, batchsize, nepochs, modeldir = None,
+    lstmUnits = (256, 64), denseUnits = (64, 32), learningRate = 1e-4, 
+    validation = 0.1, patience = 10, masking = False, checkpointDir = None, 
+    targetAuc = None, stopAtTarget = False, seed = 10, trainPatients = None):
+
+    #TensorFlow is only imported once there is a model to fit
+    import tensorflow as tf
+    import setup_LSTMFit as util
+
+    tf.keras.utils.set_random_seed(seed)
+    nsteps, nvars = util.windowShape(xtrain)
+
+    #Early stopping watches a seeded validation split of the training patients
+    if validation:
+        if trainPatients is None:
+            print('No patient of each window (text files, or an older dataset), so '
+                'validation windows are held out at random and share patients with '
+                'the fit')
+        fitLocs, validationLocs = util.validationSplit(ytrain, validation, seed, 
+            trainPatients)
+        validationInput = util.WindowBatches(xtrain, ytrain, batchsize, 
+            locs = validationLocs)
+    else:
+        fitLocs, validationInput = None, None
+    trainInput = util.WindowBatches(xtrain, ytrain, batchsize, shuffle = True, 
+        locs = fitLocs)
+    testInput = util.WindowBatches(xtest, None, batchsize)
+
+    model = util.buildModel(nsteps, nvars, lstmUnits, denseUnits, 0.25, masking, 
+        learningRate)
+    callbacks, timer = util.fitCallbacks(validation, patience, checkpointDir, 
+        targetAuc, stopAtTarget)
+
+    with profiling.stage('fit', len(trainInput.order)):
+        model.fit(trainInput, validation_data = validationInput, epochs = nepochs, 
+            callbacks = callbacks, verbose = 2)
+    util.reportTraining(timer, targetAuc)
+
+    #Saved for ScoreService.py
+    if modeldir is not None:
+        with profiling.stage('save'):
+            os.makedirs(modeldir, exist_ok = True)
+            model.save(os.path.join(modeldir, 'model.keras'))
+
+    with profiling.stage('predict', len(ytest)):
+        ypreds = model.predict(testInput)
 
     ypreds = ypreds.reshape(ytest.shape)
-    accDF = pd.DataFrame([ytest, ypreds]).T
+    accDF = pd.DataFrame([np.asarray(ytest), ypreds]).T
     accDF.columns = ['yTest', 'yPredScores']
+    if len(np.unique(ytest)) == 2:
+        print('Test AUC: {0:.3f}'.format(roc_auc_score(accDF.yTest, accDF.yPredScores)))
 
     return accDF
 
 if __name__ == '__main__':
 
-    try:
-        xtrainfile = sys.argv[1]
-        ytrainfile = sys.argv[2]
-        xtestfile = sys.argv[3]
-        ytestfile = sys.argv[4]
-    except IndexError:
-        xtrainfile = 'xTrain.txt'
-        ytrainfile = 'yTrain.txt'
-        xtestfile = 'xTest.txt'
-        ytestfile = 'yTest.txt'
-
-    trainLength = 3357
-    testLength =  1119
-    nSteps = 5
-    nVars = 258
-    batchSize = 256
-    nEpochs = 200
-
-    xTrain = np.loadtxt(xtrainfile).reshape(trainLength, nSteps, nVars)
-    xTest = np.loadtxt(xtestfile).reshape(testLength, nSteps, nVars)
-    yTrain = np.loadtxt(ytrainfile).reshape(trainLength, )
-    yTest = np.loadtxt(ytestfile).reshape(testLength, )
-
-    modelPredictions = main(xTrain, yTrain, xTest, yTest, batchSize, nEpochs)
+    parser = argparse.ArgumentParser(description = 'Fit an LSTM sequence classifier '
+        'to windows from BuildLSTMData.py')
+    parser.add_argument('files', nargs = '*', help = 'a dataset directory '
+        '(LSTMData by default), or xTrain, yTrain, xTest, yTest text files')
+    parser.add_argument('--target', default = None, help = 'target to fit, for a '
+        'dataset built with several --phenotypes or --steps')
+    parser.add_argument('--epochs', type = int, default = 200, help = 'most epochs; '
+        'early stopping usually ends the fit sooner')
+    parser.add_argument('--batch-size', type = int, default = 256)
+    parser.add_argument('--lstm-units', type = int, nargs = '+', default = [256, 64])
+    parser.add_argument('--dense-units', type = int, nargs = '+', default = [64, 32])
+    parser.add_argument('--learning-rate', type = float, default = 1e-4)
+    parser.add_argument('--fast', action = 'store_true', help = 'CPU-sized model: '
+        'LSTM 64, 32, dense 32, 16, batch size 512, learning rate 1e-3 and patience '
+        '5, unless given explicitly')
+    parser.add_argument('--validation', type = float, default = 0.1, help = 'share '
+        'of training patients whose windows are held out for early stopping; 0 to fit '
+        'every epoch on all of them')
+    parser.add_argument('--patience', type = int, default = 10, help = 'epochs '
+        'without a better validation AUC before stopping')
+    parser.add_argument('--intra-op', type = int, default = None, help = 'threads '
+        'within each op, all cores by default')
+    parser.add_argument('--inter-op', type = int, default = None, help = 'ops run '
+        'at once')
+    parser.add_argument('--bfloat16', action = 'store_true', help = 'mixed_bfloat16 '
+        'precision, for CPUs with bfloat16 support')
+    parser.add_argument('--masking', action = 'store_true', help = 'skip all-zero '
+        '(padding) steps; always on for a dataset built with --pad-short')
+    parser.add_argument('--checkpoint', default = None, metavar = 'DIR', 
+        help = 'keep the best model and a backup in DIR; rerunning after an '
+        'interruption resumes from the backup')
+    parser.add_argument('--target-auc', type = float, default = None, help = 'report '
+        'the epochs and seconds taken to reach this validation AUC')
+    parser.add_argument('--stop-at-target', action = 'store_true', help = 'stop as '
+        'soon as --target-auc is reached')
+    parser.add_argument('--vocab', default = None, help = 'vocabulary JSON the text '
+        'files were built with (BuildLSTMData.py --text), saved with the model so it '
+        'can be scored; a dataset directory has its own')
+    parser.add_argument('--seed', type = int, default = 10)
+    parser.add_argument('--inspect', action = 'store_true', help = 'print the '
+        'dataset\'s shapes and labels and exit, without loading TensorFlow')
+    parser.add_argument('--profile', default = None, metavar = 'PREFIX', 
+        help = 'write stage timings to PREFIX.json and a Chrome trace to '
+        'PREFIX.trace.json')
+    parser.add_argument('--profiler', default = None, choices = ['cprofile', 'sample'],
+        help = 'also profile functions, to PREFIX.prof (cProfile) or PREFIX.folded '
+        '(sampled stacks, for flame graphs)')
+    args = parser.parse_args()
+
+    #--fast only changes settings left at their defaults
+    if args.fast:
+        fastSettings = {'lstm_units': [64, 32], 'dense_units': [32, 16], 
+            'batch_size': 512, 'learning_rate': 1e-3, 'patience': 5}
+        for name, value in fastSettings.items():
+            if getattr(args, name) == parser.get_default(name):
+                setattr(args, name, value)
+
+    #A dataset directory from BuildLSTMData.py, or the four text files
+    xtrainfile = args.files[0] if len(args.files) else 'LSTMData'
+
+    if args.inspect:
+        xTrain, xTest, yTrain, yTest, manifest = data.loadTensorDataset(xtrainfile,
+            target = args.target)
+        print('{0}: {1} layout, {2} steps of {3} variables{4}{5}'.format(xtrainfile,
+            manifest['layout'], manifest['nSteps'], manifest['nVars'], 
+            ', target {0}'.format(manifest['target']) if 'target' in manifest else '',
+            ', short histories padded' if manifest.get('padded') else ''))
+        for name, ydata in [('train', yTrain), ('test', yTest)]:
+            print('{0}: {1} windows, {2:.1%} positive'.format(name, len(ydata), 
+                float(np.mean(ydata)) if len(ydata) else 0))
+        sys.exit()
+
+    import setup_LSTMFit as util
+    util.configureRuntime(args.intra_op, args.inter_op, args.bfloat16)
+
+    modelDir = 'LSTMModel'
+
+    prof = profiling.StageProfiler('LSTMFit', args.profile, args.profiler).activate()
+
+    with profiling.stage('load') as record:
+        if os.path.isdir(xtrainfile):
+            xTrain, xTest, yTrain, yTest, manifest = data.loadTensorDataset(xtrainfile,
+                target = args.target)
+            trainPatients = data.loadWindowPatients(xtrainfile, manifest)[0]
+        else:
+            if len(args.files) == 4:
+                xtrainfile, ytrainfile, xtestfile, ytestfile = args.files
+            else:
+                xtrainfile = 'xTrain.txt'
+                ytrainfile = 'yTrain.txt'
+                xtestfile = 'xTest.txt'
+                ytestfile = 'yTest.txt'
+
+            xTrain = data.read3DArray(xtrainfile)
+            xTest = data.read3DArray(xtestfile)
+            yTrain = np.loadtxt(ytrainfile)
+            yTest = np.loadtxt(ytestfile)
+            trainPatients = None
+
+            #Text files carry no manifest, so the model's is made from their shape,
+            #with variable names from the vocabulary when there is one
+            variables = None
+            if args.vocab is not None:
+                codeDicts = vocab.vocabularyDicts(vocab.readVocabulary(args.vocab))
+                variables = data.featureNames(codeDicts[4], codeDicts[5])
+                if len(variables) != xTrain.shape[2]:
+                    sys.exit('{0} gives {1} variables, the windows have {2}'.format(
+                        args.vocab, len(variables), xTrain.shape[2]))
+            manifest = {'version': 1, 'layout': 'dense', 'nSteps': xTrain.shape[1], 
+                'nVars': xTrain.shape[2], 'variables': variables}
+        record['rows'] = len(yTrain) + len(yTest)
+
+    #Only windows from BuildLSTMData.py --pad-short have zero steps to mask
+    masking = args.masking or manifest.get('padded', False)
+    if args.masking and not manifest.get('padded', False):
+        print('{0} has no padded windows (BuildLSTMData.py --pad-short), so masking '
+            'skips nothing'.format(xtrainfile))
+
+    modelPredictions = main(xTrain, yTrain, xTest, yTest, args.batch_size, args.epochs, 
+        modelDir, args.lstm_units, args.dense_units, args.learning_rate, 
+        args.validation, args.patience, masking, args.checkpoint, 
+        args.target_auc, args.stop_at_target, args.seed, trainPatients)
     
     modelPredictions.to_csv('yPredictions.csv')
 
+    #The model is scored with the dataset's variables and vocabulary, and the window
+    #length of the target it was fit to
+    with open(os.path.join(modelDir, 'manifest.json'), 'w') as fout:
+        json.dump(manifest, fout, indent = 2)
+    vocabFile = os.path.join(xtrainfile, 'vocabulary.json') if os.path.isdir(
+        xtrainfile) else args.vocab
+    if vocabFile is not None and os.path.exists(vocabFile):
+        shutil.copy(vocabFile, os.path.join(modelDir, 'vocabulary.json'))
+    else:
+        #Not one left from an earlier model
+        if os.path.exists(os.path.join(modelDir, 'vocabulary.json')):
+            os.remove(os.path.join(modelDir, 'vocabulary.json'))
+        print('No vocabulary saved with the model; ScoreService.py needs one (--vocab)')
+
+    prof.close()
+
 #Low 70s seems to be the best I can do here, complex vs simple model doesn't matter
 #much, although 2-layer LSTM helps a bit, beyond that it levels off
\ No newline at end of file
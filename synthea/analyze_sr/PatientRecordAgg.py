@@ -5,40 +5,241 @@
     Author: Seth Rhoades
 '''
 
-import sys, re
+import sys, re, os, argparse
 import pandas as pd
 import numpy as np
 import setup_PatientRecordAgg as util
+import setup_FeatureStore as store
+import setup_Profiling as profiling
 from pathos.helpers import mp
-from itertools import repeat
-
-try:
-    patientFile = sys.argv[1]
-    procedureFile = sys.argv[2]
-    observationFile = sys.argv[3]
-    conditionFile = sys.argv[4]
-    coreNum = sys.argv[5]
-except IndexError:
-    patientFile = 'output/csv/patients.csv'
-    procedureFile = 'output/csv/procedures.csv'
-    observationFile = 'output/csv/observations.csv'
-    conditionFile = 'output/csv/conditions.csv'
-    coreNum = 10
-
-def main(patientFile, procedureFile, observationFile, conditionFile, coreNum):
-        
-    patientRecs, IDs = util.combineDatasets(patientFile, procedureFile, observationFile,
-        conditionFile)
-
-    patientRecCopy = list(repeat(patientRecs, coreNum))
-    splitIDs = np.array_split(list(IDs), coreNum)
-
-    pooler = mp.Pool(coreNum)
-
-    with open('AggregatePatientData.csv', 'a') as fout:
-        for result in pooler.starmap(util.AggregateQuantValues, zip(patientRecCopy, 
-            splitIDs)):
-            result.to_csv(fout, index=False, header=False)
+
+aggregators = {'vectorized': util.AggregateQuantValuesVectorized, 
+    'loop': util.AggregateQuantValues, 'events': util.AggregateQuantEvents}
+
+outNames = {'wide': 'AggregatePatientData', 'events': 'AggregatePatientEvents'}
+
+def mainSql(patientFile, procedureFile, observationFile, conditionFile, 
+    fileFormat = 'parquet', memoryLimit = None, tempDir = None, threads = None, 
+    verifyPatients = 0, profileOut = None, profilerName = None):
+
+    prof = profiling.StageProfiler('PatientRecordAgg', profileOut, 
+        profilerName).activate()
+    con = util.duckdbConnection(memoryLimit, tempDir, threads)
+    outDir = outNames['wide']
+
+    #Parquet is written by the engine itself, other formats go through pandas
+    with profiling.stage('aggregate+write') as record:
+        if fileFormat == 'parquet':
+            nRows = util.writeSqlParts(patientFile, procedureFile, observationFile, 
+                conditionFile, con, outDir)
+        else:
+            patientRecs = util.combineAggregateSql(patientFile, procedureFile, 
+                observationFile, conditionFile, con)
+            nRows = len(patientRecs)
+            if fileFormat == 'csv':
+                with open(outDir + '.csv', 'a') as fout:
+                    patientRecs.to_csv(fout, index=False, header=False)
+            else:
+                util.clearParts(outDir)
+                util.writePart(util.encodeColumnar(patientRecs), outDir, 0, fileFormat)
+        print('{0} rows written to {1}'.format(nRows, outDir))
+        record['rows'] = nRows
+
+    if verifyPatients > 0:
+        with profiling.stage('verify', verifyPatients):
+            matches, nSample = util.verifySqlEngine(patientFile, procedureFile, 
+                observationFile, conditionFile, con, verifyPatients)
+            print('Sample of {0} patients ({1} rows) {2} the pandas path'.format(
+                verifyPatients, nSample, 'matches' if matches else 'DOES NOT match'))
+
+    prof.close()
+
+def writeShards(pooler, shards, outDir, fileFormat):
+    """ Aggregate shards on the pool. Columnar parts are written by the workers, csv 
+        rows are appended here
+
+    Returns:
+        Number of aggregated rows
+    """
+    if fileFormat == 'csv':
+        nRows = 0
+        with open(outDir + '.csv', 'a') as fout:
+            for result in pooler.imap_unordered(util.aggregateShard, shards):
+                result.to_csv(fout, index=False, header=False)
+                nRows += len(result)
+        return(nRows)
+    return(sum(pooler.imap_unordered(util.aggregateShard, shards)))
+
+def mainByRange(patientFile, procedureFile, observationFile, conditionFile, workers, 
+    aggMode, chunkSize, fileFormat, patientRanges):
+    """ Load, aggregate and write one range of patients at a time, so only one 
+        range's records are in memory (wide layout, no store)
+    """
+    outDir = outNames['wide']
+    if fileFormat != 'csv':
+        util.clearParts(outDir)
+    pooler = mp.Pool(workers)
+
+    ranges = util.combineDatasetsByRange(patientFile, procedureFile, observationFile, 
+        conditionFile, patientRanges, max(chunkSize, 1))
+    nRows, nParts = 0, 0
+    for i in range(patientRanges):
+        with profiling.stage('load (range {0})'.format(i)) as record:
+            patientRecs, IDs = next(ranges)
+            record['rows'] = len(patientRecs)
+        with profiling.stage('partition (range {0})'.format(i), len(patientRecs)):
+            shards = [(aggregators[aggMode], x, nParts + j, outDir, fileFormat) for
+                j, x in enumerate(util.partitionPatients(patientRecs, workers*4))]
+            nParts += len(shards)
+            del patientRecs
+        with profiling.stage('aggregate+write (range {0})'.format(i)) as record:
+            record['rows'] = writeShards(pooler, shards, outDir, fileFormat)
+            nRows += record['rows']
+
+    pooler.close()
+    pooler.join()
+    print('{0} rows written to {1}'.format(nRows, outDir))
+
+def main(patientFile, procedureFile, observationFile, conditionFile, workers, 
+    aggMode = 'vectorized', chunkSize = 500000, layout = 'wide', fileFormat = 'parquet',
+    storeDir = None, profileOut = None, profilerName = None, patientRanges = 1):
+
+    prof = profiling.StageProfiler('PatientRecordAgg', profileOut, 
+        profilerName).activate()
+
+    if patientRanges > 1:
+        mainByRange(patientFile, procedureFile, observationFile, conditionFile, 
+            workers, aggMode, chunkSize, fileFormat, patientRanges)
+        prof.close()
+        return
+
+    with profiling.stage('load') as record:
+        if layout == 'events':
+            patientRecs, IDs = util.buildEventTable(patientFile, procedureFile, 
+                observationFile, conditionFile, max(chunkSize, 1))
+            aggMode = 'events'
+        elif chunkSize > 0:
+            patientRecs, IDs = util.combineDatasetsStreaming(patientFile, procedureFile, 
+                observationFile, conditionFile, chunkSize)
+        else:
+            patientRecs, IDs = util.combineDatasets(patientFile, procedureFile, 
+                observationFile, conditionFile)
+        record['rows'] = len(patientRecs)
+
+    #Only new or changed patients are aggregated when there is a feature store
+    if storeDir is not None:
+        with profiling.stage('hash', len(patientRecs)):
+            storeLayer = 'records-' + layout
+            hashes = store.patientHashes(patientRecs)
+            staleIDs = store.stalePatients(os.path.join(storeDir, storeLayer), hashes)
+            patientRecs = patientRecs[patientRecs.PATIENT.isin(staleIDs)]
+            print('{0} of {1} patients new or changed'.format(len(staleIDs), 
+                len(hashes)))
+
+    #Several shards per worker, so results stream back while other shards still run
+    with profiling.stage('partition', len(patientRecs)):
+        outDir = outNames[layout]
+        shards = [(aggregators[aggMode], x, i, outDir, 
+            None if storeDir is not None else fileFormat) for i, x in 
+            enumerate(util.partitionPatients(patientRecs, workers*4))]
+        del patientRecs
+
+    pooler = mp.Pool(workers)
+
+    #Columnar parts are written by the workers, csv rows are appended here
+    #Worker CPU and memory are counted once the pool has closed, as childCpu
+    with profiling.stage('aggregate+write') as record:
+        if storeDir is not None:
+            results = list(pooler.imap_unordered(util.aggregateShard, shards))
+            aggregated = pd.concat(results, ignore_index = True) if len(results) else (
+                pd.DataFrame({'PATIENT': []}))
+            changedBuckets = store.updateRecordStore(storeDir, storeLayer, aggregated, 
+                hashes)
+            if fileFormat == 'csv':
+                with open(outDir + '.csv', 'w') as fout:
+                    for bucket, records in store.readRecordBuckets(storeDir, storeLayer):
+                        if records is not None:
+                            records.to_csv(fout, index=False, header=(
+                                layout=='events' and fout.tell()==0))
+            else:
+                nParts = util.writeStoreParts(storeDir, storeLayer, changedBuckets, 
+                    outDir, fileFormat)
+                print('{0} parts written to {1}/'.format(nParts, outDir))
+        elif fileFormat == 'csv':
+            with open(outDir + '.csv', 'a') as fout:
+                for result in pooler.imap_unordered(util.aggregateShard, shards):
+                    result.to_csv(fout, index=False, header=(layout=='events' and 
+                        fout.tell()==0))
+        else:
+            util.clearParts(outDir)
+            nRows = sum(pooler.imap_unordered(util.aggregateShard, shards))
+            print('{0} rows written to {1}/'.format(nRows, outDir))
+            record['rows'] = nRows
+        pooler.close()
+        pooler.join()
+
+    prof.close()
 
 if __name__ == '__main__':
-    main(patientFile, procedureFile, observationFile, conditionFile, coreNum)
+
+    parser = argparse.ArgumentParser(description = 'Aggregate Synthea patient '
+        'histories by age-year')
+    parser.add_argument('patientFile', nargs = '?', default = 'output/csv/patients.csv')
+    parser.add_argument('procedureFile', nargs = '?', 
+        default = 'output/csv/procedures.csv')
+    parser.add_argument('observationFile', nargs = '?', 
+        default = 'output/csv/observations.csv')
+    parser.add_argument('conditionFile', nargs = '?', 
+        default = 'output/csv/conditions.csv')
+    parser.add_argument('--workers', type = int, default = 10, 
+        help = 'Worker processes, each sent only its own shards of patients')
+    parser.add_argument('--agg-mode', default = 'vectorized', 
+        choices = ['vectorized', 'loop'], help = 'groupby aggregation, or the '
+        'original per-patient loop')
+    parser.add_argument('--chunk-size', type = int, default = 500000, 
+        help = 'Rows per chunk when streaming the history files, 0 to read each '
+        'file whole')
+    parser.add_argument('--patient-ranges', type = int, default = 1, help = 'load '
+        'and aggregate the patients in this many ranges, one at a time, so peak '
+        'memory follows a range rather than the cohort; each csv is read once per '
+        'range (wide layout, no --store)')
+    parser.add_argument('--layout', default = 'wide', choices = ['wide', 'events'],
+        help = 'wide merged records, or the long event table')
+    parser.add_argument('--format', default = 'parquet', 
+        choices = ['parquet', 'feather', 'csv'], help = 'one part file per shard in '
+        'a directory (parquet, feather), or rows appended to a single csv')
+    parser.add_argument('--store', default = None, help = 'feature store directory; '
+        'only patients whose source records changed since the last run are '
+        'aggregated, and the output is rewritten from the store')
+    parser.add_argument('--engine', default = 'pandas', choices = ['pandas', 'duckdb'],
+        help = 'pandas with a worker pool, or joins and averages pushed down as SQL '
+        'into an embedded DuckDB (wide layout, no --store)')
+    parser.add_argument('--memory-limit', default = None, help = 'DuckDB memory '
+        'limit, e.g. 4GB; beyond it the engine spills to --temp-dir')
+    parser.add_argument('--temp-dir', default = None, help = 'DuckDB spill directory')
+    parser.add_argument('--threads', type = int, default = None, help = 'DuckDB '
+        'threads, all cores by default')
+    parser.add_argument('--verify', type = int, default = 0, metavar = 'N', 
+        help = 'with --engine duckdb, check the first N patients against the '
+        'pandas path')
+    parser.add_argument('--profile', default = None, metavar = 'PREFIX', 
+        help = 'write stage timings to PREFIX.json and a Chrome trace to '
+        'PREFIX.trace.json')
+    parser.add_argument('--profiler', default = None, choices = ['cprofile', 'sample'],
+        help = 'also profile functions, to PREFIX.prof (cProfile) or PREFIX.folded '
+        '(sampled stacks, for flame graphs)')
+    args = parser.parse_args()
+
+    if args.engine == 'duckdb':
+        if args.layout != 'wide' or args.store is not None:
+            parser.error('--engine duckdb builds the wide layout, without --store')
+        mainSql(args.patientFile, args.procedureFile, args.observationFile, 
+            args.conditionFile, args.format, args.memory_limit, args.temp_dir, 
+            args.threads, args.verify, args.profile, args.profiler)
+    else:
+        if args.patient_ranges > 1 and (args.layout != 'wide' or args.store is not None):
+            parser.error('--patient-ranges is for the wide layout, without --store')
+        main(args.patientFile, args.procedureFile, args.observationFile, 
+            args.conditionFile, args.workers, args.agg_mode, args.chunk_size, 
+            args.layout, args.format, args.store, args.profile, args.profiler,
+            args.patient_ranges)
@@ -0,0 +1,96 @@
+''' One command line for the whole pipeline: aggregate Synthea CSVs
+    (PatientRecordAgg.py), build LSTM windows (BuildLSTMData.py), fit (LSTMFit.py or
+    BaselineFit.py), score (ScoreService.py) and benchmark (BenchmarkPipeline.py).
+    Stages whose inputs, outputs and arguments have not changed since they last
+    completed are skipped, so a rerun after a failure resumes where it stopped.
+    Nothing heavier than the standard library is imported until a stage runs.
+
+    Author: Seth Rhoades
+'''
+
+import sys, os, shlex, argparse
+import setup_Pipeline as util
+
+def runStage(stage, args, scriptArgs, state, force = False):
+    """ Run one stage unless it is up to date, recording it in the state file once
+        it completes
+    """
+    spec = util.stageSpec(stage, args, scriptArgs)
+    status = util.stageStatus(spec, state.get(stage))
+    if status == 'fresh' and not force:
+        print('{0}: up to date, skipped'.format(stage))
+        return
+    print('{0}: {1}, running {2} {3}'.format(stage, 'forced' if force else status,
+        spec['script'], ' '.join(shlex.quote(x) for x in spec['argv'])))
+    sys.stdout.flush()
+
+    #An appended csv would otherwise get a second copy of every row
+    if stage == 'aggregate' and args.format == 'csv':
+        for output in spec['outputs']:
+            if os.path.isfile(output):
+                os.remove(output)
+
+    state.pop(stage, None)
+    util.writeState(state, args.state)
+    elapsed = util.runScript(spec['script'], spec['argv'])
+    if len(spec['outputs']):
+        state[stage] = util.stageRecord(spec)
+        util.writeState(state, args.state)
+    print('{0}: done in {1:.1f}s'.format(stage, elapsed))
+
+def status(args, stageArgs, state):
+    for stage in util.stageOrder:
+        spec = util.stageSpec(stage, args, stageArgs[stage])
+        print('{0:<12s}{1}'.format(stage, util.stageStatus(spec, state.get(stage))))
+
+if __name__ == '__main__':
+
+    #Arguments after -- go to the stage script of a single-stage command
+    argv = sys.argv[1:]
+    scriptArgs = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser(description = 'Run pipeline stages, skipping '
+        'those already up to date. Arguments after -- are passed on to the stage '
+        'script, e.g. Pipeline.py build -- --builder sparse --workers 4')
+    parser.add_argument('command', choices = ['run', 'status'] + util.stageOrder +
+        ['score', 'bench'], help = 'run: aggregate, build and fit in turn; status: '
+        'whether each of them is up to date; or a single stage')
+    parser.add_argument('--csv-dir', default = 'output/csv', help = 'Synthea CSVs')
+    parser.add_argument('--layout', default = 'wide', choices = ['wide', 'events'])
+    parser.add_argument('--format', default = 'parquet',
+        choices = ['parquet', 'feather', 'csv'], help = 'aggregated records format')
+    parser.add_argument('--data', default = 'LSTMData', help = 'dataset directory '
+        'of windows')
+    parser.add_argument('--fit-model', default = 'lstm', choices = ['lstm',
+        'baseline'], help = 'LSTMFit.py, or BaselineFit.py')
+    for stage in util.stageOrder:
+        parser.add_argument('--{0}-args'.format(stage), default = '',
+            metavar = 'ARGS', help = 'more arguments for the {0} script with '
+            'run, e.g. "--workers 4"'.format(stage))
+    parser.add_argument('--from', dest = 'fromStage', default = None,
+        choices = util.stageOrder, help = 'with run, rerun from this stage on')
+    parser.add_argument('--force', action = 'store_true', help = 'run even if up to '
+        'date')
+    parser.add_argument('--state', default = 'pipeline_state.json', help = 'where '
+        'completed stages are recorded')
+    args = parser.parse_args(argv)
+
+    if len(scriptArgs) and args.command in ['run', 'status']:
+        parser.error('arguments after -- are for single stages; use --<stage>-args '
+            'with {0}'.format(args.command))
+    stageArgs = dict((x, shlex.split(getattr(args, x + '_args'))) for x in
+        util.stageOrder)
+    state = util.readState(args.state)
+
+    if args.command == 'status':
+        status(args, stageArgs, state)
+    elif args.command == 'run':
+        forceFrom = util.stageOrder.index(args.fromStage) if (
+            args.fromStage is not None) else len(util.stageOrder)
+        for i, stage in enumerate(util.stageOrder):
+            runStage(stage, args, stageArgs[stage], state, args.force or
+                i >= forceFrom)
+    else:
+        runStage(args.command, args, stageArgs.get(args.command, []) + scriptArgs,
+            state, args.force)
@@ -0,0 +1,74 @@
+''' Serve the LSTM model saved by LSTMFit.py on localhost. Windows are built from
+    raw patient records as in BuildLSTMData.py, and concurrent requests are scored
+    together in micro-batches. With --bench, time the running service with several
+    concurrent clients.
+
+    Author: Seth Rhoades
+'''
+
+import sys, time, json, argparse
+import urllib.request
+import pandas as pd
+import numpy as np
+import setup_ScoreService as util
+import setup_BuildLSTMData as data
+
+def main(modelDir, host, port, maxBatch, maxDelay):
+
+    server = util.startServer(modelDir, host, port, maxBatch, maxDelay)
+    print('Scoring on http://{0}:{1}/score'.format(host, port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+def bench(modelDir, patientFile, nClients, nRequests, maxBatch, maxDelay):
+
+    server = util.startServer(modelDir, '127.0.0.1', 0, maxBatch, maxDelay)
+    url = 'http://127.0.0.1:{0}/score'.format(server.server_address[1])
+
+    records = data.readAggregateData(patientFile)
+    records.columns = data.recordColumns
+    nSteps = server.nSteps
+    payloads = util.patientPayloads(records, nClients*nRequests, 1 if (
+        server.padShort) else nSteps)
+
+    util.benchService(url, payloads[:nClients], nClients, 2)
+    with urllib.request.urlopen(url.replace('/score', '/health')) as response:
+        before = json.load(response)
+    latencies, elapsed = util.benchService(url, payloads, nClients, nRequests)
+    with urllib.request.urlopen(url.replace('/score', '/health')) as response:
+        after = json.load(response)
+    server.shutdown()
+
+    print('{0} clients, {1} requests: p50 {2:.1f} ms, p99 {3:.1f} ms, '
+        '{4:.0f} requests/s, {5:.1f} windows per model call'.format(nClients, 
+        len(latencies), np.percentile(latencies, 50)*1000, 
+        np.percentile(latencies, 99)*1000, len(latencies)/elapsed, 
+        (after['windows'] - before['windows'])/max(after['batches'] - 
+        before['batches'], 1)))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Score patient records with the '
+        'saved LSTM model')
+    parser.add_argument('modelDir', nargs = '?', default = 'LSTMModel')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8050)
+    parser.add_argument('--max-batch', type = int, default = 256, help = 'most '
+        'windows scored in one model call')
+    parser.add_argument('--max-delay', type = float, default = 5, help = 'ms the '
+        'first request in a batch waits for others to join it')
+    parser.add_argument('--bench', default = None, metavar = 'PATIENTFILE', 
+        help = 'benchmark with patients from aggregated records instead of serving')
+    parser.add_argument('--clients', type = int, default = 8)
+    parser.add_argument('--requests', type = int, default = 50, help = 'requests '
+        'per client')
+    args = parser.parse_args()
+
+    if args.bench is not None:
+        bench(args.modelDir, args.bench, args.clients, args.requests, args.max_batch,
+            args.max_delay/1000)
+    else:
+        main(args.modelDir, args.host, args.port, args.max_batch, args.max_delay/1000)
@@ -0,0 +1,110 @@
+''' Python engines for the analyses of AllergyHistory.R, LabRegression.R and
+    QuantitativeDimReduction.R: allergy frequency trends, regressions of lab values
+    by age, race and gender, and PCA of lab values. The Synthea tables are read
+    once into a typed parquet cache shared by every analysis, and independent
+    analyses run in parallel. File paths come from the same params_sr yaml files.
+    Result tables are written as csv.
+
+    Author: Seth Rhoades
+'''
+
+import sys, os, argparse
+from functools import partial
+import pandas as pd
+import numpy as np
+import setup_SyntheaAnalyses as util
+import setup_SyntheaTables as tables
+import setup_Profiling as profiling
+from pathos.helpers import mp
+
+def main(files, tasks, outDir, cacheDir = None, workers = 1, pcaMethod = 'auto',
+    outlierSD = 3):
+
+    #Loaded before the workers fork, so they share this one load
+    with profiling.stage('load') as record:
+        names = set(['patients'])
+        if any(x[0] == 'allergy' for x in tasks):
+            names.add('allergies')
+        if any(x[0] in ['regression', 'pca'] for x in tasks):
+            names.add('observations')
+            record['rows'] = len(tables.patientObservations(files['patients'],
+                files['observations'], cacheDir))
+        if any(x[0] == 'pca' for x in tasks):
+            names.add('conditions')
+        for name in names:
+            tables.loadTable(name, files[name], cacheDir)
+
+    os.makedirs(outDir, exist_ok = True)
+    runTask = partial(util.timedAnalysis, files = files, cacheDir = cacheDir,
+        pcaMethod = pcaMethod, outlierSD = outlierSD)
+    with profiling.stage('analyses', len(tasks)):
+        if workers > 1:
+            pooler = mp.Pool(min(workers, len(tasks)))
+            completed = pooler.imap_unordered(runTask, tasks)
+        else:
+            completed = map(runTask, tasks)
+
+        for task, results, elapsed, error in completed:
+            label = ' '.join(str(x) for x in task if x is not None)
+            if error is not None:
+                print('{0}: skipped, {1}'.format(label, error))
+                continue
+            for name, result in results.items():
+                result.to_csv(os.path.join(outDir, name + '.csv'), index = False)
+            print('{0}: {1:.2f}s, wrote {2}'.format(label, elapsed, ', '.join(
+                x + '.csv' for x in results)))
+
+        if workers > 1:
+            pooler.close()
+            pooler.join()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Allergy trends, lab value '
+        'regressions and lab value PCA of a Synthea export, in parallel')
+    parser.add_argument('--params-dir', default = 'params_sr', help = 'directory '
+        'of the R analyses\' yaml parameters, for the csv paths')
+    parser.add_argument('--analyses', nargs = '+', default = ['allergy',
+        'regression', 'pca'], choices = ['allergy', 'regression', 'pca'])
+    parser.add_argument('--vitals', nargs = '+', default = ['Low Density '
+        'Lipoprotein Cholesterol', 'High Density Lipoprotein Cholesterol',
+        'Creatinine'], help = 'observations to regress on age, race and gender')
+    parser.add_argument('--min-tests', type = int, nargs = '+',
+        default = [200000, 250000], help = 'one PCA per value, of the tests done more '
+        'than this many times')
+    parser.add_argument('--pca', default = 'auto', choices = ['auto', 'full',
+        'randomized', 'incremental'], help = 'SVD solver; auto is randomized past '
+        '100,000 encounters')
+    parser.add_argument('--outlier-sd', type = float, default = 3, help = 'PCA is '
+        'refit without encounters past this many standard deviations on PC1 or PC2')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(),
+        help = 'worker processes, one analysis each at a time; 1 to run them in turn')
+    parser.add_argument('--cache-dir', default = 'SyntheaCache', help = 'parquet '
+        'copies of the csvs, reused until a csv changes')
+    parser.add_argument('--no-cache', action = 'store_true')
+    parser.add_argument('--out', default = 'AnalysisResults', help = 'directory '
+        'for the result csvs')
+    parser.add_argument('--profile', default = None, metavar = 'PREFIX',
+        help = 'write stage timings to PREFIX.json and a Chrome trace to '
+        'PREFIX.trace.json')
+    parser.add_argument('--profiler', default = None, choices = ['cprofile', 'sample'],
+        help = 'also profile functions, to PREFIX.prof (cProfile) or PREFIX.folded '
+        '(sampled stacks, for flame graphs)')
+    args = parser.parse_args()
+
+    #Each R analysis names the csvs it reads
+    files = {}
+    for paramFile in ['params_AllergyHistory.yaml', 'params_LabRegression.yaml',
+        'params_QuantitativeDimReduction.yaml']:
+        params = tables.readParams(os.path.join(args.params_dir, paramFile))
+        files.update((x, params[x]) for x in ['patients', 'observations',
+            'conditions', 'allergies'] if x in params)
+
+    tasks = [x for x in util.analysisTasks(args.vitals, args.min_tests) if x[0] in
+        args.analyses]
+
+    prof = profiling.StageProfiler('SyntheaAnalyses', args.profile,
+        args.profiler).activate()
+    main(files, tasks, args.out, None if args.no_cache else args.cache_dir,
+        args.workers, args.pca, args.outlier_sd)
+    prof.close()
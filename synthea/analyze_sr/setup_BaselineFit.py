@@ -0,0 +1,154 @@
+
+import os, json, pickle
+import pandas as pd
+import numpy as np
+import sklearn
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.metrics import roc_auc_score
+import setup_BuildLSTMData as data
+
+def windowBatches(xdata, batchSize = 4096):
+    """ Dense float32 (windows, steps, variables) batches of dense or compact windows,
+        so compact windows are never densified all at once
+    """
+    nWindows = len(xdata[0]) if isinstance(xdata, tuple) else len(xdata)
+    for start in range(0, nWindows, batchSize):
+        locs = np.arange(start, min(start + batchSize, nWindows))
+        if isinstance(xdata, tuple):
+            yield data.densifyWindows(xdata, locs)
+        else:
+            yield np.asarray(xdata[locs], dtype = np.float32)
+
+def summarizeWindows(windows):
+    """ Last value, mean and trend (least-squares slope per step) of each variable
+        over each window's steps
+
+    Args:
+        windows: (windows, steps, variables) array
+
+    Returns:
+        summaries: (windows, 3*variables) array, the lasts, then means, then trends
+    """
+    steps = np.arange(windows.shape[1], dtype = np.float32)
+    steps -= steps.mean()
+    trend = np.tensordot(windows, steps, axes = ([1], [0])) / max((steps**2).sum(), 1.)
+    return(np.concatenate([windows[:, -1, :], windows.mean(axis = 1), trend], axis = 1))
+
+def windowFeatures(xdata, features = 'summary', batchSize = 4096):
+    """ One row per window for a non-sequence model: summarizeWindows, or the steps
+        flattened side by side
+
+    Args:
+        xdata: Dense or compact windows, as from loadTensorDataset
+        features: 'summary' or 'flatten'
+        batchSize: Windows densified at a time
+
+    Returns:
+        features: (windows, columns) float32 array
+    """
+    if features == 'summary':
+        parts = [summarizeWindows(x) for x in windowBatches(xdata, batchSize)]
+    elif features == 'flatten':
+        parts = [x.reshape(len(x), -1) for x in windowBatches(xdata, batchSize)]
+    else:
+        raise ValueError('Unknown features: {0}'.format(features))
+    if not len(parts):
+        nSteps, nVars = (xdata[0].shape[1], xdata[1].shape[1] + xdata[2].shape[1]) if (
+            isinstance(xdata, tuple)) else xdata.shape[1:]
+        return(np.zeros((0, nVars*(3 if features == 'summary' else nSteps)),
+            dtype = np.float32))
+    return(np.concatenate(parts).astype(np.float32))
+
+def featureColumnNames(variables, nSteps, features = 'summary'):
+    """ Names of the windowFeatures columns
+    """
+    if features == 'summary':
+        return(['{0} {1}'.format(x, y) for x in ['last', 'mean', 'trend'] for y in
+            variables])
+    return(['step {0} {1}'.format(x, y) for x in range(nSteps) for y in variables])
+
+def buildBaseline(kind = 'logistic', C = 0.1, seed = 10):
+    """ Untrained baseline model
+
+    Args:
+        kind: 'logistic' for L1 (sparse) logistic regression on standardized
+            features, 'hgb' for histogram gradient boosting
+        C: Inverse L1 strength of the logistic regression
+        seed: Random seed
+
+    Returns:
+        model: sklearn estimator with predict_proba
+    """
+    if kind == 'logistic':
+        #scikit-learn 1.8 replaced penalty = 'l1' with l1_ratio = 1
+        version = tuple(int(x) for x in sklearn.__version__.split('.')[:2])
+        l1 = {'l1_ratio': 1.} if version >= (1, 8) else {'penalty': 'l1'}
+        return(make_pipeline(StandardScaler(), LogisticRegression(C = C,
+            solver = 'liblinear', max_iter = 1000, random_state = seed, **l1)))
+    if kind == 'hgb':
+        return(HistGradientBoostingClassifier(max_iter = 300, learning_rate = 0.1,
+            early_stopping = True, validation_fraction = 0.1, n_iter_no_change = 10,
+            random_state = seed))
+    raise ValueError('Unknown baseline: {0}'.format(kind))
+
+def nonzeroFeatures(model, columnNames, nTop = 10):
+    """ Largest non-zero coefficients of a logistic baseline, as (name, coefficient)
+    """
+    if not hasattr(model, 'steps'):
+        return([])
+    coefs = model.steps[-1][1].coef_.ravel()
+    order = np.argsort(-np.abs(coefs))
+    return([(columnNames[i], coefs[i]) for i in order[:nTop] if coefs[i] != 0])
+
+def readLSTMRun(predictionsFile, yTest, profileFile = None):
+    """ Test AUC of LSTMFit.py predictions on the same test windows, and its fit and
+        predict seconds from an LSTMFit.py --profile JSON
+
+    Returns:
+        Dictionary of auc, fit and predict seconds, with None for what is unknown
+    """
+    run = {'auc': None, 'fit': None, 'predict': None}
+    if predictionsFile is not None:
+        predictions = pd.read_csv(predictionsFile, index_col = 0)
+        if len(predictions) == len(yTest) and np.array_equal(predictions.yTest.values,
+            np.asarray(yTest)):
+            run['auc'] = roc_auc_score(predictions.yTest, predictions.yPredScores)
+        else:
+            print('{0} is not on these test windows, skipping its AUC'.format(
+                predictionsFile))
+
+    if profileFile is not None:
+        with open(profileFile) as fin:
+            stages = dict((x['stage'], x['wall']) for x in json.load(fin)['stages'])
+        run['fit'], run['predict'] = stages.get('fit'), stages.get('predict')
+    return(run)
+
+def printComparison(runs):
+    """ Fit and predict seconds and test AUC of each model, as {name: run}
+    """
+    print('{0:<20s}{1:>10s}{2:>12s}{3:>10s}'.format('model', 'fit (s)',
+        'predict (s)', 'test AUC'))
+    formatted = lambda x, y: ('{0:' + y + '}').format(x) if x is not None else '-'
+    for name, run in runs.items():
+        print('{0:<20s}{1:>10s}{2:>12s}{3:>10s}'.format(name, formatted(run['fit'],
+            '.2f'), formatted(run['predict'], '.2f'), formatted(run['auc'], '.3f')))
+
+def saveBaseline(model, modelDir, features, datasetDir = None, manifest = None):
+    """ Save a fitted baseline as model.pkl, with the features it takes and the
+        dataset's manifest and vocabulary, as LSTMFit.py saves its model
+    """
+    os.makedirs(modelDir, exist_ok = True)
+    with open(os.path.join(modelDir, 'model.pkl'), 'wb') as fout:
+        pickle.dump({'model': model, 'features': features}, fout)
+    if manifest is not None:
+        with open(os.path.join(modelDir, 'manifest.json'), 'w') as fout:
+            json.dump(manifest, fout, indent = 2)
+    if datasetDir is not None and os.path.exists(os.path.join(datasetDir,
+        'vocabulary.json')):
+        with open(os.path.join(datasetDir, 'vocabulary.json')) as fin:
+            vocabulary = fin.read()
+        with open(os.path.join(modelDir, 'vocabulary.json'), 'w') as fout:
+            fout.write(vocabulary)
@@ -0,0 +1,178 @@
+
+import sys, os, time
+import pandas as pd
+import numpy as np
+
+def simulatePatientRecords(nPatients, seed = 10):
+    """ Simulate combined patient records shaped like the output of combineDatasets,
+        for benchmarking without a Synthea export
+
+    Args:
+        nPatients: Number of patients to simulate
+        seed: Random seed, so repeated runs build identical records
+
+    Returns:
+        patientRecs: Simulated patient records, several rows per patient and age-year
+        patientIDs: Unique patients in the records
+    """
+    rng = np.random.RandomState(seed)
+    obsDescriptions = np.array(['Tobacco smoking status NHIS', 'Body Mass Index', 
+        'Diastolic Blood Pressure', 'Systolic Blood Pressure'])
+    smokerValues = np.array(['Never smoker', 'Former smoker', 'Every day smoker'])
+
+    patientIDs = np.array(['patient-{0:07d}'.format(x) for x in range(nPatients)])
+    nAges = rng.randint(5, 25, size = nPatients)
+    firstAge = rng.randint(0, 60, size = nPatients)
+    agePatient = np.repeat(np.arange(nPatients), nAges)
+    ageOffset = np.arange(len(agePatient)) - np.repeat(np.cumsum(nAges) - nAges, nAges)
+    ages = (firstAge[agePatient] + ageOffset).astype(float)
+
+    #Several observations per age-year, so there is something to average
+    nRows = rng.randint(2, 9, size = len(ages))
+    rowAge = np.repeat(np.arange(len(ages)), nRows)
+    rowPatient = agePatient[rowAge]
+    descriptions = obsDescriptions[rng.randint(0, len(obsDescriptions), size = len(rowAge))]
+    values = np.round(rng.normal(90., 25., size = len(rowAge)), 1).astype(str).astype(object)
+    smokers = descriptions == 'Tobacco smoking status NHIS'
+    values[smokers] = smokerValues[rng.randint(0, len(smokerValues), size = smokers.sum())]
+
+    patientRecs = pd.DataFrame({'PATIENT': patientIDs[rowPatient],
+        'GENDER': np.array(['M', 'F'])[rowPatient % 2],
+        'RACE': np.array(['white', 'black', 'hispanic', 'asian'])[rowPatient % 4],
+        'ZIP': (1000 + rowPatient % 500).astype(float),
+        'Age': ages[rowAge],
+        'PROCEDURE_CODE': rng.choice([428191000124101, 430193006, 710824005], 
+            size = len(rowAge)),
+        'OBSERVATION_DESCRIPTION': descriptions,
+        'OBSERVATION_VALUE': values,
+        'CONDITION_CODE': np.nan,
+        'CONDITION_DESCRIPTION': np.nan})
+
+    return(patientRecs, set(patientIDs))
+
+def writeSyntheaCsvs(outDir, nPatients, seed = 10):
+    """ Write simulated patients, procedures, observations and conditions CSVs with
+        the columns of a Synthea export, for benchmarking the whole pipeline offline.
+        The same nPatients and seed always give the same files
+
+    Args:
+        outDir: Directory for the four CSVs, created if needed
+        nPatients: Number of patients, about 70% of whom have a DEATHDATE
+        seed: Random seed
+
+    Returns:
+        patientFile, procedureFile, observationFile, conditionFile
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(outDir, exist_ok = True)
+    fileNames = [os.path.join(outDir, x + '.csv') for x in ['patients', 'procedures',
+        'observations', 'conditions']]
+
+    patientIDs = np.array(['{0:08x}-0000-4000-8000-{1:012d}'.format(x, x) for x in 
+        range(nPatients)])
+    birthDates = pd.to_datetime('1930-01-01') + pd.to_timedelta(rng.randint(0, 
+        365*70, nPatients), unit = 'D')
+    deathDates = birthDates + pd.to_timedelta(rng.randint(365*40, 365*90, nPatients),
+        unit = 'D')
+    hasDied = rng.rand(nPatients) < 0.7
+    patients = pd.DataFrame({'ID': patientIDs, 
+        'BIRTHDATE': birthDates.strftime('%Y-%m-%d'),
+        'DEATHDATE': np.where(hasDied, deathDates.strftime('%Y-%m-%d'), None),
+        'SSN': '999-00-0000', 'DRIVERS': 'S99999999', 'PASSPORT': np.nan, 
+        'PREFIX': 'Mr.', 'FIRST': 'Jon', 'LAST': 'Doe', 'SUFFIX': np.nan, 
+        'MAIDEN': np.nan, 'MARITAL': 'M',
+        'RACE': np.array(['white', 'black', 'hispanic', 'asian'])[rng.randint(0, 4, 
+            nPatients)],
+        'ETHNICITY': 'irish', 
+        'GENDER': np.array(['M', 'F'])[rng.randint(0, 2, nPatients)],
+        'BIRTHPLACE': 'Boston', 'ADDRESS': '1 Main St', 'CITY': 'Boston', 
+        'STATE': 'Massachusetts', 
+        'ZIP': rng.choice([1001., 2139., 2144., np.nan], nPatients)})
+    patients.to_csv(fileNames[0], index = False)
+
+    #Each encounter has a date, and procedures, observations and conditions on it
+    nEncounters = rng.randint(5, 30, nPatients)
+    encounterPatient = np.repeat(np.arange(nPatients), nEncounters)
+    encounterDates = np.asarray((birthDates[encounterPatient] + pd.to_timedelta(
+        rng.randint(0, 365*60, len(encounterPatient)), unit = 'D')).strftime('%Y-%m-%d'))
+    encounterIDs = np.array(['encounter-{0}'.format(x) for x in 
+        range(len(encounterPatient))])
+
+    def encounterRows(counts):
+        rowEncounter = np.repeat(np.arange(len(encounterPatient)), counts)
+        return(rowEncounter, patientIDs[encounterPatient[rowEncounter]])
+
+    procCodes = np.array([428191000124101, 430193006, 710824005, 73761001, 23426006])
+    procDescriptions = np.array(['Medication Reconciliation (procedure)', 
+        'Medication Reconciliation (procedure)', 'Assessment of health and social '
+        'care needs (procedure)', 'Colonoscopy', 'Pulmonary rehabilitation (regime/'
+        'therapy)'])
+    rowEncounter, rowPatient = encounterRows(rng.randint(0, 3, len(encounterPatient)))
+    codeLocs = rng.randint(0, len(procCodes), len(rowEncounter))
+    pd.DataFrame({'DATE': encounterDates[rowEncounter], 'PATIENT': rowPatient,
+        'ENCOUNTER': encounterIDs[rowEncounter], 'CODE': procCodes[codeLocs],
+        'DESCRIPTION': procDescriptions[codeLocs], 'REASONCODE': np.nan, 
+        'REASONDESCRIPTION': np.nan}).to_csv(fileNames[1], index = False)
+
+    #Includes observations that combineDatasets drops, as a real export does
+    obsDescriptions = np.array(['Body Height', 'Body Weight', 'Body Mass Index', 
+        'Diastolic Blood Pressure', 'Systolic Blood Pressure', 
+        'Tobacco smoking status NHIS', 'Creatinine', 
+        'High Density Lipoprotein Cholesterol', 'Low Density Lipoprotein Cholesterol',
+        'Hemoglobin A1c/Hemoglobin.total in Blood'])
+    rowEncounter, rowPatient = encounterRows(rng.randint(2, 12, len(encounterPatient)))
+    descriptions = obsDescriptions[rng.randint(0, len(obsDescriptions), 
+        len(rowEncounter))]
+    values = np.round(rng.normal(80., 20., len(rowEncounter)), 1).astype(str).astype(
+        object)
+    smokers = descriptions == 'Tobacco smoking status NHIS'
+    values[smokers] = np.array(['Never smoker', 'Former smoker', 
+        'Every day smoker'])[rng.randint(0, 3, smokers.sum())]
+    pd.DataFrame({'DATE': encounterDates[rowEncounter], 'PATIENT': rowPatient,
+        'ENCOUNTER': encounterIDs[rowEncounter], 'CODE': '8302-2', 
+        'DESCRIPTION': descriptions, 'VALUE': values, 'UNITS': 'mg/dL',
+        'TYPE': np.where(smokers, 'text', 'numeric')}).to_csv(fileNames[2], 
+        index = False)
+
+    conditionCodes = np.array([22298006, 38341003, 15777000, 44054006, 10509002])
+    conditionDescriptions = np.array(['Myocardial Infarction', 'Hypertension', 
+        'Prediabetes', 'Diabetes', 'Acute bronchitis (disorder)'])
+    rowEncounter, rowPatient = encounterRows((rng.rand(len(encounterPatient)) < 
+        0.15).astype(int))
+    codeLocs = rng.randint(0, len(conditionCodes), len(rowEncounter))
+    pd.DataFrame({'START': encounterDates[rowEncounter], 'STOP': np.nan, 
+        'PATIENT': rowPatient, 'ENCOUNTER': encounterIDs[rowEncounter], 
+        'CODE': conditionCodes[codeLocs], 
+        'DESCRIPTION': conditionDescriptions[codeLocs]}).to_csv(fileNames[3], 
+        index = False)
+
+    return(tuple(fileNames))
+
+def syntheaFiles(dataDir, nPatients, seed = 10):
+    """ CSVs from writeSyntheaCsvs for this scale and seed, written only once and
+        reused by later runs
+    """
+    outDir = os.path.join(dataDir, 'synthea-{0}-seed{1}'.format(nPatients, seed))
+    fileNames = [os.path.join(outDir, x + '.csv') for x in ['patients', 'procedures',
+        'observations', 'conditions']]
+    if all(os.path.exists(x) for x in fileNames):
+        return(tuple(fileNames))
+    return(writeSyntheaCsvs(outDir, nPatients, seed))
+
+def timeCall(func, *args):
+    """ Wall-clock a single call
+
+    Returns:
+        result: Return value of func
+        elapsed: Seconds taken
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    return(result, elapsed)
+
+def scalingExponent(rowCounts, elapsed):
+    """ Slope of log(time) against log(rows). Close to 1 means linear scaling
+    """
+    slope = np.polyfit(np.log(rowCounts), np.log(elapsed), 1)[0]
+    return(slope)
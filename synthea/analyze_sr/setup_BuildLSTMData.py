@@ -1,58 +1,155 @@
 
-import sys, re, random
+import sys, re, os, glob, json, random, hashlib
 import pandas as pd
 import numpy as np
 from itertools import chain
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import sparse
+from pathos.helpers import mp
 from sklearn.model_selection import train_test_split
+import setup_Vocabulary as vocab
+import setup_FeatureStore as store
+import setup_Profiling as profiling
 
-def buildDictsSortHistories(patientRecs):
+recordColumns = ['PATIENT', 'GENDER', 'RACE', 'ZIP', 'Age', 'PROCEDURE_CODE', 
+    'OBSERVATION_DESCRIPTION', 'OBSERVATION_VALUE', 'CONDITION_CODE', 
+    'CONDITION_DESCRIPTION']
+
+def readAggregateData(patientPath, layout = 'wide'):
+    """ Read the output of PatientRecordAgg.py: a directory of parquet/feather part
+        files, or the headerless (wide) or headed (events) csv
+
+    Args:
+        patientPath: AggregatePatientData(.csv) or AggregatePatientEvents(.csv)
+        layout: 'wide' merged records, or the long 'events' table
+
+    Returns:
+        patientRecs: Aggregated patient records (or events)
+    """
+    if not os.path.isdir(patientPath):
+        if layout == 'events':
+            return(pd.read_csv(patientPath, dtype = {'PATIENT': 'category', 
+                'GENDER': 'category', 'RACE': 'category', 'EVENT_TYPE': 'category', 
+                'CODE': 'category'}))
+        return(pd.read_csv(patientPath, header = None, names = recordColumns))
+
+    parts = []
+    for fileName in sorted(glob.glob(os.path.join(patientPath, 'part-*'))):
+        if fileName.endswith('.parquet'):
+            parts.append(pd.read_parquet(fileName))
+        elif fileName.endswith('.feather'):
+            parts.append(pd.read_feather(fileName))
+    patientRecs = pd.concat(parts, ignore_index = True)
+
+    #Put the split numeric and text values back into one column
+    valueColumn = 'VALUE' if layout == 'events' else 'OBSERVATION_VALUE'
+    textValues = patientRecs.pop(valueColumn + '_TEXT').astype(object)
+    patientRecs[valueColumn] = patientRecs[valueColumn].astype(object).where(
+        textValues.isnull(), textValues)
+
+    for column in patientRecs.columns:
+        if patientRecs[column].dtype == object and column != valueColumn:
+            patientRecs[column] = patientRecs[column].astype('category')
+    return(patientRecs)
+
+def formatZips(zips):
+    """ Zip codes as the zero-padded strings the zip dictionary is keyed by, with
+        None (e.g. from JSON) the same as NaN
+    """
+    return(['0' + re.sub('\.0', '', vocab.codeKey(x)) for x in zips])
+
+def buildDictsSortHistories(patientRecs, vocabulary = None, extend = True):
     """ Build dictionaries of covariates for post-modeling analysis. Also order
-        each patient's records by their age
+        each patient's records by their age. Columns come from a vocabulary (see
+        setup_Vocabulary), so they stay the same between runs and processes, with
+        column 0 of each dictionary for codes the vocabulary does not have
 
     Args:
         patientRecs: Patient medical history
+        vocabulary: Persisted vocabulary to take columns from, updated in place with
+            any new codes. A new one is built from the records if not given
+        extend: If False, codes not in the vocabulary go to its out-of-vocabulary
+            column instead of being appended
 
     Returns:
         raceDict: Dictionary of unique races, numerically coded
-        genderDict: Dictionary of M/F, 0/1 coded
+        genderDict: Dictionary of M/F, 1/2 coded
         zipDict: Dictionary of unique zip codes represented in the data
         smokerDict: Dictionary of unique smoking status (should be 3)
         conditionDict: Dictionary of unique conditions
         procedureDict: Dictionary of unique procedures
         sortedHistory: History of patient records, ordered by age
     """
-    raceDict = dict()
-    for i, j in reversed(list(enumerate(set(patientRecs.RACE)))):
-        raceDict.update({j:i})
+    (raceDict, genderDict, zipDict, smokerDict, conditionDict, 
+        procedureDict) = buildDicts(patientRecs, vocabulary, extend)
 
-    genderDict = dict()
-    for i, j in reversed(list(enumerate(set(patientRecs.GENDER)))):
-        genderDict.update({j:i})
+    sortHistory = sortHistories(patientRecs)
 
-    patientRecs.ZIP = ['0' + re.sub('\.0', '', str(x)) for x in patientRecs.ZIP]
-    zips = set(patientRecs.ZIP)
-    zipDict = dict()
-    for i, j in enumerate(zips):
-        zipDict.update({j:i})
+    return(raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict, 
+        sortHistory)
 
-    smokerDict = dict()
-    for i, j in reversed(list(enumerate(set(patientRecs.OBSERVATION_VALUE[patientRecs.
-        OBSERVATION_DESCRIPTION=='Tobacco smoking status NHIS'])))):
-        smokerDict.update({j:i})
+def buildDicts(patientRecs, vocabulary = None, extend = True):
+    """ The dictionaries of buildDictsSortHistories, without sorting the histories.
+        ZIP is formatted in place
 
-    conditionDict = dict()
-    for i, j in reversed(list(enumerate(set(patientRecs.CONDITION_DESCRIPTION)))):
-        conditionDict.update({j:i})
+    Returns:
+        raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict
+    """
+    patientRecs.ZIP = formatZips(patientRecs.ZIP)
 
-    procedureDict = dict()
-    for i, j in reversed(list(enumerate(set(patientRecs.PROCEDURE_CODE)))):
-        procedureDict.update({j:i})
+    if vocabulary is None:
+        vocabulary = vocab.newVocabulary()
+    vocab.updateVocabulary(vocabulary, patientRecs, extend)
+    return(vocab.vocabularyDicts(vocabulary))
 
-    sortHistory = [(x[0], x[1].sort_values('Age')) for x in patientRecs.groupby('PATIENT')]
+def sortHistories(patientRecs):
+    """ (patient, records ordered by age) for each patient, in patient order
+    """
+    return([(x[0], x[1].sort_values('Age')) for x in patientRecs.groupby('PATIENT')])
 
-    return(raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict, 
-        sortHistory)
 
+def eventsToRecords(patientEvents):
+    """ Lay the long event table from buildEventTable out in the columns of the
+        aggregated patient records, one event per row with the other event columns
+        left empty, so the record-based functions here can use it unchanged
+
+    Args:
+        patientEvents: Patient event table
+
+    Returns:
+        patientRecs: Patient medical history, in the AggregatePatientData columns
+    """
+    patientRecs = pd.DataFrame({'PATIENT': patientEvents.PATIENT.astype(str).values, 
+        'GENDER': patientEvents.GENDER.astype(object).values, 
+        'RACE': patientEvents.RACE.astype(object).values,
+        'ZIP': patientEvents.ZIP.astype(float).values, 
+        'Age': patientEvents.Age.values})
+
+    eventCodes = patientEvents.CODE.astype(object).values
+    isProcedure = (patientEvents.EVENT_TYPE=='procedure').values
+    isObservation = (patientEvents.EVENT_TYPE=='observation').values
+    isCondition = (patientEvents.EVENT_TYPE=='condition').values
+
+    patientRecs['PROCEDURE_CODE'] = np.where(isProcedure, eventCodes, np.nan)
+    patientRecs['OBSERVATION_DESCRIPTION'] = np.where(isObservation, eventCodes, np.nan)
+    patientRecs['OBSERVATION_VALUE'] = np.where(isObservation, 
+        patientEvents.VALUE.values, np.nan)
+    patientRecs['CONDITION_CODE'] = np.nan
+    patientRecs['CONDITION_DESCRIPTION'] = np.where(isCondition, eventCodes, np.nan)
+
+    return(patientRecs)
+
+def buildDictsSortHistoriesEvents(patientEvents, vocabulary = None, extend = True):
+    """ buildDictsSortHistories for the long event table from buildEventTable
+
+    Args:
+        patientEvents: Patient event table
+        (see buildDictsSortHistories for the vocabulary)
+
+    Returns:
+        (see buildDictsSortHistories)
+    """
+    return(buildDictsSortHistories(eventsToRecords(patientEvents), vocabulary, extend))
 
 def conditionVars(singleRecord, conditionDict):
     """ Create a 0/1 vector of the unique conditions for a given individual's record
@@ -151,14 +248,22 @@ def extractVarsOneStep(singleRecord, singleZip, singleGender, singleRace,
 def balanceSamples(xData, yData, ratio):
     """Create a ratio:1 sample for 0s to 1s in an unbalanced dataset
     """
+    allLocs = balanceIndices(yData, ratio)
+    xData, yData = xData[allLocs], yData[allLocs]
+
+    return(xData, yData)
+
+def balanceIndices(yData, ratio):
+    """The positions balanceSamples keeps, so they can be chosen before any window
+        is materialized
+    """
     zeros = [i for i,j in enumerate(yData) if j==0.]
     ones = [i for i,j in enumerate(yData) if j==1.]
     random.Random(10).shuffle(zeros)
     zeros = zeros[0:len(ones)*ratio]
     allLocs = zeros + ones
-    xData, yData = xData[allLocs], yData[allLocs]
 
-    return(xData, yData)
+    return(allLocs)
 
 def buildRNNData(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
     smokerDict, conditionDict, procedureDict, posControl = 'no'):
@@ -176,10 +281,12 @@ def buildRNNData(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
 
     Returns:
         xTrain, xTest, yTrain, yTest data, with y being 0/1 indicator of the phenotype
-        occuring some point in the patient's future.
+        occuring some point in the patient's future. Then patientsTrain, patientsTest,
+        the hash of each window's patient (see hashPatients)
     """
     xData = []
     yData = []
+    windowIDs = []
     for patient in patientRecs:
         oneZip = patient[1].ZIP.values[0]
         oneGender = patient[1].GENDER.values[0]
@@ -203,6 +310,7 @@ def buildRNNData(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
                             timeSeries.append(oneAgeData)
                         xData.append(timeSeries)
                         yData.append(1.)
+                        windowIDs.append(patient[0])
 
         else:        
             subRec = patient[1]
@@ -220,19 +328,662 @@ def buildRNNData(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
                         timeSeries.append(oneAgeData)
                     xData.append(timeSeries)
                     yData.append(0.)
+                    windowIDs.append(patient[0])
     
     xData, yData = np.array(xData), np.array(yData)
 
-    xData, yData = balanceSamples(xData, yData, 1)
+    allLocs = balanceIndices(yData, 1)
+    xData, yData = xData[allLocs], yData[allLocs]
+    windowHashes = hashPatients(windowIDs)[allLocs]
 
     #Make a positive control for the model
     if posControl == 'yes':
         xData = makePosControl(xData, yData)
 
-    xTrain, xTest, yTrain, yTest = train_test_split(xData, 
-        yData, test_size = 0.25, random_state = 10)
+    (xTrain, xTest, yTrain, yTest, patientsTrain, patientsTest) = train_test_split(
+        xData, yData, windowHashes, test_size = 0.25, random_state = 10)
+
+    return(xTrain, xTest, yTrain, yTest, patientsTrain, patientsTest)
+
+def firstRowValues(values, rowKeys, nKeys, default):
+    """ The first value in each key's rows, or default for keys without rows
+    """
+    keyValues = np.full(nKeys, default, dtype = float)
+    firstRows = pd.Series(rowKeys).drop_duplicates().index.values
+    keyValues[rowKeys[firstRows]] = values[firstRows]
+    return(keyValues)
+
+def buildFeatureTables(patientRecs, zipDict, genderDict, raceDict, smokerDict, 
+    conditionDict, procedureDict, denseType = np.float32):
+    """ Compute every patient's per-age feature vector (as extractVarsOneStep does for
+        one age at a time) in one vectorized pass over all records. The 0/1 condition
+        and procedure columns are kept sparse, so their memory follows the codes
+        present rather than the size of the dictionaries
+
+    Args:
+        patientRecs: Sorted patient histories, from buildDictsSortHistories
+        (see extractVarsOneStep for the dictionaries)
+        denseType: dtype of the continuous columns
+
+    Returns:
+        binaryRows: Sparse uint8 condition and procedure columns, one row per
+            (patient, age), patients in order then ages sorted
+        denseRows: Zip, gender, race, then smoking/BP/BMI with missingness
+            indicators and age, for the same rows
+        patientStarts: First row of each patient, plus a final end row
+        rowAges: Age of each row
+    """
+    records = pd.concat([x[1] for x in patientRecs], ignore_index = True)
+    recordCounts = np.array([len(x[1]) for x in patientRecs])
+    recordPatient = np.repeat(np.arange(len(patientRecs)), recordCounts)
+    firstRecords = np.cumsum(recordCounts) - recordCounts
+
+    #Row keys, sorted by patient then age
+    keyFrame = pd.DataFrame({'patient': recordPatient, 'Age': records.Age.values})
+    rowKeys = keyFrame.groupby(['patient', 'Age'], sort = True).ngroup().values
+    keyFrame = keyFrame.drop_duplicates().sort_values(['patient', 'Age'])
+    nKeys = len(keyFrame)
+    rowAges = keyFrame.Age.values
+    patientStarts = np.searchsorted(keyFrame.patient.values, np.arange(
+        len(patientRecs) + 1))
+    keyPatient = keyFrame.patient.values
+
+    denseRows = np.zeros((nKeys, 12), dtype = denseType)
+
+    #Demographics from each patient's first record
+    for col, (column, codeDict) in enumerate([('ZIP', zipDict), ('GENDER', genderDict), 
+        ('RACE', raceDict)]):
+        patientValues = records[column].values[firstRecords]
+        denseRows[:, col] = vocab.lookupCodes(codeDict, patientValues)[keyPatient]
+
+    #Multi-hot conditions and procedures, as (row, column) pairs
+    binaryKeys, binaryCols = [], []
+    for column, codeDict, colStart in [('CONDITION_DESCRIPTION', conditionDict, 0), 
+        ('PROCEDURE_CODE', procedureDict, len(conditionDict))]:
+        values = pd.Series(records[column].values).astype(object)
+        present = (values != 'nan').values
+        binaryKeys.append(rowKeys[present])
+        binaryCols.append(colStart + vocab.lookupCodes(codeDict, 
+            values[present]).astype(int))
+    nBinary = len(conditionDict) + len(procedureDict)
+    cells = np.unique(np.concatenate(binaryKeys).astype(np.int64)*nBinary + 
+        np.concatenate(binaryCols))
+    binaryRows = sparse.csr_matrix((np.ones(len(cells), dtype = np.uint8), 
+        (cells // nBinary, cells % nBinary)), shape = (nKeys, nBinary))
+
+    #Smoking, BP and BMI: the first value in each age-year, or a missingness indicator
+    descriptions = records.OBSERVATION_DESCRIPTION.values
+    obsValues = records.OBSERVATION_VALUE.values
+    smokers = descriptions == 'Tobacco smoking status NHIS'
+    smokerCodes = vocab.lookupCodes(smokerDict, obsValues[smokers])
+    smokerStatus = firstRowValues(smokerCodes, rowKeys[smokers], nKeys, np.nan)
+    denseRows[:, 3] = np.nan_to_num(smokerStatus, nan = 0.)
+    denseRows[:, 4] = np.isnan(smokerStatus)
+
+    for i, description in enumerate(['Diastolic Blood Pressure', 
+        'Systolic Blood Pressure', 'Body Mass Index']):
+        measured = descriptions == description
+        hasValue = firstRowValues(np.ones(measured.sum()), rowKeys[measured], nKeys, 0.)
+        firstValue = firstRowValues(obsValues[measured].astype(float), rowKeys[measured],
+            nKeys, 0.)
+        denseRows[:, 5 + i*2] = firstValue
+        denseRows[:, 6 + i*2] = 1. - hasValue
+
+    denseRows[:, -1] = rowAges
+
+    return(binaryRows, denseRows, patientStarts, rowAges)
+
+def combineFeatureColumns(binaryPart, densePart):
+    """ Put dense and 0/1 columns back in extractVarsOneStep order: zip, gender, race,
+        conditions, procedures, smoking/BP/BMI, age. Works on rows or on windows
+    """
+    return(np.concatenate([densePart[..., :3], binaryPart.astype(densePart.dtype), 
+        densePart[..., 3:]], axis = -1))
+
+def buildFeatureMatrix(patientRecs, zipDict, genderDict, raceDict, smokerDict, 
+    conditionDict, procedureDict, featureTables = None):
+    """ Dense version of buildFeatureTables, or of already built featureTables
+
+    Returns:
+        featureMatrix: One row per (patient, age), patients in order then ages sorted
+        patientStarts: First featureMatrix row of each patient, plus a final end row
+        rowAges: Age of each featureMatrix row
+    """
+    if featureTables is None:
+        featureTables = buildFeatureTables(patientRecs, zipDict, genderDict, raceDict, 
+            smokerDict, conditionDict, procedureDict, float)
+    binaryRows, denseRows, patientStarts, rowAges = featureTables
+    featureMatrix = combineFeatureColumns(binaryRows.toarray(), denseRows.astype(float))
+    return(featureMatrix, patientStarts, rowAges)
+
+def phenotypeAges(patientRecs, phenotype):
+    """ Age of each patient's first diagnosis with the phenotype, NaN for patients
+        without it
+    """
+    firstAges = np.full(len(patientRecs), np.nan)
+    for i, patient in enumerate(patientRecs):
+        if phenotype in patient[1].CONDITION_DESCRIPTION.values:
+            firstAges[i] = min(patient[1].Age[patient[1].CONDITION_DESCRIPTION==phenotype])
+    return(firstAges)
+
+def windowStarts(patientRecs, patientStarts, rowAges, nSteps, phenotype, 
+    padShort = False):
+    """ Every nSteps window buildRNNData takes, as the featureMatrix row it starts on.
+        For patients with the phenotype, only ages before its first diagnosis are used.
+        With padShort, a patient with fewer than nSteps ages also gets one window of
+        them all, left-padded with zero steps: it starts before the patient's first
+        row, and windowRows marks those steps
+
+    Returns:
+        startRows: First featureMatrix row of each window, in buildRNNData order
+        yData: 1 for windows from patients who go on to have the phenotype, else 0
+    """
+    return(windowStartsFromAges(patientStarts, rowAges, nSteps, 
+        phenotypeAges(patientRecs, phenotype), padShort))
+
+def windowStartsFromAges(patientStarts, rowAges, nSteps, firstAges, padShort = False):
+    """ windowStarts, given each patient's first phenotype age from phenotypeAges
+    """
+    patientEnds = patientStarts[1:].copy()
+    labels = (~np.isnan(firstAges)).astype(float)
+    for i in np.flatnonzero(labels):
+        patientEnds[i] = patientStarts[i] + np.searchsorted(
+            rowAges[patientStarts[i]:patientStarts[i+1]], firstAges[i])
+
+    nRows = patientEnds - patientStarts[:-1]
+    nWindows = np.maximum(nRows - nSteps + 1, 0)
+    if padShort:
+        nWindows[(nRows > 0) & (nRows < nSteps)] = 1
+    windowPatient = np.repeat(np.arange(len(firstAges)), nWindows)
+    windowOffset = np.arange(nWindows.sum()) - np.repeat(np.cumsum(nWindows) - nWindows,
+        nWindows)
+    #Only a padded window starts later than nSteps before its patient's end
+    startRows = np.minimum(patientStarts[:-1][windowPatient] + windowOffset, 
+        patientEnds[windowPatient] - nSteps)
+
+    return(startRows, labels[windowPatient])
+
+def windowPatients(patientStarts, startRows, nSteps):
+    """ Patient (feature-table position) of each window, from its last row, which is
+        its patient's even when the window is padded
+    """
+    return(np.searchsorted(patientStarts, startRows + nSteps - 1, side = 'right') - 1)
+
+def windowRows(patientStarts, startRows, nSteps):
+    """ Feature-table row of each step of the windows starting at startRows, -1 for
+        the zero steps padding a short history
+    """
+    rows = startRows[:, None] + np.arange(nSteps)
+    firstRows = patientStarts[windowPatients(patientStarts, startRows, nSteps)]
+    return(np.where(rows < firstRows[:, None], -1, rows).astype(np.int32))
+
+def gatherWindows(featureMatrix, patientStarts, startRows, nSteps):
+    """ Dense (windows, steps, variables) copies of the windows starting at startRows,
+        out of zero-copy sliding views, or gathered row by row when some are padded
+    """
+    if not len(startRows):
+        return(np.zeros((0, nSteps, featureMatrix.shape[1]), 
+            dtype = featureMatrix.dtype))
+    rows = windowRows(patientStarts, startRows, nSteps)
+    if (rows >= 0).all():
+        #(windows, variables, steps) views, as (windows, steps, variables) copies
+        windows = sliding_window_view(featureMatrix, nSteps, axis = 0)
+        return(np.ascontiguousarray(windows[startRows].transpose(0, 2, 1)))
+    xData = featureMatrix[np.maximum(rows, 0)]
+    xData[rows < 0] = 0
+    return(xData)
+
+def buildRNNDataWindowed(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
+    smokerDict, conditionDict, procedureDict, posControl = 'no', featureTables = None,
+    padShort = False):
+    """ Same datasets as buildRNNData, but the features are computed once per
+        (patient, age) and the windows are zero-copy views over them. Only the windows
+        kept after balancing are copied out. Ages within a patient are taken in
+        sorted order
+
+    Args:
+        (see buildRNNData)
+        featureTables: Tables from buildFeatureTables (e.g. from the feature store),
+            built here if not given
+        padShort: Also take one zero-padded window of each patient with fewer than
+            nSteps ages (see windowStarts), for a model with masking
+
+    Returns:
+        xTrain, xTest, yTrain, yTest, patientsTrain, patientsTest, as buildRNNData
+    """
+    with profiling.stage('feature matrix') as record:
+        featureMatrix, patientStarts, rowAges = buildFeatureMatrix(patientRecs, 
+            zipDict, genderDict, raceDict, smokerDict, conditionDict, procedureDict, 
+            featureTables)
+        record['rows'] = len(featureMatrix)
+    with profiling.stage('window starts') as record:
+        startRows, yData = windowStarts(patientRecs, patientStarts, rowAges, nSteps, 
+            phenotype, padShort)
+        record['rows'] = len(startRows)
+
+    return(denseWindowSplits(featureMatrix, patientStarts, hashPatients([x[0] for x
+        in patientRecs]), startRows, yData, nSteps, posControl))
+
+def denseWindowSplits(featureMatrix, patientStarts, patientHashes, startRows, yData, 
+    nSteps, posControl = 'no'):
+    """ Balance the windows starting at startRows, copy the kept ones out of the
+        feature matrix, and split them into train and test sets, with the hash of
+        each window's patient (patientHashes by feature-table patient)
+    """
+    with profiling.stage('balance', len(yData)):
+        keepLocs = balanceIndices(yData, 1)
+    with profiling.stage('window build', len(keepLocs)):
+        xData = gatherWindows(featureMatrix, patientStarts, startRows[keepLocs], 
+            nSteps)
+        yData = yData[keepLocs]
+        windowHashes = patientHashes[windowPatients(patientStarts, 
+            startRows[keepLocs], nSteps)]
+
+    #Make a positive control for the model
+    if posControl == 'yes':
+        xData = makePosControl(xData, yData)
+
+    with profiling.stage('split', len(yData)):
+        (xTrain, xTest, yTrain, yTest, patientsTrain, 
+            patientsTest) = train_test_split(xData, yData, windowHashes, 
+            test_size = 0.25, random_state = 10)
+
+    return(xTrain, xTest, yTrain, yTest, patientsTrain, patientsTest)
+
+def buildRNNDataSparse(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
+    smokerDict, conditionDict, procedureDict, posControl = 'no', featureTables = None,
+    padShort = False):
+    """ Same datasets as buildRNNDataWindowed, kept compact: each window is the
+        nSteps feature-table rows it covers, with the tables shared by train and test.
+        Use densifyWindows for a dense (windows, steps, variables) batch
+
+    Args:
+        (see buildRNNDataWindowed)
+
+    Returns:
+        xTrain, xTest as (windowRows, binaryRows, denseRows), and yTrain, yTest,
+            patientsTrain, patientsTest
+    """
+    if posControl == 'yes':
+        raise ValueError('A positive control needs dense windows, use '
+            'buildRNNDataWindowed')
+
+    if featureTables is None:
+        with profiling.stage('feature tables') as record:
+            featureTables = buildFeatureTables(patientRecs, zipDict, genderDict, 
+                raceDict, smokerDict, conditionDict, procedureDict)
+            record['rows'] = featureTables[0].shape[0]
+    binaryRows, denseRows, patientStarts, rowAges = featureTables
+    with profiling.stage('window starts') as record:
+        startRows, yData = windowStarts(patientRecs, patientStarts, rowAges, nSteps, 
+            phenotype, padShort)
+        record['rows'] = len(startRows)
+
+    return(sparseWindowSplits(binaryRows, denseRows, patientStarts, hashPatients(
+        [x[0] for x in patientRecs]), startRows, yData, nSteps))
+
+def sparseWindowSplits(binaryRows, denseRows, patientStarts, patientHashes, startRows, 
+    yData, nSteps):
+    """ Balance the windows starting at startRows and split them into train and test
+        sets, as compact windows over the feature tables (row -1 for padding steps),
+        with the hash of each window's patient
+    """
+    denseRows = denseRows.astype(np.float32)
+    with profiling.stage('balance', len(yData)):
+        keepLocs = balanceIndices(yData, 1)
+    with profiling.stage('window build', len(keepLocs)):
+        rows = windowRows(patientStarts, startRows[keepLocs], nSteps)
+        yData = yData[keepLocs]
+        windowHashes = patientHashes[windowPatients(patientStarts, 
+            startRows[keepLocs], nSteps)]
+
+    with profiling.stage('split', len(yData)):
+        (rowsTrain, rowsTest, yTrain, yTest, patientsTrain, 
+            patientsTest) = train_test_split(rows, yData, windowHashes, 
+            test_size = 0.25, random_state = 10)
+
+    return((rowsTrain, binaryRows, denseRows), (rowsTest, binaryRows, denseRows), 
+        yTrain, yTest, patientsTrain, patientsTest)
+
+def shardPatients(patientRecs, nShards):
+    """ Split the records into shards of whole patients by a stable hash of the
+        patient ID, so a patient's shard depends on neither the cohort nor the number
+        of workers
+
+    Returns:
+        shards: List of (up to) nShards record subsets, disjoint by patient
+    """
+    patientCodes, patientIDs = pd.factorize(patientRecs.PATIENT)
+    shardOf = store.patientBuckets(patientIDs, nShards)[patientCodes]
+    shardOrder = np.argsort(shardOf, kind = 'mergesort')
+    bounds = np.searchsorted(shardOf[shardOrder], np.arange(nShards + 1))
+
+    shards = []
+    for i in range(nShards):
+        if bounds[i+1] > bounds[i]:
+            shard = patientRecs.iloc[shardOrder[bounds[i]:bounds[i+1]]].copy()
+            if hasattr(shard.PATIENT, 'cat'):
+                shard['PATIENT'] = shard.PATIENT.cat.remove_unused_categories()
+            shards.append(shard)
+    return(shards)
+
+def shardFeatureTables(task):
+    """ Worker entry point: sort one shard's histories and build its feature tables
+
+    Args:
+        task: (shard of patient records, list of phenotypes, dictionaries in
+            buildFeatureTables order, dtype of the continuous columns)
+
+    Returns:
+        tables: The shard's feature tables, by patient (see
+            setup_FeatureStore.splitPatientTables)
+        firstAges: (patients, phenotypes) first phenotype ages (see phenotypeAges)
+    """
+    shard, phenotypes, codeDicts, denseType = task
+    sortHistory = sortHistories(shard)
+    featureTables = buildFeatureTables(sortHistory, *codeDicts, denseType = denseType)
+    tables = store.splitPatientTables(featureTables, [x[0] for x in sortHistory])
+    firstAges = np.zeros((len(sortHistory), len(phenotypes)))
+    for i, phenotype in enumerate(phenotypes):
+        firstAges[:, i] = phenotypeAges(sortHistory, phenotype)
+    return(tables, firstAges)
+
+def shardedFeatureTables(patientRecs, phenotypes, codeDicts, workers = 4, 
+    nShards = 16, denseType = np.float32):
+    """ Feature tables over a process pool: patients are hash-partitioned into nShards
+        shards, workers sort each shard's histories and build its tables, and the
+        tables are gathered back in patient order. So they are the tables
+        buildFeatureTables gives, whatever workers and nShards are
+
+    Args:
+        patientRecs: Patient records (not sorted histories), ZIP formatted and
+            dictionaries built by buildDicts
+        phenotypes: Phenotypes to find each patient's first age of
+        codeDicts: Dictionaries in buildFeatureTables order
+        workers: Number of worker processes
+        nShards: Number of shards, several per worker so uneven shards even out
+        denseType: dtype of the continuous columns
+
+    Returns:
+        featureTables: (see buildFeatureTables)
+        patientOrder: Patient of each table position, in sortHistories order
+        firstAges: (patients, phenotypes) first phenotype ages, NaN if never
+    """
+    #Single-process builders take patients in groupby order
+    patientOrder = list(patientRecs.PATIENT.drop_duplicates().sort_values())
+    with profiling.stage('shard', len(patientRecs)):
+        tasks = [(x, phenotypes, codeDicts, denseType) for x in 
+            shardPatients(patientRecs, nShards)]
+
+    #Worker CPU and memory are counted once the pool has closed, as childCpu
+    with profiling.stage('feature tables', len(patientOrder)):
+        pooler = mp.Pool(workers)
+        results = pooler.map(shardFeatureTables, tasks)
+        pooler.close()
+        pooler.join()
+        del tasks
 
-    return(xTrain, xTest, yTrain, yTest)
+    with profiling.stage('gather') as record:
+        tables = store.takePatients(store.stackPatientTables([x[0] for x in results]),
+            patientOrder)
+        firstAges = pd.DataFrame(np.concatenate([x[1] for x in results]), index = 
+            np.concatenate([x[0]['patients'] for x in results])).reindex(
+            patientOrder).values
+        patientStarts = np.concatenate([[0], np.cumsum(tables['counts'])])
+        record['rows'] = len(tables['ages'])
+
+    return((tables['binary'], tables['dense'], patientStarts, tables['ages']), 
+        patientOrder, firstAges)
+
+def buildRNNDataSharded(patientRecs, nSteps, phenotype, zipDict, genderDict, raceDict,
+    smokerDict, conditionDict, procedureDict, posControl = 'no', workers = 4, 
+    nShards = 16, compact = False, padShort = False):
+    """ buildRNNDataWindowed, or buildRNNDataSparse if compact, over a process pool.
+        Patients are hash-partitioned into nShards shards, workers sort each shard's
+        histories and build its feature tables, and the tables are gathered back in
+        patient order before the windows are balanced and split. So the datasets are
+        the same as the single-process builders', whatever workers and nShards are
+
+    Args:
+        patientRecs: Patient records (not sorted histories), ZIP formatted and
+            dictionaries built by buildDicts
+        (see buildRNNData for the rest)
+        workers: Number of worker processes
+        nShards: Number of shards, several per worker so uneven shards even out
+        compact: Return compact windows, as buildRNNDataSparse does
+        padShort: Also take zero-padded windows of short histories (see windowStarts)
+
+    Returns:
+        (see buildRNNDataWindowed, or buildRNNDataSparse if compact)
+    """
+    if compact and posControl == 'yes':
+        raise ValueError('A positive control needs dense windows, use '
+            'buildRNNDataWindowed')
+
+    codeDicts = (zipDict, genderDict, raceDict, smokerDict, conditionDict, 
+        procedureDict)
+    featureTables, patientOrder, firstAges = shardedFeatureTables(patientRecs, 
+        [phenotype], codeDicts, workers, nShards, np.float32 if compact else float)
+    binaryRows, denseRows, patientStarts, rowAges = featureTables
+
+    with profiling.stage('window starts') as record:
+        startRows, yData = windowStartsFromAges(patientStarts, rowAges, nSteps, 
+            firstAges[:, 0], padShort)
+        record['rows'] = len(startRows)
+
+    patientHashes = hashPatients(patientOrder)
+    if compact:
+        return(sparseWindowSplits(binaryRows, denseRows, patientStarts, patientHashes,
+            startRows, yData, nSteps))
+    featureMatrix = combineFeatureColumns(binaryRows.toarray(), denseRows.astype(float))
+    return(denseWindowSplits(featureMatrix, patientStarts, patientHashes, startRows, 
+        yData, nSteps, posControl))
+
+def targetName(phenotype, nSteps):
+    """ File-safe name of a (phenotype, nSteps) target, e.g. Myocardial_Infarction_5
+    """
+    return('{0}_{1}'.format(re.sub('[^0-9A-Za-z]+', '_', phenotype).strip('_'), nSteps))
+
+def buildMultiTargetData(featureTables, patientIDs, firstAges, phenotypes, stepSizes,
+    padShort = False):
+    """ Compact windows for every (phenotype, nSteps) target over one set of feature
+        tables, so each extra target costs only its window indices and labels. Each
+        target's windows are balanced and split as buildRNNDataSparse does
+
+    Args:
+        featureTables: Tables from buildFeatureTables (or shardedFeatureTables)
+        patientIDs: Patient of each table position
+        firstAges: (patients, phenotypes) first phenotype ages, patients in table
+            order (see phenotypeAges)
+        phenotypes: Phenotypes, in firstAges column order
+        stepSizes: Window lengths
+        padShort: Also take zero-padded windows of short histories (see windowStarts)
+
+    Returns:
+        targets: Dictionary of targetName to {'phenotype', 'nSteps', 'rowsTrain',
+            'rowsTest', 'yTrain', 'yTest', 'patientsTrain', 'patientsTest'}, with
+            rows as in buildRNNDataSparse
+    """
+    binaryRows, denseRows, patientStarts, rowAges = featureTables
+    patientHashes = hashPatients(patientIDs)
+    targets = {}
+    for i, phenotype in enumerate(phenotypes):
+        for nSteps in stepSizes:
+            name = targetName(phenotype, nSteps)
+            with profiling.stage('target ' + name) as record:
+                startRows, yData = windowStartsFromAges(patientStarts, rowAges, 
+                    nSteps, firstAges[:, i], padShort)
+                (xTrain, xTest, yTrain, yTest, patientsTrain, 
+                    patientsTest) = sparseWindowSplits(binaryRows, denseRows, 
+                    patientStarts, patientHashes, startRows, yData, nSteps)
+                targets[name] = {'phenotype': phenotype, 'nSteps': nSteps, 
+                    'rowsTrain': xTrain[0], 'rowsTest': xTest[0], 'yTrain': yTrain, 
+                    'yTest': yTest, 'patientsTrain': patientsTrain, 
+                    'patientsTest': patientsTest}
+                record['rows'] = len(yTrain) + len(yTest)
+    return(targets)
+
+def seededHashes(patientIDs, seed, salt = ''):
+    """ Uniform 64-bit hash of each patient ID under a seed, the same in any process
+        and whatever order the patients come in
+    """
+    return(np.array([int.from_bytes(hashlib.blake2b('{0}:{1}:{2}'.format(seed, salt,
+        x).encode(), digest_size = 8).digest(), 'little') for x in patientIDs], 
+        dtype = np.uint64))
+
+def hashPatients(patientIDs):
+    """ Hash standing for each patient in a dataset, so windows can be grouped by
+        patient (e.g. to hold out whole patients for validation) without the IDs
+    """
+    return(seededHashes(patientIDs, 0, 'patient'))
+
+def mixHashes(hashes, values):
+    """ Combine 64-bit hashes with non-negative integer values (splitmix64), e.g. a
+        patient's hash with the age a window starts at
+    """
+    mixed = hashes + (values.astype(np.uint64) + np.uint64(1)) * np.uint64(
+        0x9E3779B97F4A7C15)
+    mixed = (mixed ^ (mixed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return(mixed ^ (mixed >> np.uint64(31)))
+
+class WindowReservoir(object):
+    """ Uniform sample of at most capacity windows of one class: the windows with the
+        smallest random keys seen so far (bottom-k sampling, a form of reservoir
+        sampling that does not depend on the order windows arrive in). The first n
+        windows by key are a uniform sample of n
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.keys = np.zeros(0, dtype = np.uint64)
+        self.patients = np.zeros(0, dtype = object)
+        self.windows = None
+        self.nOffered = 0
+
+    def offer(self, keys, patients, makeWindows):
+        """ Consider new windows, given their keys and patients. makeWindows(locs)
+            builds the windows at locs, and is only called for those that get in
+        """
+        self.nOffered += len(keys)
+        locs = np.arange(len(keys))
+        if len(self.keys) >= self.capacity:
+            locs = locs[keys < self.keys[-1]]
+        if not len(locs):
+            return
+
+        newWindows = makeWindows(locs)
+        keys = np.concatenate([self.keys, keys[locs]])
+        order = np.argsort(keys, kind = 'stable')[:self.capacity]
+        self.keys = keys[order]
+        self.patients = np.concatenate([self.patients, patients[locs]])[order]
+        self.windows = (newWindows if self.windows is None else np.concatenate(
+            [self.windows, newWindows]))[order]
+
+def buildRNNDataReservoir(patientRecs, nSteps, phenotype, zipDict, genderDict, 
+    raceDict, smokerDict, conditionDict, procedureDict, capacity = 20000, ratio = 1, 
+    testSize = 0.25, seed = 10, workers = 0, nShards = 16, padShort = False):
+    """ Balance and split windows as they are generated, one shard of patients at a
+        time, so only one shard's feature rows and the kept windows are ever in
+        memory. Each class keeps a seeded reservoir of windows, and patients go to
+        train or test by a seeded hash, so a patient's windows are never in both.
+        The sample depends on the seed alone, not on the shards or workers, but it is
+        not the sample buildRNNDataWindowed takes
+
+    Args:
+        patientRecs: Patient records (not sorted histories), ZIP formatted and
+            dictionaries built by buildDicts
+        (see buildRNNData for the rest)
+        capacity: Most windows kept of each class; at least the expected number of
+            positive windows, so that all of them are kept
+        ratio: Negative windows kept per positive window, as in balanceSamples
+        testSize: Share of patients in the test set
+        seed: Seed for which windows are kept and which patients are tested on
+        workers: Worker processes building shards' feature tables, 0 to build them
+            here
+        nShards: Number of shards
+        padShort: Also take zero-padded windows of short histories (see windowStarts)
+
+    Returns:
+        xTrain, xTest, yTrain, yTest as float32 (windows, steps, variables) arrays
+            and 0/1 labels, ordered by key, then patientsTrain, patientsTest (see
+            hashPatients)
+    """
+    codeDicts = (zipDict, genderDict, raceDict, smokerDict, conditionDict, 
+        procedureDict)
+    tasks = ((x, [phenotype], codeDicts, np.float32) for x in shardPatients(
+        patientRecs, nShards))
+    if workers > 0:
+        pooler = mp.Pool(workers)
+        results = pooler.imap(shardFeatureTables, tasks)
+    else:
+        results = map(shardFeatureTables, tasks)
+
+    reservoirs = [WindowReservoir(capacity), WindowReservoir(capacity)]
+    with profiling.stage('window build') as record:
+        for tables, firstAges in results:
+            patientStarts = np.concatenate([[0], np.cumsum(tables['counts'])])
+            startRows, yData = windowStartsFromAges(patientStarts, tables['ages'], 
+                nSteps, firstAges[:, 0], padShort)
+            if not len(startRows):
+                continue
+
+            #Keyed by the age of a window's first step that is not padding
+            windowPatient = windowPatients(patientStarts, startRows, nSteps)
+            patientIDs = np.array(tables['patients'], dtype = object)
+            keys = mixHashes(seededHashes(patientIDs, seed)[windowPatient], 
+                tables['ages'][np.maximum(startRows, patientStarts[windowPatient])])
+            featureMatrix = combineFeatureColumns(tables['binary'].toarray(), 
+                tables['dense'])
+
+            for label, reservoir in enumerate(reservoirs):
+                locs = np.flatnonzero(yData == label)
+                reservoir.offer(keys[locs], patientIDs[windowPatient[locs]], 
+                    lambda x: gatherWindows(featureMatrix, patientStarts, 
+                    startRows[locs[x]], nSteps))
+        record['rows'] = sum(x.nOffered for x in reservoirs)
+    if workers > 0:
+        pooler.close()
+        pooler.join()
+
+    #Both reservoirs are sorted by key, so their first windows are uniform samples
+    with profiling.stage('balance') as record:
+        zeros, ones = reservoirs
+        nZeros = min(len(zeros.keys), len(ones.keys)*ratio)
+        keys = np.concatenate([zeros.keys[:nZeros], ones.keys])
+        patients = np.concatenate([zeros.patients[:nZeros], ones.patients])
+        yData = np.concatenate([np.zeros(nZeros), np.ones(len(ones.keys))])
+        nVars = len(codeDicts[4]) + len(codeDicts[5]) + 12
+        xData = np.concatenate([x.windows[:n] if x.windows is not None else 
+            np.zeros((0, nSteps, nVars), dtype = np.float32) for x, n in 
+            [(zeros, nZeros), (ones, len(ones.keys))]])
+        order = np.argsort(keys, kind = 'stable')
+        xData, yData, patients = xData[order], yData[order], patients[order]
+        record['rows'] = len(yData)
+
+    with profiling.stage('split', len(yData)):
+        uniquePatients, patientLocs = np.unique(patients.astype(str), 
+            return_inverse = True)
+        isTest = (seededHashes(uniquePatients, seed, 'split') / 2.**64 < 
+            testSize)[patientLocs]
+
+    windowHashes = hashPatients(uniquePatients)[patientLocs]
+    return(xData[~isTest], xData[isTest], yData[~isTest], yData[isTest], 
+        windowHashes[~isTest], windowHashes[isTest])
+
+def densifyWindows(xData, windowLocs = None):
+    """ Dense float32 (windows, steps, variables) array for compact windows from
+        buildRNNDataSparse, or for a subset of them (e.g. one training batch). Padding
+        steps (row -1) are zeros
+    """
+    rows, binaryRows, denseRows = xData
+    if windowLocs is not None:
+        rows = rows[windowLocs]
+    flatRows = np.maximum(rows.ravel(), 0)
+    binaryPart = binaryRows[flatRows].toarray().reshape(rows.shape + (-1,))
+    densePart = denseRows[flatRows].reshape(rows.shape + (-1,))
+    xData = combineFeatureColumns(binaryPart, densePart)
+    xData[rows < 0] = 0
+    return(xData)
 
 def makePosControl(xData, yData):
 
@@ -250,3 +1001,174 @@ def write3DArray(data, fileName):
             np.savetxt(outfile, data_slice, fmt='%-7.2f')
             outfile.write('# New slice\n')
 
+
+def read3DArray(fileName):
+    """ Read a text array from write3DArray, taking its shape from the header line
+    """
+    with open(fileName) as infile:
+        shape = tuple(int(x) for x in re.findall(r'\d+', infile.readline()))
+    return(np.loadtxt(fileName).reshape(shape))
+
+def featureNames(conditionDict, procedureDict):
+    """ Names of the variables in each step, in extractVarsOneStep order
+    """
+    conditions = sorted(conditionDict, key = conditionDict.get)
+    procedures = sorted(procedureDict, key = procedureDict.get)
+    names = (['ZIP', 'GENDER', 'RACE'] + 
+        ['CONDITION: {0}'.format(x) for x in conditions] + 
+        ['PROCEDURE: {0}'.format(x) for x in procedures] + 
+        ['SMOKER', 'SMOKER_MISSING', 'DIASTOLIC', 'DIASTOLIC_MISSING', 'SYSTOLIC', 
+        'SYSTOLIC_MISSING', 'BMI', 'BMI_MISSING', 'AGE'])
+    return(names)
+
+def clearDataset(outDir):
+    """ Remove the manifest, then the arrays, of a dataset written before. Without a
+        manifest a half-rewritten dataset cannot be loaded, and arrays of an earlier
+        layout or target set do not linger
+    """
+    os.makedirs(outDir, exist_ok = True)
+    if os.path.exists(os.path.join(outDir, 'manifest.json')):
+        os.remove(os.path.join(outDir, 'manifest.json'))
+    for fileName in glob.glob(os.path.join(outDir, '*.npy')):
+        os.remove(fileName)
+
+def writeTensorDataset(outDir, xTrain, xTest, yTrain, yTest, variableNames, 
+    padded = False, patientsTrain = None, patientsTest = None):
+    """ Save train/test windows as .npy files plus a manifest.json with their shapes,
+        dtypes and variable names. Dense windows are saved as they are; compact windows
+        from buildRNNDataSparse save their shared feature tables once
+
+    Args:
+        outDir: Dataset directory, created if needed
+        xTrain, xTest: Dense (windows, steps, variables) arrays, or compact windows
+        yTrain, yTest: 0/1 labels
+        variableNames: Names of the variables in each step, from featureNames
+        padded: Whether short histories were zero-padded (padShort)
+        patientsTrain, patientsTest: Optional hash of each window's patient, for
+            validation splits by patient
+    """
+    clearDataset(outDir)
+    arrays = {'yTrain': np.asarray(yTrain, dtype = np.float32), 
+        'yTest': np.asarray(yTest, dtype = np.float32)}
+    if patientsTrain is not None:
+        arrays.update({'patientsTrain': np.asarray(patientsTrain, dtype = np.uint64),
+            'patientsTest': np.asarray(patientsTest, dtype = np.uint64)})
+
+    if isinstance(xTrain, tuple):
+        layout = 'sparse'
+        nSteps = xTrain[0].shape[1]
+        binaryRows, denseRows = xTrain[1], xTrain[2]
+        arrays.update({'rowsTrain': xTrain[0], 'rowsTest': xTest[0], 
+            'binaryData': binaryRows.data, 'binaryIndices': binaryRows.indices, 
+            'binaryIndptr': binaryRows.indptr, 'denseRows': denseRows})
+        manifest = {'binaryShape': list(binaryRows.shape)}
+    else:
+        layout = 'dense'
+        nSteps = xTrain.shape[1]
+        arrays.update({'xTrain': xTrain, 'xTest': xTest})
+        manifest = {}
+
+    manifest.update({'version': 1, 'layout': layout, 'nSteps': nSteps, 
+        'nVars': len(variableNames), 'variables': list(variableNames), 
+        'padded': padded, 'arrays': {}})
+    for name, array in arrays.items():
+        np.save(os.path.join(outDir, name + '.npy'), array)
+        manifest['arrays'][name] = {'file': name + '.npy', 'shape': list(array.shape),
+            'dtype': str(array.dtype)}
+
+    #Manifest last, after clearDataset, so a dataset with a manifest is complete
+    with open(os.path.join(outDir, 'manifest.json'), 'w') as fout:
+        json.dump(manifest, fout, indent = 2)
+
+def writeMultiTargetDataset(outDir, binaryRows, denseRows, targets, variableNames, 
+    padded = False):
+    """ Save the shared feature tables once, and each target's window rows and
+        labels, with a manifest.json listing the targets
+
+    Args:
+        outDir: Dataset directory, created if needed
+        binaryRows, denseRows: Shared feature tables
+        targets: Targets from buildMultiTargetData
+        variableNames: Names of the variables in each step, from featureNames
+        padded: Whether short histories were zero-padded (padShort)
+    """
+    clearDataset(outDir)
+    binaryRows = binaryRows.tocsr()
+    manifest = {'version': 1, 'layout': 'sparse', 'binaryShape': list(binaryRows.shape),
+        'nVars': len(variableNames), 'variables': list(variableNames), 
+        'padded': padded, 'arrays': {}, 'targets': {}}
+
+    def saveArray(fileName, array):
+        np.save(os.path.join(outDir, fileName + '.npy'), array)
+        return({'file': fileName + '.npy', 'shape': list(array.shape),
+            'dtype': str(array.dtype)})
+
+    for name, array in [('binaryData', binaryRows.data), ('binaryIndices', 
+        binaryRows.indices), ('binaryIndptr', binaryRows.indptr), 
+        ('denseRows', np.asarray(denseRows, dtype = np.float32))]:
+        manifest['arrays'][name] = saveArray(name, array)
+
+    #A target's arrays keep their plain names in the manifest, so loading one target
+    #gives the arrays of a single-target dataset
+    for name, target in targets.items():
+        targetArrays = {}
+        for arrayName in ['rowsTrain', 'rowsTest', 'yTrain', 'yTest', 
+            'patientsTrain', 'patientsTest']:
+            array = target[arrayName]
+            if arrayName.startswith('y'):
+                array = np.asarray(array, dtype = np.float32)
+            targetArrays[arrayName] = saveArray('{0}-{1}'.format(arrayName, name), 
+                array)
+        manifest['targets'][name] = {'phenotype': target['phenotype'], 
+            'nSteps': target['nSteps'], 'arrays': targetArrays}
+
+    #Manifest last, after clearDataset, so a dataset with a manifest is complete
+    with open(os.path.join(outDir, 'manifest.json'), 'w') as fout:
+        json.dump(manifest, fout, indent = 2)
+
+def loadTensorDataset(outDir, mmap = True, target = None):
+    """ Load a dataset saved by writeTensorDataset (or one target of a dataset saved
+        by writeMultiTargetDataset). Arrays are memory-mapped, so nothing is read from
+        disk until it is used
+
+    Returns:
+        xTrain, xTest: Dense arrays, or compact windows (see buildRNNDataSparse)
+        yTrain, yTest: 0/1 labels
+        manifest: Shapes, dtypes and variable names, plus the phenotype and nSteps of
+            a chosen target
+    """
+    with open(os.path.join(outDir, 'manifest.json')) as fin:
+        manifest = json.load(fin)
+
+    #A multi-target dataset is loaded as a single-target one, for the chosen target
+    if 'targets' in manifest:
+        if target is None and len(manifest['targets']) == 1:
+            target = list(manifest['targets'])[0]
+        if target not in manifest['targets']:
+            raise ValueError('Choose a target of {0}: {1}'.format(outDir, 
+                ', '.join(manifest['targets'])))
+        targetInfo = manifest.pop('targets')[target]
+        manifest['arrays'].update(targetInfo.pop('arrays'))
+        manifest.update(targetInfo, target = target)
+
+    arrays = dict((name, np.load(os.path.join(outDir, spec['file']), 
+        mmap_mode = 'r' if mmap else None)) for name, spec in manifest['arrays'].items())
+
+    if manifest['layout'] == 'sparse':
+        binaryRows = sparse.csr_matrix((arrays['binaryData'], arrays['binaryIndices'],
+            arrays['binaryIndptr']), shape = tuple(manifest['binaryShape']))
+        xTrain = (arrays['rowsTrain'], binaryRows, arrays['denseRows'])
+        xTest = (arrays['rowsTest'], binaryRows, arrays['denseRows'])
+    else:
+        xTrain, xTest = arrays['xTrain'], arrays['xTest']
+
+    return(xTrain, xTest, arrays['yTrain'], arrays['yTest'], manifest)
+
+def loadWindowPatients(outDir, manifest):
+    """ Patient hash of each training and test window, given the manifest from
+        loadTensorDataset, or (None, None) for a dataset saved without them
+    """
+    if 'patientsTrain' not in manifest['arrays']:
+        return(None, None)
+    return(tuple(np.load(os.path.join(outDir, manifest['arrays'][x]['file']), 
+        mmap_mode = 'r') for x in ['patientsTrain', 'patientsTest']))
@@ -0,0 +1,273 @@
+
+import sys, os, glob, json, zlib, pickle
+import pandas as pd
+import numpy as np
+from scipy import sparse
+import setup_Vocabulary as vocab
+
+def patientHashes(patientRecs):
+    """ Content hash of each patient's records, independent of row order and of
+        whether columns are categorical
+
+    Args:
+        patientRecs: Patient records (source, aggregated, or events)
+
+    Returns:
+        hashes: Series of hash strings, indexed by patient ID
+    """
+    rowHashes = pd.util.hash_pandas_object(patientRecs, index = False).values
+    patientCodes, patientIDs = pd.factorize(patientRecs.PATIENT.astype(object))
+
+    hashSums = np.zeros(len(patientIDs), dtype = np.uint64)
+    hashXors = np.zeros(len(patientIDs), dtype = np.uint64)
+    np.add.at(hashSums, patientCodes, rowHashes)
+    np.bitwise_xor.at(hashXors, patientCodes, rowHashes)
+    rowCounts = np.bincount(patientCodes, minlength = len(patientIDs))
+
+    hashes = pd.Series(['{0:016x}{1:016x}-{2}'.format(*x) for x in
+        zip(hashSums, hashXors, rowCounts)], index = patientIDs)
+    return(hashes)
+
+def patientBuckets(patientIDs, nBuckets):
+    """ Bucket of each patient, stable across runs and cohorts
+    """
+    return(np.array([zlib.crc32(str(x).encode()) % nBuckets for x in patientIDs]))
+
+def loadIndex(layerDir):
+    """ PATIENT, HASH, BUCKET of everything stored in one layer of the store
+    """
+    indexFile = os.path.join(layerDir, 'index.pkl')
+    if os.path.exists(indexFile):
+        return(pd.read_pickle(indexFile))
+    return(pd.DataFrame({'PATIENT': [], 'HASH': [], 'BUCKET': []}))
+
+def stalePatients(layerDir, hashes):
+    """ Patients that are new, or whose records changed, since the layer was written
+    """
+    stored = loadIndex(layerDir).set_index('PATIENT').HASH
+    stale = hashes.index[hashes.values != stored.reindex(hashes.index).values]
+    return(set(stale))
+
+def bucketFile(layerDir, bucket):
+    return(os.path.join(layerDir, 'bucket-{0:05d}.pkl'.format(bucket)))
+
+def writePickle(obj, fileName):
+    """ Write atomically, so an interrupted run never leaves a partial bucket
+    """
+    with open(fileName + '.tmp', 'wb') as fout:
+        pickle.dump(obj, fout, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(fileName + '.tmp', fileName)
+
+def updateLayer(layerDir, hashes, staleIDs, nBuckets, mergeBucket):
+    """ Rewrite only the buckets holding stale or removed patients, then the index
+
+    Args:
+        layerDir: Directory of one layer of the store
+        hashes: Current hash of every patient, from patientHashes
+        staleIDs: Patients with freshly computed values
+        nBuckets: Number of buckets patients are spread over
+        mergeBucket: Function of (bucket contents or None, patients to keep, bucket
+            number), returning the new contents, or None if the bucket is now empty
+
+    Returns:
+        changedBuckets: Sorted bucket numbers that were rewritten
+    """
+    os.makedirs(layerDir, exist_ok = True)
+    stored = loadIndex(layerDir)
+    removed = stored[~stored.PATIENT.isin(hashes.index)]
+
+    buckets = pd.Series(patientBuckets(hashes.index, nBuckets), index = hashes.index)
+    changedBuckets = sorted(set(buckets[list(staleIDs)]) | set(removed.BUCKET.astype(int)))
+
+    for bucket in changedBuckets:
+        fileName = bucketFile(layerDir, bucket)
+        contents = pd.read_pickle(fileName) if os.path.exists(fileName) else None
+        keepIDs = set(buckets.index[buckets.values==bucket]) - staleIDs
+        contents = mergeBucket(contents, keepIDs, bucket)
+        if contents is None:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+        else:
+            writePickle(contents, fileName)
+
+    writePickle(pd.DataFrame({'PATIENT': hashes.index, 'HASH': hashes.values,
+        'BUCKET': buckets.values}), os.path.join(layerDir, 'index.pkl'))
+    return(changedBuckets)
+
+def updateRecordStore(storeDir, layer, aggregatedRecs, hashes, nBuckets = 64):
+    """ Store freshly aggregated records for new or changed patients
+
+    Args:
+        storeDir: Feature store directory
+        layer: Name of the records layer, e.g. one per record layout
+        aggregatedRecs: Aggregated records of the stale patients only
+        hashes: Source-record hash of every current patient
+        nBuckets: Number of buckets patients are spread over
+
+    Returns:
+        changedBuckets: Sorted bucket numbers that were rewritten
+    """
+    layerDir = os.path.join(storeDir, layer)
+    staleIDs = set(aggregatedRecs.PATIENT.astype(object))
+    freshBuckets = patientBuckets(aggregatedRecs.PATIENT.astype(object), nBuckets)
+
+    def mergeBucket(contents, keepIDs, bucket):
+        parts = [aggregatedRecs[freshBuckets==bucket]]
+        if contents is not None:
+            parts.insert(0, contents[contents.PATIENT.isin(keepIDs)])
+        merged = pd.concat(parts, ignore_index = True)
+        for column in merged.columns:
+            if hasattr(parts[-1][column], 'cat'):
+                merged[column] = merged[column].astype('category')
+        return(merged if len(merged) else None)
+
+    return(updateLayer(layerDir, hashes, staleIDs, nBuckets, mergeBucket))
+
+def readRecordBuckets(storeDir, layer, buckets = None):
+    """ Stored aggregated records, as a generator of (bucket, records or None if the
+        bucket is now empty)
+    """
+    layerDir = os.path.join(storeDir, layer)
+    if buckets is None:
+        buckets = sorted(set(loadIndex(layerDir).BUCKET.astype(int)))
+    for bucket in buckets:
+        fileName = bucketFile(layerDir, bucket)
+        yield(bucket, pd.read_pickle(fileName) if os.path.exists(fileName) else None)
+
+def remapFeatureLayer(layerDir, oldCodes, newCodes):
+    """ Move stored feature rows to the columns of an extended vocabulary, without
+        rebuilding them
+
+    Args:
+        layerDir: Directory of the features layer
+        oldCodes, newCodes: Codes of the zip, gender, race, smoker, condition and
+            procedure dictionaries, before and after
+
+    Returns:
+        oovIDs: Patients with rows in an out-of-vocabulary column, whose codes may
+            now have columns of their own
+    """
+    oldSizes = [len(oldCodes[4]), len(oldCodes[5])]
+    newSizes = [len(newCodes[4]), len(newCodes[5])]
+
+    oovIDs = set()
+    for fileName in sorted(glob.glob(os.path.join(layerDir, 'bucket-*.pkl'))):
+        tables = pd.read_pickle(fileName)
+        tables['binary'] = vocab.remapBinaryColumns(tables['binary'], oldSizes, newSizes)
+        writePickle(tables, fileName)
+
+        dense = tables['dense']
+        oovRows = ((tables['binary'][:, [0, newSizes[0]]].getnnz(axis = 1) > 0) | 
+            (dense[:, :3] == 0).any(axis = 1) | ((dense[:, 3] == 0) & (dense[:, 4] == 0)))
+        rowPatients = np.repeat(np.array(tables['patients'], dtype = object), 
+            tables['counts'])
+        oovIDs.update(rowPatients[oovRows])
+    return(oovIDs)
+
+def cachedFeatureTables(storeDir, patientRecs, zipDict, genderDict, raceDict,
+    smokerDict, conditionDict, procedureDict, buildTables, nBuckets = 64):
+    """ buildFeatureTables for the sorted histories, computing rows only for patients
+        whose aggregated records changed since the last run. When the vocabulary was
+        only extended, stored rows are moved to the new columns; any other change to
+        the dictionaries drops every stored row
+
+    Args:
+        storeDir: Feature store directory
+        patientRecs: Sorted patient histories, from buildDictsSortHistories
+        (see extractVarsOneStep for the dictionaries)
+        buildTables: setup_BuildLSTMData.buildFeatureTables
+        nBuckets: Number of buckets patients are spread over
+
+    Returns:
+        (see buildFeatureTables, with float64 denseRows)
+    """
+    layerDir = os.path.join(storeDir, 'features')
+    metaFile = os.path.join(layerDir, 'meta.json')
+    codes = [vocab.dictCodes(x) for x in (zipDict, genderDict, raceDict, smokerDict,
+        conditionDict, procedureDict)]
+
+    meta = {}
+    if os.path.exists(metaFile):
+        with open(metaFile) as fin:
+            meta = json.load(fin)
+
+    oovIDs = set()
+    if meta.get('codes') != codes:
+        if meta.get('codes') is not None and vocab.extendsVocabulary(meta['codes'], 
+            codes):
+            oovIDs = remapFeatureLayer(layerDir, meta['codes'], codes)
+        else:
+            for fileName in glob.glob(os.path.join(layerDir, '*.pkl')):
+                os.remove(fileName)
+        os.makedirs(layerDir, exist_ok = True)
+        with open(metaFile, 'w') as fout:
+            json.dump({'codes': codes}, fout)
+
+    patientIDs = [x[0] for x in patientRecs]
+    frames = [x[1] for x in patientRecs]
+    hashes = patientHashes(pd.concat(frames, ignore_index = True)).reindex(patientIDs)
+    staleIDs = stalePatients(layerDir, hashes) | (oovIDs & set(hashes.index))
+    print('Feature rows built for {0} of {1} patients'.format(len(staleIDs), 
+        len(hashes)))
+
+    staleRecs = [x for x in patientRecs if x[0] in staleIDs]
+    if len(staleRecs):
+        fresh = splitPatientTables(buildTables(staleRecs, zipDict, genderDict, 
+            raceDict, smokerDict, conditionDict, procedureDict, float), 
+            [x[0] for x in staleRecs])
+    else:
+        fresh = stackPatientTables([])
+    freshBuckets = patientBuckets(fresh['patients'], nBuckets)
+
+    def mergeBucket(contents, keepIDs, bucket):
+        parts = [takePatients(fresh, np.array(fresh['patients'])[freshBuckets==bucket])]
+        if contents is not None:
+            parts.insert(0, takePatients(contents, [x for x in contents['patients']
+                if x in keepIDs]))
+        merged = stackPatientTables(parts)
+        return(merged if len(merged['patients']) else None)
+
+    updateLayer(layerDir, hashes, staleIDs, nBuckets, mergeBucket)
+
+    #Every patient's rows, back in the order of the histories
+    stored = stackPatientTables([x for x in (pd.read_pickle(y) for y in
+        sorted(glob.glob(os.path.join(layerDir, 'bucket-*.pkl'))))])
+    ordered = takePatients(stored, patientIDs)
+    patientStarts = np.concatenate([[0], np.cumsum(ordered['counts'])])
+
+    return(ordered['binary'], ordered['dense'], patientStarts, ordered['ages'])
+
+def splitPatientTables(featureTables, patientIDs):
+    """ Feature tables from buildFeatureTables, labelled with their patients' row counts
+    """
+    binaryRows, denseRows, patientStarts, rowAges = featureTables
+    return({'patients': list(patientIDs), 'counts': np.diff(patientStarts),
+        'binary': binaryRows.tocsr(), 'dense': denseRows, 'ages': rowAges})
+
+def takePatients(tables, patientIDs):
+    """ The rows of the given patients, in the order given
+    """
+    starts = pd.Series(np.cumsum(tables['counts']) - tables['counts'],
+        index = tables['patients'])
+    counts = pd.Series(tables['counts'], index = tables['patients'])
+    takeStarts = starts.reindex(patientIDs).values.astype(int)
+    takeCounts = counts.reindex(patientIDs).values.astype(int)
+    rows = np.repeat(takeStarts - (np.cumsum(takeCounts) - takeCounts), takeCounts) + \
+        np.arange(takeCounts.sum())
+    return({'patients': list(patientIDs), 'counts': takeCounts,
+        'binary': tables['binary'][rows], 'dense': tables['dense'][rows],
+        'ages': tables['ages'][rows]})
+
+def stackPatientTables(tablesList):
+    """ Stack per-patient feature tables, keeping each patient's rows together
+    """
+    tablesList = [x for x in tablesList if len(x['patients'])]
+    if not len(tablesList):
+        return({'patients': [], 'counts': np.zeros(0, dtype = int),
+            'binary': sparse.csr_matrix((0, 0), dtype = np.uint8),
+            'dense': np.zeros((0, 12)), 'ages': np.zeros(0)})
+    return({'patients': list(np.concatenate([x['patients'] for x in tablesList])),
+        'counts': np.concatenate([x['counts'] for x in tablesList]),
+        'binary': sparse.vstack([x['binary'] for x in tablesList], format = 'csr'),
+        'dense': np.concatenate([x['dense'] for x in tablesList]),
+        'ages': np.concatenate([x['ages'] for x in tablesList])})
@@ -0,0 +1,209 @@
+
+import sys, os, json, time
+import numpy as np
+import tensorflow as tf
+import setup_BuildLSTMData as data
+
+class WindowBatches(tf.keras.utils.Sequence):
+    """ Feed windows to keras one batch at a time: slices of a (memory-mapped) dense
+        array, or compact windows from BuildLSTMData.py (--builder sparse) densified
+        per batch. locs limits the batches to some of the windows (e.g. a validation
+        split)
+    """
+    def __init__(self, xdata, ydata, batchsize, shuffle = False, locs = None):
+        self.xdata, self.ydata, self.batchsize = xdata, ydata, batchsize
+        self.shuffle = shuffle
+        if locs is None:
+            locs = np.arange(len(xdata[0]) if isinstance(xdata, tuple) else len(xdata))
+        self.order = np.array(locs)
+
+    def __len__(self):
+        return int(np.ceil(len(self.order) / self.batchsize))
+
+    def __getitem__(self, i):
+        locs = np.sort(self.order[i*self.batchsize:(i+1)*self.batchsize])
+        if isinstance(self.xdata, tuple):
+            xbatch = data.densifyWindows(self.xdata, locs)
+        else:
+            xbatch = np.asarray(self.xdata[locs], dtype = np.float32)
+        if self.ydata is None:
+            return xbatch
+        return xbatch, np.asarray(self.ydata[locs])
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+def windowShape(xdata):
+    """ (steps, variables) of dense windows, or of compact windows (windowRows,
+        binaryRows, denseRows)
+    """
+    if isinstance(xdata, tuple):
+        return(xdata[0].shape[1], xdata[1].shape[1] + xdata[2].shape[1])
+    return(xdata.shape[1], xdata.shape[2])
+
+def configureRuntime(intraOp = None, interOp = None, bfloat16 = False):
+    """ Thread pools and precision, set before any model is built
+
+    Args:
+        intraOp: Threads within one op (e.g. a matmul), all cores if None
+        interOp: Ops run at once, TensorFlow's choice if None
+        bfloat16: Compute in bfloat16 with float32 weights (mixed_bfloat16), which
+            pays off on CPUs with bfloat16 support (AVX512-BF16, AMX)
+    """
+    if intraOp is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intraOp)
+    if interOp is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(interOp)
+    if bfloat16:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+def buildModel(nsteps, nvars, lstmUnits = (256, 64), denseUnits = (64, 32),
+    dropout = 0.25, masking = False, learningRate = 1e-4):
+    """ Stacked LSTM then dense layers for sequence classification
+
+    Args:
+        nsteps, nvars: Shape of each window
+        lstmUnits: Units of each LSTM layer
+        denseUnits: Units of each dense layer after them
+        dropout: Dropout after each dense layer
+        masking: Skip all-zero steps, so windows of shorter histories can be
+            left-padded with zeros
+        learningRate: Adam learning rate
+
+    Returns:
+        model: Compiled keras model, with accuracy and AUC metrics
+    """
+    model = tf.keras.models.Sequential()
+    model.add(tf.keras.Input(shape = (nsteps, nvars)))
+    if masking:
+        model.add(tf.keras.layers.Masking(mask_value = 0.))
+    for i, units in enumerate(lstmUnits):
+        model.add(tf.keras.layers.LSTM(units,
+            return_sequences = i < len(lstmUnits) - 1))
+    for units in denseUnits:
+        model.add(tf.keras.layers.Dense(units, activation = tf.nn.relu))
+        model.add(tf.keras.layers.BatchNormalization())
+        model.add(tf.keras.layers.Dropout(dropout))
+    #Output in float32 under mixed precision, so the loss is computed in float32
+    model.add(tf.keras.layers.Dense(1, activation = 'sigmoid', dtype = 'float32'))
+
+    model.compile(optimizer = tf.keras.optimizers.Adam(learningRate),
+        loss = 'binary_crossentropy', metrics = ['accuracy',
+        tf.keras.metrics.AUC(name = 'auc')])
+    return(model)
+
+def validationSplit(ydata, fraction, seed = 10, patients = None):
+    """ Seeded split of the training windows into fit and validation positions. Given
+        each window's patient hash (from the dataset), whole patients are held out,
+        about fraction of them, so no patient has windows on both sides. Otherwise
+        windows are split at random
+
+    Returns:
+        fitLocs, validationLocs: Sorted positions of the training windows
+    """
+    if patients is not None:
+        patients = np.asarray(patients, dtype = np.uint64)
+        isValidation = data.mixHashes(patients, np.full(len(patients), seed)) / (
+            2.**64) < fraction
+        return(np.flatnonzero(~isValidation), np.flatnonzero(isValidation))
+    order = np.random.RandomState(seed).permutation(len(ydata))
+    nValidation = int(round(len(ydata)*fraction))
+    return(np.sort(order[nValidation:]), np.sort(order[:nValidation]))
+
+class TimeToTarget(tf.keras.callbacks.Callback):
+    """ Seconds and epochs of training until the monitored metric first reaches a
+        target (e.g. validation AUC), optionally stopping there. With a stateFile,
+        the history is saved after each epoch and picked up again when a fit resumes
+        from a BackupAndRestore backup (resumeDir), so seconds count on from where
+        the interrupted fit stopped
+
+    Attributes:
+        history: (epoch, seconds, value) after each epoch
+        reached: (epoch, seconds) the target was first reached, or None
+    """
+    def __init__(self, target = None, monitor = 'val_auc', stopAtTarget = False,
+        stateFile = None, resumeDir = None):
+        super(TimeToTarget, self).__init__()
+        self.target, self.monitor, self.stopAtTarget = target, monitor, stopAtTarget
+        self.stateFile, self.resumeDir = stateFile, resumeDir
+        self.history, self.reached = [], None
+
+    def on_train_begin(self, logs = None):
+        elapsed = 0
+        #Only a fit that will resume from its backup carries on the saved state
+        if self.stateFile is not None and os.path.exists(self.stateFile) and (
+            self.resumeDir is None or os.path.exists(self.resumeDir)):
+            with open(self.stateFile) as fin:
+                state = json.load(fin)
+            self.history = [tuple(x) for x in state['history']]
+            self.reached = tuple(state['reached']) if state['reached'] else None
+            elapsed = self.history[-1][1] if len(self.history) else 0
+        self.start = time.perf_counter() - elapsed
+
+    def on_epoch_end(self, epoch, logs = None):
+        value = (logs or {}).get(self.monitor)
+        if value is None:
+            return
+        elapsed = time.perf_counter() - self.start
+        #An epoch redone after resuming replaces its first record
+        self.history = [x for x in self.history if x[0] <= epoch]
+        if self.reached is not None and self.reached[0] > epoch:
+            self.reached = None
+        self.history.append((epoch + 1, elapsed, float(value)))
+        if self.target is not None and self.reached is None and value >= self.target:
+            self.reached = (epoch + 1, elapsed)
+            if self.stopAtTarget:
+                self.model.stop_training = True
+        if self.stateFile is not None:
+            with open(self.stateFile + '.tmp', 'w') as fout:
+                json.dump({'history': self.history, 'reached': self.reached}, fout)
+            os.replace(self.stateFile + '.tmp', self.stateFile)
+
+    def on_train_end(self, logs = None):
+        #The backup is removed once a fit completes, and so is this
+        if self.stateFile is not None and os.path.exists(self.stateFile):
+            os.remove(self.stateFile)
+
+def fitCallbacks(validation, patience, checkpointDir = None, targetAuc = None,
+    stopAtTarget = False):
+    """ Early stopping on validation AUC, checkpoints of the best model plus a backup
+        to resume an interrupted fit from, and time-to-target timing
+
+    Returns:
+        callbacks: List of keras callbacks
+        timer: The TimeToTarget callback
+    """
+    monitor = 'val_auc' if validation else 'auc'
+    if checkpointDir is not None:
+        os.makedirs(checkpointDir, exist_ok = True)
+        timer = TimeToTarget(targetAuc, monitor, stopAtTarget, os.path.join(
+            checkpointDir, 'timing.json'), os.path.join(checkpointDir, 'backup'))
+    else:
+        timer = TimeToTarget(targetAuc, monitor, stopAtTarget)
+    callbacks = [timer]
+    if validation and patience:
+        callbacks.append(tf.keras.callbacks.EarlyStopping(monitor = monitor,
+            mode = 'max', patience = patience, restore_best_weights = True))
+    if checkpointDir is not None:
+        callbacks.append(tf.keras.callbacks.ModelCheckpoint(os.path.join(
+            checkpointDir, 'best.keras'), monitor = monitor, mode = 'max',
+            save_best_only = True))
+        #Removed once a fit completes; a rerun after an interruption resumes from it
+        callbacks.append(tf.keras.callbacks.BackupAndRestore(os.path.join(
+            checkpointDir, 'backup')))
+    return(callbacks, timer)
+
+def reportTraining(timer, targetAuc):
+    if not len(timer.history):
+        return
+    epoch, elapsed, value = max(timer.history, key = lambda x: x[2])
+    print('Best {0} {1:.3f} at epoch {2} ({3:.1f}s), {4} epochs in {5:.1f}s'.format(
+        timer.monitor, value, epoch, elapsed, len(timer.history),
+        timer.history[-1][1]))
+    if targetAuc is not None:
+        if timer.reached is None:
+            print('{0} never reached {1}'.format(timer.monitor, targetAuc))
+        else:
+            print('{0} reached {1} after {2} epochs, {3:.1f}s'.format(timer.monitor,
+                targetAuc, *timer.reached))
@@ -1,7 +1,9 @@
 
-import sys, re
+import sys, re, os, glob, json
 import pandas as pd
 import numpy as np
+import setup_FeatureStore as store
+import setup_Profiling as profiling
 
 def combineDatasets(patientFile, procFile, obsFile, conditionFile):
     """ Combine the datasets for each individual and caculate their medical costs
@@ -66,6 +68,219 @@ def combineDatasets(patientFile, procFile, obsFile, conditionFile):
    
     return(patientRecs, aliveIDs)
 
+def readCsvChunks(fileName, columns, dtypes, chunkSize, keepRows = None):
+    """ Read a csv in bounded chunks, projecting columns and compacting dtypes as
+        each chunk is parsed
+
+    Args:
+        fileName: Csv file to read
+        columns: Columns to keep (everything else is never parsed)
+        dtypes: Dictionary of column dtypes, e.g. categoricals for descriptions
+        chunkSize: Number of rows parsed at a time
+        keepRows: Optional function of a chunk, returning a boolean mask of rows to keep
+
+    Returns:
+        Generator of filtered chunks
+    """
+    for chunk in pd.read_csv(fileName, usecols = columns, dtype = dtypes, 
+        chunksize = chunkSize):
+        if keepRows is not None:
+            chunk = chunk[keepRows(chunk)]
+        yield chunk
+
+def calcAge(dates, birthDates):
+    """ Age in whole years at each date, with birth dates already parsed
+    """
+    return((pd.to_datetime(dates) - birthDates).astype('<m8[Y]'))
+
+def mergeChunksWithPatients(chunks, patients, dateColumn):
+    """ Merge each chunk onto the patient table as it is read, calculating the age
+        at each record and dropping chunk rows that cannot survive the final filters
+
+    Args:
+        chunks: Generator of chunks from readCsvChunks
+        patients: Patient table, with BIRTHDATE parsed and PATIENT as a categorical
+        dateColumn: Column of the chunk holding the record date
+
+    Returns:
+        patientRecs: Records for all chunks, in the order an in-memory merge gives
+    """
+    merged = []
+    for chunk in chunks:
+        chunk = chunk.rename(columns = {dateColumn: 'DATE'})
+        chunk = chunk[chunk.PATIENT.notnull()]
+        chunk['Age'] = calcAge(chunk.DATE, patients.BIRTHDATE.values[
+            chunk.PATIENT.cat.codes.values])
+        merged.append(chunk[chunk.Age.notnull()])
+
+    patientRecs = pd.concat(merged, ignore_index = True)
+    #Patient order then file order, as from patients.merge(records, how = 'inner')
+    patientRecs = patientRecs.iloc[np.argsort(patientRecs.PATIENT.cat.codes.values, 
+        kind = 'mergesort')]
+    return(patientRecs)
+
+def combineDatasetsStreaming(patientFile, procFile, obsFile, conditionFile, 
+    chunkSize = 500000, patientRange = None):
+    """ Same records as combineDatasets, but each history file is read in bounded
+        chunks, with only the needed columns in compact dtypes. Observations are
+        trimmed to BP, BMI and smoking during the read, so the observations file is
+        never held whole. The kept rows of every file, and their merge, are still
+        held in memory, so peak memory grows with the cohort; combineDatasetsByRange
+        bounds it by merging one range of patients at a time
+
+    Args:
+        patientFile: Base patient ID information
+        procFile: Procedures history
+        obsFile: History of observations (BMI, BP, etc..)
+        conditionFile: History of conditions and phenotypes
+        chunkSize: Number of rows parsed at a time
+        patientRange: Optional (i, n), to keep only the patients in bucket i of n
+            (store.patientBuckets)
+
+    Returns:
+        patientCostRecord: A patient's history of medical costs
+        patientIDs: IDs of patients who are still alive
+    """
+    obsKeep = ['Tobacco smoking status NHIS', 'Body Mass Index', 
+        'Diastolic Blood Pressure', 'Systolic Blood Pressure']
+
+    #Only patients with a DEATHDATE survive the final filter of combineDatasets
+    patients = pd.read_csv(patientFile, usecols = ['ID', 'BIRTHDATE', 'DEATHDATE', 
+        'RACE', 'GENDER', 'ZIP'])
+    patients = patients[patients.DEATHDATE.notnull()].reset_index(drop = True)
+    #Rows of patients outside the range are dropped as each chunk is read
+    if patientRange is not None:
+        patients = patients[store.patientBuckets(patients.ID, patientRange[1]) == 
+            patientRange[0]].reset_index(drop = True)
+    patients['BIRTHDATE'] = pd.to_datetime(patients.BIRTHDATE)
+    patientType = pd.CategoricalDtype(patients.ID)
+
+    with profiling.stage('read procedures') as record:
+        procedures = mergeChunksWithPatients(readCsvChunks(procFile, 
+            ['DATE', 'PATIENT', 'CODE'], {'DATE': str, 'PATIENT': patientType}, 
+            chunkSize), patients, 'DATE')
+        procedures = procedures.rename(columns = {'CODE': 'PROCEDURE_CODE'})
+        record['rows'] = len(procedures)
+
+    with profiling.stage('read observations') as record:
+        observations = mergeChunksWithPatients(readCsvChunks(obsFile, 
+            ['DATE', 'PATIENT', 'DESCRIPTION', 'VALUE'], {'DATE': str, 
+            'PATIENT': patientType, 'DESCRIPTION': pd.CategoricalDtype(obsKeep), 
+            'VALUE': str}, chunkSize, lambda x: x.DESCRIPTION.notnull()), patients, 
+            'DATE')
+        observations = observations.rename(columns = {'DESCRIPTION': 
+            'OBSERVATION_DESCRIPTION', 'VALUE': 'OBSERVATION_VALUE'})
+        record['rows'] = len(observations)
+
+    with profiling.stage('read conditions') as record:
+        conditions = mergeChunksWithPatients((x.assign(START = x.START.str.replace(
+            'T.*', '', regex = True)) for x in readCsvChunks(conditionFile, 
+            ['START', 'PATIENT', 'CODE', 'DESCRIPTION'], {'START': str, 
+            'PATIENT': patientType}, chunkSize)), patients, 'START')
+        conditions = conditions.rename(columns = {'CODE': 'CONDITION_CODE', 
+            'DESCRIPTION': 'CONDITION_DESCRIPTION'})
+        conditions['CONDITION_DESCRIPTION'] = conditions.CONDITION_DESCRIPTION.astype(
+            'category')
+        record['rows'] = len(conditions)
+
+    #Patient columns follow from PATIENT, so these are the same join keys as on = None
+    with profiling.stage('merge') as record:
+        joinKeys = ['DATE', 'PATIENT', 'Age']
+        patientRecs = procedures.merge(observations, how = 'left', on = joinKeys)
+        patientRecs = patientRecs.merge(conditions, how = 'left', on = joinKeys)
+        patientRecs = patientRecs.merge(patients[['ID', 'GENDER', 'RACE', 'ZIP']], 
+            how = 'left', left_on = patientRecs.PATIENT.cat.codes.values, 
+            right_index = True)
+        aliveIDs = set(patientRecs.ID)
+        record['rows'] = len(patientRecs)
+
+    patientRecs = patientRecs[['PATIENT', 'GENDER', 'RACE', 'ZIP', 'Age', 
+        'PROCEDURE_CODE', 'OBSERVATION_DESCRIPTION', 'OBSERVATION_VALUE', 
+        'CONDITION_CODE', 'CONDITION_DESCRIPTION']]
+
+    return(patientRecs, aliveIDs)
+
+def combineDatasetsByRange(patientFile, procFile, obsFile, conditionFile, nRanges,
+    chunkSize = 500000):
+    """ combineDatasetsStreaming one range of patients at a time, so peak memory
+        follows the largest range rather than the cohort. Each history file is read
+        once per range
+
+    Args:
+        nRanges: Number of patient ranges (store.patientBuckets)
+        (see combineDatasetsStreaming for the rest)
+
+    Returns:
+        Generator of (patientRecs, patientIDs) of each range, disjoint by patient
+    """
+    for i in range(nRanges):
+        yield combineDatasetsStreaming(patientFile, procFile, obsFile, conditionFile, 
+            chunkSize, (i, nRanges))
+
+def buildEventTable(patientFile, procFile, obsFile, conditionFile, chunkSize = 500000):
+    """ Stack procedures, observations and conditions into one long event table, one
+        row per record, rather than left-merging them on shared dates. A patient-date
+        with P procedures, O observations and C conditions gives P + O + C rows, not
+        P x O x C. Unlike combineDatasets, observations and conditions are kept on
+        dates without a procedure
+
+    Args:
+        patientFile: Base patient ID information
+        procFile: Procedures history
+        obsFile: History of observations (BMI, BP, etc..)
+        conditionFile: History of conditions and phenotypes
+        chunkSize: Number of rows parsed at a time
+
+    Returns:
+        patientEvents: PATIENT, GENDER, RACE, ZIP, Age, EVENT_TYPE, CODE, VALUE, with
+            CODE the procedure code, observation description or condition description
+        patientIDs: IDs of patients who are still alive
+    """
+    obsKeep = ['Tobacco smoking status NHIS', 'Body Mass Index', 
+        'Diastolic Blood Pressure', 'Systolic Blood Pressure']
+
+    patients = pd.read_csv(patientFile, usecols = ['ID', 'BIRTHDATE', 'DEATHDATE', 
+        'RACE', 'GENDER', 'ZIP'])
+    patients = patients[patients.DEATHDATE.notnull()].reset_index(drop = True)
+    patients['BIRTHDATE'] = pd.to_datetime(patients.BIRTHDATE)
+    patientType = pd.CategoricalDtype(patients.ID)
+
+    procedures = mergeChunksWithPatients(readCsvChunks(procFile, 
+        ['DATE', 'PATIENT', 'CODE'], {'DATE': str, 'PATIENT': patientType, 
+        'CODE': str}, chunkSize), patients, 'DATE')
+    procedures['EVENT_TYPE'] = 'procedure'
+
+    observations = mergeChunksWithPatients(readCsvChunks(obsFile, 
+        ['DATE', 'PATIENT', 'DESCRIPTION', 'VALUE'], {'DATE': str, 
+        'PATIENT': patientType, 'DESCRIPTION': pd.CategoricalDtype(obsKeep), 
+        'VALUE': str}, chunkSize, lambda x: x.DESCRIPTION.notnull()), patients, 'DATE')
+    observations = observations.rename(columns = {'DESCRIPTION': 'CODE'})
+    observations['EVENT_TYPE'] = 'observation'
+
+    conditions = mergeChunksWithPatients((x.assign(START = x.START.str.replace(
+        'T.*', '', regex = True)) for x in readCsvChunks(conditionFile, 
+        ['START', 'PATIENT', 'DESCRIPTION'], {'START': str, 'PATIENT': patientType}, 
+        chunkSize)), patients, 'START')
+    conditions = conditions.rename(columns = {'DESCRIPTION': 'CODE'})
+    conditions['EVENT_TYPE'] = 'condition'
+
+    eventColumns = ['PATIENT', 'Age', 'EVENT_TYPE', 'CODE', 'VALUE']
+    patientEvents = pd.concat([x.reindex(columns = eventColumns) for x in 
+        [procedures, observations, conditions]], ignore_index = True)
+    patientEvents['CODE'] = patientEvents.CODE.astype('category')
+    patientEvents['EVENT_TYPE'] = patientEvents.EVENT_TYPE.astype(pd.CategoricalDtype(
+        ['procedure', 'observation', 'condition']))
+    patientEvents = patientEvents.sort_values(['PATIENT', 'Age'], 
+        kind = 'mergesort').reset_index(drop = True)
+
+    patientCodes = patientEvents.PATIENT.cat.codes.values
+    for i, column in enumerate(['GENDER', 'RACE', 'ZIP']):
+        patientEvents.insert(i + 1, column, 
+            patients[column].astype('category').values[patientCodes])
+    aliveIDs = set(patientEvents.PATIENT)
+
+    return(patientEvents, aliveIDs)
+
 def AggregateQuantValues(patientRecs, patientIDs):
     """ Aggregate values for BP and BMI within the same age year
 
@@ -125,3 +340,379 @@ def AggregateQuantValues(patientRecs, patientIDs):
     
     returnRecs = pd.concat(storeData)
     return(returnRecs)
+
+def AggregateQuantValuesVectorized(patientRecs, patientIDs):
+    """ Aggregate values for BP and BMI within the same age year, in a single
+        groupby pass rather than re-scanning the records per patient and age.
+        Returns the same records, in the same order, as AggregateQuantValues
+
+    Args:
+        patientRecs: Patient records
+        patientIDs: Unique patients in the records
+
+    Returns:
+        patientRecs: Patient records, with values for BP and BMI averaged by age-year
+    """
+    quantKeep = ['Diastolic Blood Pressure', 'Systolic Blood Pressure', 
+        'Body Mass Index']
+
+    patientOrder = pd.Index(list(patientIDs)).get_indexer(patientRecs.PATIENT)
+    patientRecs = patientRecs[patientOrder >= 0].copy()
+    patientOrder = patientOrder[patientOrder >= 0]
+
+    #Average the rounded BP and BMI values within each patient, age and measurement
+    quantMask = patientRecs.OBSERVATION_DESCRIPTION.isin(quantKeep)
+    quantRecs = patientRecs[quantMask]
+    quantValues = quantRecs.OBSERVATION_VALUE.astype(float).round()
+    patientRecs.loc[quantMask, 'OBSERVATION_VALUE'] = quantValues.groupby(
+        [quantRecs.PATIENT, quantRecs.Age, quantRecs.OBSERVATION_DESCRIPTION], 
+        observed = True).transform('mean')
+
+    #Order as the looped version does: by patient, then by first appearance of each age
+    ageOrder = patientRecs.groupby(['PATIENT', 'Age'], sort = False, 
+        observed = True).ngroup()
+    sortKeys = pd.DataFrame({'patient': patientOrder, 'age': ageOrder.values})
+    sortKeys = sortKeys.sort_values(['patient', 'age'], kind = 'mergesort')
+    patientRecs = patientRecs.iloc[sortKeys.index.values]
+
+    returnRecs = patientRecs.drop_duplicates()
+    return(returnRecs)
+
+def AggregateQuantEvents(patientEvents, patientIDs):
+    """ Aggregate values for BP and BMI within the same age year, for the long event
+        table from buildEventTable. Repeated events within an age-year collapse to one
+
+    Args:
+        patientEvents: Patient event table
+        patientIDs: Unique patients in the events
+
+    Returns:
+        patientEvents: Patient events, with values for BP and BMI averaged by age-year
+    """
+    quantKeep = ['Diastolic Blood Pressure', 'Systolic Blood Pressure', 
+        'Body Mass Index']
+
+    patientEvents = patientEvents[patientEvents.PATIENT.isin(list(patientIDs))].copy()
+
+    quantMask = ((patientEvents.EVENT_TYPE=='observation') & 
+        patientEvents.CODE.isin(quantKeep)).values
+    quantEvents = patientEvents[quantMask]
+    quantValues = quantEvents.VALUE.astype(float).round()
+    patientEvents.loc[quantMask, 'VALUE'] = quantValues.groupby([quantEvents.PATIENT, 
+        quantEvents.Age, quantEvents.CODE], observed = True).transform('mean')
+
+    returnEvents = patientEvents.drop_duplicates()
+    return(returnEvents)
+
+def sqlString(value):
+    """ A value as a quoted SQL string literal, with its quotes doubled. DuckDB
+        takes no bound parameters in SET or in a COPY target, so paths and settings
+        are quoted this way throughout
+    """
+    return("'{0}'".format(str(value).replace("'", "''")))
+
+def sqlSource(fileName):
+    """ DuckDB table function reading a Synthea csv (every column as text, parsed in
+        the query) or a parquet file
+    """
+    if fileName.endswith('.parquet'):
+        return('read_parquet({0})'.format(sqlString(fileName)))
+    return('read_csv({0}, header = true, all_varchar = true)'.format(
+        sqlString(fileName)))
+
+def aggregateQuery(patientFile, procFile, obsFile, conditionFile):
+    """ combineDatasets followed by AggregateQuantValues as one SQL query, so the
+        engine can push the DEATHDATE and observation filters into the scans and
+        stream the joins and averages. Ages are whole years of 365.2425 days, floored,
+        and values are rounded half to even, both as in pandas
+
+    Args:
+        (see combineDatasets)
+
+    Returns:
+        query: SELECT of the aggregated records, with the numeric BP and BMI means in
+            OBSERVATION_VALUE and other observation values in OBSERVATION_VALUE_TEXT
+    """
+    obsKeep = ['Tobacco smoking status NHIS', 'Body Mass Index', 
+        'Diastolic Blood Pressure', 'Systolic Blood Pressure']
+    quantKeep = ['Diastolic Blood Pressure', 'Systolic Blood Pressure', 
+        'Body Mass Index']
+    sqlList = lambda x: ', '.join(sqlString(y) for y in x)
+
+    query = """
+        WITH patients AS (
+            SELECT ID, TRY_CAST(BIRTHDATE AS TIMESTAMP) AS BIRTHDATE, GENDER, RACE,
+                TRY_CAST(ZIP AS DOUBLE) AS ZIP
+            FROM {patients} WHERE DEATHDATE IS NOT NULL),
+        procedures AS (
+            SELECT PATIENT, DATE, CAST(CODE AS BIGINT) AS PROCEDURE_CODE
+            FROM {procedures}),
+        observations AS (
+            SELECT PATIENT, DATE, DESCRIPTION AS OBSERVATION_DESCRIPTION, 
+                VALUE AS OBSERVATION_VALUE
+            FROM {observations} WHERE DESCRIPTION IN ({obsKeep})),
+        conditions AS (
+            SELECT PATIENT, regexp_replace(START, 'T.*', '') AS DATE, 
+                CAST(CODE AS DOUBLE) AS CONDITION_CODE, 
+                DESCRIPTION AS CONDITION_DESCRIPTION
+            FROM {conditions}),
+        joined AS (
+            SELECT * FROM procedures LEFT JOIN observations USING (PATIENT, DATE)
+                LEFT JOIN conditions USING (PATIENT, DATE)),
+        records AS (
+            SELECT j.*, p.GENDER, p.RACE, p.ZIP, floor(date_diff('second', 
+                p.BIRTHDATE, TRY_CAST(j.DATE AS TIMESTAMP)) / 31556952.0) AS Age
+            FROM joined j JOIN patients p ON p.ID = j.PATIENT),
+        averaged AS (
+            SELECT *, OBSERVATION_DESCRIPTION IN ({quantKeep}) AS isQuant,
+                avg(round_even(TRY_CAST(OBSERVATION_VALUE AS DOUBLE), 0)) OVER (
+                    PARTITION BY PATIENT, Age, OBSERVATION_DESCRIPTION) AS quantMean
+            FROM records WHERE Age IS NOT NULL)
+        SELECT DISTINCT PATIENT, GENDER, RACE, ZIP, Age, PROCEDURE_CODE, 
+            OBSERVATION_DESCRIPTION, 
+            CASE WHEN isQuant THEN quantMean END AS OBSERVATION_VALUE,
+            CASE WHEN isQuant THEN NULL ELSE OBSERVATION_VALUE END AS 
+                OBSERVATION_VALUE_TEXT,
+            CONDITION_CODE, CONDITION_DESCRIPTION
+        FROM averaged""".format(patients = sqlSource(patientFile), 
+        procedures = sqlSource(procFile), observations = sqlSource(obsFile), 
+        conditions = sqlSource(conditionFile), obsKeep = sqlList(obsKeep), 
+        quantKeep = sqlList(quantKeep))
+    return(query)
+
+def duckdbConnection(memoryLimit = None, tempDir = None, threads = None):
+    """ In-memory DuckDB connection that spills to tempDir once past memoryLimit
+        (e.g. '4GB'), on all cores unless threads is given
+    """
+    import duckdb
+
+    con = duckdb.connect()
+    if memoryLimit is not None:
+        con.execute('SET memory_limit = {0}'.format(sqlString(memoryLimit)))
+    if tempDir is not None:
+        con.execute('SET temp_directory = {0}'.format(sqlString(tempDir)))
+    if threads is not None:
+        con.execute('SET threads = {0}'.format(int(threads)))
+    #Row order is not kept anyway, and not keeping it lets more operators spill
+    con.execute('SET preserve_insertion_order = false')
+    return(con)
+
+def decodeValues(patientRecs):
+    """ Put the numeric and text observation values back into one column, as the
+        pandas aggregation leaves them
+    """
+    textValues = patientRecs.pop('OBSERVATION_VALUE_TEXT').astype(object)
+    patientRecs['OBSERVATION_VALUE'] = patientRecs.OBSERVATION_VALUE.astype(
+        object).where(textValues.isnull(), textValues)
+    return(patientRecs)
+
+def combineAggregateSql(patientFile, procFile, obsFile, conditionFile, con, 
+    patientIDs = None):
+    """ combineDatasets + AggregateQuantValues on the DuckDB engine
+
+    Args:
+        (see combineDatasets)
+        con: Connection from duckdbConnection
+        patientIDs: Optional patients to restrict to, e.g. a sample cohort
+
+    Returns:
+        patientRecs: Aggregated patient records, in no particular order
+    """
+    query = aggregateQuery(patientFile, procFile, obsFile, conditionFile)
+    if patientIDs is not None:
+        con.register('cohort', pd.DataFrame({'ID': list(patientIDs)}))
+        query = query.replace('WHERE DEATHDATE IS NOT NULL', 
+            'WHERE DEATHDATE IS NOT NULL AND ID IN (SELECT ID FROM cohort)')
+    return(decodeValues(con.execute(query).df()))
+
+def writeSqlParts(patientFile, procFile, obsFile, conditionFile, con, outDir):
+    """ Run the aggregation on the DuckDB engine and write its parquet output straight
+        to part files, one per engine thread, without collecting it in pandas
+
+    Returns:
+        nRows: Number of rows written
+    """
+    query = aggregateQuery(patientFile, procFile, obsFile, conditionFile)
+    clearParts(outDir)
+    tempDir = os.path.join(outDir, '_sqltmp')
+    nRows = con.execute('COPY ({0}) TO {1} (FORMAT parquet, PER_THREAD_OUTPUT true, '
+        'OVERWRITE_OR_IGNORE true)'.format(query, sqlString(tempDir))).fetchone()[0]
+
+    #Renamed into place, so readers never see a partial part
+    for partNum, fileName in enumerate(sorted(glob.glob(os.path.join(tempDir, 
+        '*.parquet')))):
+        os.replace(fileName, os.path.join(outDir, 'part-{0:05d}.parquet'.format(
+            partNum)))
+    os.rmdir(tempDir)
+    return(nRows)
+
+def compareRecords(leftRecs, rightRecs):
+    """ Whether two sets of aggregated records hold the same rows, in any order and
+        whether or not columns are categorical
+    """
+    def canonical(patientRecs):
+        patientRecs = patientRecs.astype(object).where(patientRecs.notnull(), None)
+        sortKeys = patientRecs.applymap(lambda x: '' if x is None else repr(x))
+        return(patientRecs.iloc[np.lexsort([sortKeys[x].values for x in 
+            reversed(sortKeys.columns)])].reset_index(drop = True))
+
+    if len(leftRecs) != len(rightRecs) or list(leftRecs.columns) != list(
+        rightRecs.columns):
+        return(False)
+    return(canonical(leftRecs).equals(canonical(rightRecs)))
+
+def verifySqlEngine(patientFile, procFile, obsFile, conditionFile, con, 
+    nPatients = 200):
+    """ Check the DuckDB engine against the pandas path on a sample cohort: the
+        first nPatients patients with a DEATHDATE
+
+    Returns:
+        matches: Whether both give the same aggregated records
+        nRows: Rows in the sample's aggregated records
+    """
+    patients = pd.read_csv(patientFile, usecols = ['ID', 'DEATHDATE'])
+    cohort = list(patients.ID[patients.DEATHDATE.notnull()][:nPatients])
+
+    patientRecs, IDs = combineDatasetsStreaming(patientFile, procFile, obsFile, 
+        conditionFile)
+    patientRecs = patientRecs[patientRecs.PATIENT.isin(cohort)]
+    pandasRecs = AggregateQuantValuesVectorized(patientRecs, 
+        list(pd.unique(patientRecs.PATIENT)))
+    sqlRecs = combineAggregateSql(patientFile, procFile, obsFile, conditionFile, 
+        con, cohort)
+
+    return(compareRecords(pandasRecs, sqlRecs), len(sqlRecs))
+
+def partitionPatients(patientRecs, nShards):
+    """ Split the records into shards of whole patients, so each worker is sent only
+        the records it aggregates
+
+    Args:
+        patientRecs: Patient records (or events)
+        nShards: Number of shards
+
+    Returns:
+        shards: List of (up to) nShards record subsets, disjoint by patient
+    """
+    patientCodes = pd.factorize(patientRecs.PATIENT)[0]
+    shardOf = patientCodes % nShards
+    shardOrder = np.argsort(shardOf, kind = 'mergesort')
+    bounds = np.searchsorted(shardOf[shardOrder], np.arange(nShards + 1))
+
+    shards = []
+    for i in range(nShards):
+        if bounds[i+1] > bounds[i]:
+            shard = patientRecs.iloc[shardOrder[bounds[i]:bounds[i+1]]].copy()
+            #Otherwise every shard would carry the full list of patient IDs
+            if hasattr(shard.PATIENT, 'cat'):
+                shard['PATIENT'] = shard.PATIENT.cat.remove_unused_categories()
+            shards.append(shard)
+    return(shards)
+
+def aggregateShard(task):
+    """ Worker entry point: aggregate one shard of patients. For columnar output the
+        worker writes its own part file and only a row count comes back
+
+    Args:
+        task: (aggregating function, shard of patient records, part number, output
+            directory, file format)
+
+    Returns:
+        Aggregated records for the shard (csv, or no file format), or the number of
+        rows written
+    """
+    aggregator, shard, partNum, outDir, fileFormat = task
+    result = aggregator(shard, list(pd.unique(shard.PATIENT)))
+    if fileFormat in [None, 'csv']:
+        return(result)
+    writePart(encodeColumnar(result), outDir, partNum, fileFormat)
+    return(len(result))
+
+def encodeColumnar(patientRecs):
+    """ Encode aggregated records for columnar storage. Demographics and codes become
+        categoricals, and the mixed text/number value column is split in two so
+        numeric values are stored as floats rather than text
+
+    Args:
+        patientRecs: Aggregated patient records (or events)
+
+    Returns:
+        patientRecs: Encoded records, with a *_TEXT column next to the value column
+    """
+    valueColumn = 'VALUE' if 'EVENT_TYPE' in patientRecs.columns else 'OBSERVATION_VALUE'
+    patientRecs = patientRecs.reset_index(drop = True)
+
+    values = patientRecs[valueColumn]
+    numericValues = pd.to_numeric(values, errors = 'coerce')
+    textValues = values.where(numericValues.isnull() & values.notnull())
+    patientRecs[valueColumn] = numericValues.astype(float)
+    patientRecs.insert(patientRecs.columns.get_loc(valueColumn) + 1, 
+        valueColumn + '_TEXT', textValues.astype(object).astype('category'))
+
+    for column in patientRecs.columns:
+        if column not in ['Age', valueColumn, valueColumn + '_TEXT']:
+            patientRecs[column] = patientRecs[column].astype('category')
+    return(patientRecs)
+
+def writePart(patientRecs, outDir, partNum, fileFormat):
+    """ Write one part file atomically: to a temporary name, then renamed into place,
+        so readers never see a partial part
+    """
+    fileName = os.path.join(outDir, 'part-{0:05d}.{1}'.format(partNum, fileFormat))
+    tempName = fileName + '.tmp'
+    if fileFormat == 'parquet':
+        patientRecs.to_parquet(tempName, index = False)
+    else:
+        patientRecs.to_feather(tempName)
+    os.replace(tempName, fileName)
+
+def clearParts(outDir):
+    """ Remove part files from an earlier run, so reruns replace rather than duplicate
+    """
+    os.makedirs(outDir, exist_ok = True)
+    for fileName in glob.glob(os.path.join(outDir, 'part-*')) + glob.glob(
+        os.path.join(outDir, '_STORE')):
+        os.remove(fileName)
+
+def writeStoreParts(storeDir, layer, changedBuckets, outDir, fileFormat):
+    """ Write one part file per feature store bucket. If the output directory was last
+        written from this store layer in this format (its _STORE marker says so) only
+        the changed buckets are rewritten, otherwise all of them are
+
+    Args:
+        storeDir: Feature store directory
+        layer: Records layer of the store
+        changedBuckets: Buckets rewritten in the store on this run
+        outDir: Output directory
+        fileFormat: parquet or feather
+
+    Returns:
+        nParts: Number of part files written
+    """
+    markerFile = os.path.join(outDir, '_STORE')
+    marker = {'store': os.path.abspath(storeDir), 'layer': layer, 
+        'format': fileFormat}
+    written = None
+    if os.path.exists(markerFile):
+        with open(markerFile) as fin:
+            try:
+                written = json.load(fin)
+            except ValueError:
+                written = None
+    if written != marker:
+        clearParts(outDir)
+        changedBuckets = None
+
+    nParts = 0
+    for bucket, records in store.readRecordBuckets(storeDir, layer, changedBuckets):
+        #A bucket has one part, whatever format it was last written in
+        for fileName in glob.glob(os.path.join(outDir, 'part-{0:05d}.*'.format(
+            bucket))):
+            os.remove(fileName)
+        if records is not None:
+            writePart(encodeColumnar(records), outDir, bucket, fileFormat)
+            nParts += 1
+
+    with open(markerFile, 'w') as fout:
+        json.dump(marker, fout)
+    return(nParts)
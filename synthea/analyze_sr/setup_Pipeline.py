@@ -0,0 +1,126 @@
+
+import sys, os, json, time, hashlib, runpy
+
+#Stages of Pipeline.py run, in order
+stageOrder = ['aggregate', 'build', 'fit']
+
+aggregateNames = {'wide': 'AggregatePatientData', 'events': 'AggregatePatientEvents'}
+
+def pathSignature(path):
+    """ Hash of the sizes and modification times of a file, or of every file under a
+        directory, None if the path does not exist
+    """
+    if not os.path.exists(path):
+        return(None)
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fileName in sorted(files):
+                stat = os.stat(os.path.join(root, fileName))
+                entries.append((os.path.relpath(os.path.join(root, fileName), path),
+                    stat.st_size, stat.st_mtime_ns))
+    else:
+        stat = os.stat(path)
+        entries = [(stat.st_size, stat.st_mtime_ns)]
+    return(hashlib.sha1(json.dumps(entries).encode()).hexdigest())
+
+def stageSpec(stage, args, scriptArgs = ()):
+    """ What a stage runs and the paths it reads and writes
+
+    Args:
+        stage: aggregate, build, fit, score or bench
+        args: Pipeline.py arguments (csv_dir, layout, format, data, fit_model)
+        scriptArgs: More arguments for the stage script
+
+    Returns:
+        Dictionary of script, argv (without the script), inputs and outputs. A stage
+        with no outputs (serving, benchmarks) is never up to date
+    """
+    aggregated = aggregateNames[args.layout] + ('.csv' if args.format == 'csv' else '')
+    modelDir, predictions = ('BaselineModel', 'yBaselinePredictions.csv') if (
+        args.fit_model == 'baseline') else ('LSTMModel', 'yPredictions.csv')
+    if stage == 'aggregate':
+        inputs = [os.path.join(args.csv_dir, x + '.csv') for x in ['patients',
+            'procedures', 'observations', 'conditions']]
+        return({'script': 'PatientRecordAgg.py', 'argv': inputs + ['--layout',
+            args.layout, '--format', args.format] + list(scriptArgs),
+            'inputs': inputs, 'outputs': [aggregated]})
+    if stage == 'build':
+        return({'script': 'BuildLSTMData.py', 'argv': [aggregated, '--layout',
+            args.layout, '--out', args.data] + list(scriptArgs),
+            'inputs': [aggregated], 'outputs': [args.data]})
+    if stage == 'fit':
+        script = 'BaselineFit.py' if args.fit_model == 'baseline' else 'LSTMFit.py'
+        return({'script': script, 'argv': [args.data] + list(scriptArgs),
+            'inputs': [args.data], 'outputs': [modelDir, predictions]})
+    if stage == 'score':
+        return({'script': 'ScoreService.py', 'argv': ['LSTMModel'] +
+            list(scriptArgs), 'inputs': ['LSTMModel'], 'outputs': []})
+    if stage == 'bench':
+        return({'script': 'BenchmarkPipeline.py', 'argv': list(scriptArgs),
+            'inputs': [], 'outputs': []})
+    raise ValueError('Unknown stage: {0}'.format(stage))
+
+def readState(stateFile):
+    if not os.path.exists(stateFile):
+        return({})
+    with open(stateFile) as fin:
+        return(json.load(fin))
+
+def writeState(state, stateFile):
+    """ Written whole to a temporary file then renamed, so an interrupted write
+        leaves the previous state
+    """
+    with open(stateFile + '.tmp', 'w') as fout:
+        json.dump(state, fout, indent = 2)
+    os.replace(stateFile + '.tmp', stateFile)
+
+def stageRecord(spec):
+    """ Arguments and input and output signatures of a stage, as kept in the state
+        file once it completes
+    """
+    return({'script': spec['script'], 'argv': spec['argv'],
+        'inputs': dict((x, pathSignature(x)) for x in spec['inputs']),
+        'outputs': dict((x, pathSignature(x)) for x in spec['outputs'])})
+
+def stageStatus(spec, record):
+    """ 'fresh' if the stage last completed with the same arguments, and neither its
+        inputs nor its outputs have changed since. Otherwise why it has to run
+    """
+    if not len(spec['outputs']):
+        return('always runs')
+    if record is None:
+        return('never completed')
+    if record['script'] != spec['script'] or record['argv'] != spec['argv']:
+        return('arguments changed')
+    current = stageRecord(spec)
+    missing = [x for x, y in current['outputs'].items() if y is None]
+    if len(missing):
+        return('missing {0}'.format(', '.join(missing)))
+    if current['inputs'] != record['inputs']:
+        return('inputs changed')
+    if current['outputs'] != record['outputs']:
+        return('outputs changed')
+    return('fresh')
+
+def runScript(script, argv):
+    """ Run an analysis script in this process, as if from the command line. Its
+        imports (pandas, TensorFlow, ...) are only paid for when it runs, and only
+        once across stages
+
+    Returns:
+        Seconds taken
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    savedArgv = sys.argv
+    sys.argv = [path] + list(argv)
+    start = time.perf_counter()
+    try:
+        runpy.run_path(path, run_name = '__main__')
+    except SystemExit as exit:
+        if exit.code not in (None, 0):
+            raise
+    finally:
+        sys.argv = savedArgv
+    return(time.perf_counter() - start)
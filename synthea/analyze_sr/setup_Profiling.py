@@ -0,0 +1,243 @@
+
+import sys, os, json, time, socket, platform, resource, threading
+import cProfile, pstats
+from collections import Counter
+from contextlib import contextmanager
+
+activeProfiler = None
+
+def readPeakRss():
+    """ Peak resident memory of this process in MB, since the last resetPeakRss
+    """
+    try:
+        with open('/proc/self/status') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) / 1024.)
+    except OSError:
+        pass
+    #ru_maxrss is kB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(peak / 1024.**2 if sys.platform == 'darwin' else peak / 1024.)
+
+def resetPeakRss():
+    """ Reset the peak that readPeakRss reports (Linux), so each stage gets its own.
+        Returns False where it can't be reset, and peaks are then for the whole run
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return(True)
+    except OSError:
+        return(False)
+
+def childrenUsage():
+    """ CPU seconds and peak RSS in MB of finished child processes (pool workers)
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = usage.ru_maxrss / (1024.**2 if sys.platform == 'darwin' else 1024.)
+    return(usage.ru_utime + usage.ru_stime, peak)
+
+def rowCount(result):
+    """ Rows in a stage's result: its length, or the length of its first item for a
+        tuple of results (e.g. records and IDs)
+    """
+    if isinstance(result, tuple) and len(result):
+        result = result[0]
+    try:
+        return(len(result))
+    except TypeError:
+        return(None)
+
+class StackSampler(object):
+    """ Sampling profiler: a background thread records the profiled thread's stack
+        every interval seconds, as folded stacks (flamegraph.pl, speedscope)
+    """
+    def __init__(self, interval = 0.01):
+        self.interval = interval
+        self.samples = Counter()
+        self.threadID = threading.get_ident()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.threadID)
+            stack = []
+            while frame is not None:
+                stack.append('{0}:{1}'.format(os.path.basename(
+                    frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def write(self, fileName):
+        with open(fileName, 'w') as fout:
+            for stack, count in self.samples.most_common():
+                fout.write('{0} {1}\n'.format(stack, count))
+
+class StageProfiler(object):
+    """ Wall time, CPU time, peak RSS and row counts for each stage of a run, reported
+        as a table and written as JSON and a Chrome trace (chrome://tracing, Perfetto).
+        Stages can nest; a stage's peak includes its children's
+
+    Args:
+        runName: Name of the run, e.g. the script
+        outPrefix: If given, close() writes outPrefix.json and outPrefix.trace.json
+        profiler: None, 'cprofile' (outPrefix.prof) or 'sample' (outPrefix.folded)
+    """
+    def __init__(self, runName, outPrefix = None, profiler = None):
+        self.runName, self.outPrefix, self.profilerName = runName, outPrefix, profiler
+        self.stages, self.openStages = [], []
+        self.startTime = time.perf_counter()
+        self.startWall = time.time()
+        self.canReset = resetPeakRss()
+        #Other results of the run to write with it, e.g. output checks
+        self.extra = {}
+
+        self.profiler = None
+        if profiler == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profiler == 'sample':
+            self.profiler = StackSampler()
+            self.profiler.start()
+        elif profiler is not None:
+            raise ValueError('Unknown profiler: {0}'.format(profiler))
+
+    def activate(self):
+        """ Make this the profiler that module-level stage() records to
+        """
+        global activeProfiler
+        activeProfiler = self
+        return(self)
+
+    def updatePeaks(self):
+        peak = readPeakRss()
+        for record in self.openStages:
+            record['peakRssMB'] = max(record['peakRssMB'], peak)
+
+    @contextmanager
+    def stage(self, stageName, rows = None):
+        """ Record a stage. Yields its record, so the stage can fill in 'rows'
+        """
+        self.updatePeaks()
+        record = {'stage': stageName, 'depth': len(self.openStages), 'rows': rows,
+            'start': time.perf_counter() - self.startTime, 'peakRssMB': 0.}
+        if self.canReset:
+            resetPeakRss()
+        record['peakRssMB'] = readPeakRss()
+        startCpu, (startChildCpu, _) = time.process_time(), childrenUsage()
+        self.openStages.append(record)
+        try:
+            yield record
+        finally:
+            self.updatePeaks()
+            self.openStages.pop()
+            childCpu, childPeak = childrenUsage()
+            record.update({'wall': time.perf_counter() - self.startTime -
+                record['start'], 'cpu': time.process_time() - startCpu,
+                'childCpu': childCpu - startChildCpu, 'childPeakRssMB': childPeak})
+            self.stages.append(record)
+
+    def report(self):
+        """ Print the stages, indented by nesting, in the order they started
+        """
+        print('{0:<28s}{1:>10s}{2:>10s}{3:>11s}{4:>12s}'.format('stage', 'wall (s)',
+            'cpu (s)', 'peak (MB)', 'rows'))
+        for record in sorted(self.stages, key = lambda x: x['start']):
+            print('{0:<28s}{1:>10.2f}{2:>10.2f}{3:>11.0f}{4:>12s}'.format(
+                '  '*record['depth'] + record['stage'], record['wall'],
+                record['cpu'] + record['childCpu'], record['peakRssMB'],
+                '' if record['rows'] is None else str(record['rows'])))
+        print('{0:<28s}{1:>10.2f}'.format('total', time.perf_counter() -
+            self.startTime))
+
+    def summary(self):
+        """ The run and its stages, as written to outPrefix.json
+        """
+        return(dict({'run': self.runName, 'argv': sys.argv, 
+            'startTime': self.startWall, 'host': socket.gethostname(), 
+            'python': platform.python_version(), 'peakIsPerStage': self.canReset,
+            'total': time.perf_counter() - self.startTime,
+            'stages': sorted(self.stages, key = lambda x: x['start'])}, **self.extra))
+
+    def chromeTrace(self):
+        """ Stages as complete ('X') events of the Chrome trace event format
+        """
+        events = [{'name': x['stage'], 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+            'ts': x['start']*1e6, 'dur': x['wall']*1e6, 'args': {'cpu': x['cpu'],
+            'childCpu': x['childCpu'], 'peakRssMB': x['peakRssMB'],
+            'rows': x['rows']}} for x in self.stages]
+        return({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+    def close(self):
+        """ Stop any profiler, report, and write outputs if there is an outPrefix
+        """
+        if self.profilerName == 'cprofile':
+            self.profiler.disable()
+        elif self.profilerName == 'sample':
+            self.profiler.stop()
+
+        self.report()
+        if self.outPrefix is not None:
+            with open(self.outPrefix + '.json', 'w') as fout:
+                json.dump(self.summary(), fout, indent = 1)
+            with open(self.outPrefix + '.trace.json', 'w') as fout:
+                json.dump(self.chromeTrace(), fout)
+            if self.profilerName == 'cprofile':
+                self.profiler.dump_stats(self.outPrefix + '.prof')
+            elif self.profilerName == 'sample':
+                self.profiler.write(self.outPrefix + '.folded')
+
+        global activeProfiler
+        if activeProfiler is self:
+            activeProfiler = None
+
+@contextmanager
+def stage(stageName, rows = None):
+    """ Record a stage with the active profiler. Without one, yields a record that is
+        simply dropped, so library code can mark its stages unconditionally
+    """
+    if activeProfiler is None:
+        yield {'rows': rows}
+    else:
+        with activeProfiler.stage(stageName, rows) as record:
+            yield record
+
+def compareProfiles(baselineFile, currentFile):
+    """ Per-stage change between two runs' JSON profiles, to track regressions
+
+    Returns:
+        List of (stage, baseline wall, current wall, wall ratio, baseline peak MB,
+            current peak MB) for stages in both runs
+    """
+    with open(baselineFile) as fin:
+        baseline = {x['stage']: x for x in json.load(fin)['stages']}
+    with open(currentFile) as fin:
+        current = json.load(fin)['stages']
+
+    changes = []
+    for record in current:
+        if record['stage'] in baseline:
+            old = baseline[record['stage']]
+            changes.append((record['stage'], old['wall'], record['wall'],
+                record['wall'] / max(old['wall'], 1e-9), old['peakRssMB'],
+                record['peakRssMB']))
+    return(changes)
+
+def printProfileComparison(changes):
+    print('{0:<28s}{1:>10s}{2:>10s}{3:>8s}{4:>13s}{5:>12s}'.format('stage', 'before',
+        'after', 'ratio', 'peak before', 'peak after'))
+    for stageName, oldWall, newWall, ratio, oldPeak, newPeak in changes:
+        print('{0:<28s}{1:>10.2f}{2:>10.2f}{3:>8.2f}{4:>13.0f}{5:>12.0f}'.format(
+            stageName, oldWall, newWall, ratio, oldPeak, newPeak))
@@ -0,0 +1,241 @@
+
+import sys, os, json, time, queue, threading
+import urllib.request
+import pandas as pd
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import setup_BuildLSTMData as util
+import setup_Vocabulary as vocab
+
+def loadScoringModel(modelDir):
+    """ Load a model saved by LSTMFit.py, with the manifest and vocabulary of the
+        dataset it was trained on
+
+    Args:
+        modelDir: Directory with model.keras, manifest.json and vocabulary.json
+
+    Returns:
+        model: Keras model
+        nSteps: Number of age-years in each window
+        codeDicts: raceDict, genderDict, zipDict, smokerDict, conditionDict,
+            procedureDict of the training vocabulary
+        padShort: Whether the model was fit with zero-padded windows of short
+            histories, so they are scored padded too
+    """
+    import tensorflow as tf
+
+    for fileName in ['model.keras', 'manifest.json', 'vocabulary.json']:
+        if not os.path.exists(os.path.join(modelDir, fileName)):
+            raise ValueError('{0} has no {1}; fit the model on a dataset directory, or '
+                'pass LSTMFit.py --vocab with text files'.format(modelDir, fileName))
+
+    model = tf.keras.models.load_model(os.path.join(modelDir, 'model.keras'))
+    with open(os.path.join(modelDir, 'manifest.json')) as fin:
+        manifest = json.load(fin)
+    codeDicts = vocab.vocabularyDicts(vocab.readVocabulary(os.path.join(modelDir,
+        'vocabulary.json')))
+
+    if model.input_shape[-1] != manifest['nVars']:
+        raise ValueError('Model takes {0} variables, the vocabulary gives {1}'.format(
+            model.input_shape[-1], manifest['nVars']))
+
+    #First call builds the predict function, so the first request isn't slow
+    model.predict_on_batch(np.zeros((1, manifest['nSteps'], manifest['nVars']),
+        dtype = np.float32))
+    return(model, manifest['nSteps'], codeDicts, manifest.get('padded', False))
+
+def recordsWindow(records, nSteps, raceDict, genderDict, zipDict, smokerDict,
+    conditionDict, procedureDict, padShort = False):
+    """ The window of a patient's last nSteps age-years, built as buildRNNData builds
+        each step
+
+    Args:
+        records: One patient's records, as AggregatePatientData rows (DataFrame, or
+            list of dicts keyed by column)
+        nSteps: Number of age-years in each window
+        (see extractVarsOneStep for the dictionaries)
+        padShort: Left-pad a history of fewer than nSteps age-years with zero steps,
+            as BuildLSTMData.py --pad-short does
+
+    Returns:
+        window: (nSteps, variables) array, or None if the patient has fewer than
+            nSteps age-years (no age-years with padShort)
+    """
+    records = pd.DataFrame(records).reindex(columns = util.recordColumns)
+    records = records.sort_values('Age')
+    records['ZIP'] = util.formatZips(records.ZIP)
+
+    ages = np.sort(records.Age.unique())
+    if len(ages) < (1 if padShort else nSteps):
+        return(None)
+
+    oneZip = records.ZIP.values[0]
+    oneGender = records.GENDER.values[0]
+    oneRace = records.RACE.values[0]
+    window = [util.extractVarsOneStep(records[records.Age==age], oneZip, oneGender,
+        oneRace, zipDict, genderDict, raceDict, smokerDict, conditionDict,
+        procedureDict, age) for age in ages[-nSteps:]]
+    window = np.array(window, dtype = np.float32)
+    return(np.pad(window, ((nSteps - len(window), 0), (0, 0))))
+
+class MicroBatcher(object):
+    """ Collect windows from concurrent requests into one model call. A batch runs
+        once maxBatch windows are waiting or the first has waited maxDelay seconds
+    """
+    def __init__(self, model, maxBatch = 256, maxDelay = 0.005):
+        self.model, self.maxBatch, self.maxDelay = model, maxBatch, maxDelay
+        self.requests = queue.Queue()
+        self.nBatches, self.nWindows = 0, 0
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def score(self, windows):
+        """ Scores of a (windows, steps, variables) array, once its batch has run
+        """
+        request = {'windows': windows, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return(request['scores'])
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            nWindows = len(batch[0]['windows'])
+            deadline = time.perf_counter() + self.maxDelay
+            while nWindows < self.maxBatch:
+                try:
+                    request = self.requests.get(timeout = max(deadline -
+                        time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                nWindows += len(request['windows'])
+
+            try:
+                scores = np.asarray(self.model.predict_on_batch(np.concatenate(
+                    [x['windows'] for x in batch]))).reshape(-1)
+                splits = np.cumsum([len(x['windows']) for x in batch])[:-1]
+                for request, requestScores in zip(batch, np.split(scores, splits)):
+                    request['scores'] = requestScores
+            except Exception as error:
+                for request in batch:
+                    request['error'] = error
+
+            self.nBatches += 1
+            self.nWindows += nWindows
+            for request in batch:
+                request['done'].set()
+
+def makeHandler(scorer, nSteps, codeDicts, padShort = False):
+    """ Request handler for the scoring server
+
+        POST /score {"patients": [{"id": ..., "records": [...]}, ...]} returns
+        {"scores": [{"id": ..., "score": ...}, ...]}, with a null score and an error
+        for patients without enough history. GET /health returns batching counts
+    """
+    class ScoreHandler(BaseHTTPRequestHandler):
+
+        def sendJson(self, status, body):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return(self.sendJson(404, {'error': 'not found'}))
+            self.sendJson(200, {'status': 'ok', 'batches': scorer.nBatches,
+                'windows': scorer.nWindows})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return(self.sendJson(404, {'error': 'not found'}))
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                patients = body['patients']
+                windows = [recordsWindow(x['records'], nSteps, *codeDicts, 
+                    padShort = padShort) for x in patients]
+            except Exception as error:
+                return(self.sendJson(400, {'error': str(error)}))
+
+            error = 'no age-years of records' if padShort else ('fewer than {0} '
+                'age-years of records'.format(nSteps))
+            results = [{'id': x.get('id'), 'score': None, 'error': error} for x in 
+                patients]
+            scoredLocs = [i for i, x in enumerate(windows) if x is not None]
+            if len(scoredLocs):
+                scores = scorer.score(np.stack([windows[i] for i in scoredLocs]))
+                for i, score in zip(scoredLocs, scores):
+                    results[i] = {'id': patients[i].get('id'), 'score': float(score)}
+            self.sendJson(200, {'scores': results})
+
+        def log_message(self, format, *args):
+            pass
+
+    return(ScoreHandler)
+
+def startServer(modelDir, host = '127.0.0.1', port = 8050, maxBatch = 256,
+    maxDelay = 0.005):
+    """ Load the model once and serve it on a background thread
+
+    Returns:
+        server: ThreadingHTTPServer, stop with server.shutdown(). server.nSteps is
+            the window length the model takes, and server.padShort whether shorter
+            histories are padded
+    """
+    model, nSteps, codeDicts, padShort = loadScoringModel(modelDir)
+    scorer = MicroBatcher(model, maxBatch, maxDelay)
+    server = ThreadingHTTPServer((host, port), makeHandler(scorer, nSteps, codeDicts,
+        padShort))
+    server.daemon_threads = True
+    server.nSteps, server.padShort = nSteps, padShort
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return(server)
+
+def patientPayloads(patientRecs, nPatients, minAges = 1):
+    """ /score request bodies of one patient each, from aggregated patient records,
+        for patients with at least minAges age-years
+    """
+    payloads = []
+    for patientID, records in patientRecs.groupby('PATIENT', observed = True):
+        if records.Age.nunique() < minAges:
+            continue
+        records = records.astype(object).where(records.notnull(), None)
+        payloads.append(json.dumps({'patients': [{'id': str(patientID),
+            'records': records.to_dict('records')}]}).encode())
+        if len(payloads) == nPatients:
+            break
+    return(payloads)
+
+def benchService(url, payloads, nClients, nRequests):
+    """ Send nRequests from each of nClients concurrent clients, each client waiting
+        for its last response before sending the next request
+
+    Returns:
+        latencies: Seconds from sending each request to its response
+        elapsed: Wall time for all requests
+    """
+    latencies = [[] for x in range(nClients)]
+
+    def client(clientNum):
+        for i in range(nRequests):
+            payload = payloads[(clientNum*nRequests + i) % len(payloads)]
+            request = urllib.request.Request(url, data = payload,
+                headers = {'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            latencies[clientNum].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target = client, args = (x,)) for x in range(nClients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return(np.concatenate(latencies), elapsed)
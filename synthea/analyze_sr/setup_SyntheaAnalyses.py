@@ -0,0 +1,298 @@
+
+import sys, os, time
+import pandas as pd
+import numpy as np
+import setup_SyntheaTables as tables
+
+#Allergies
+
+def allergyYears(patients, allergies):
+    """ Patients joined to their allergies, with the year (YOB) each allergy was
+        recorded, as AllergyHistory.R takes it from the allergy START
+    """
+    allergyYOB = patients[['ID']].merge(allergies[['PATIENT', 'START',
+        'DESCRIPTION']].rename(columns = {'PATIENT': 'ID', 'DESCRIPTION': 'Allergy'}),
+        on = 'ID', how = 'left')
+    allergyYOB['YOB'] = allergyYOB.START.dt.year
+    return(allergyYOB.drop(columns = 'START'))
+
+def yearSequence(years, yearWindow = 5):
+    """ Bin edges every yearWindow years, from below the first year to past the last
+    """
+    years = years[years.notnull()]
+    minYear, maxYear = int(years.min()), int(years.max())
+    return(np.arange(minYear - minYear % yearWindow, maxYear - maxYear % yearWindow +
+        yearWindow + 1, yearWindow))
+
+def yearBins(years, yearSeq):
+    """ Bin of each year, -1 for none. As in AllergyHistory.R, bins exclude both
+        edges, so years on an edge fall in no bin
+    """
+    yearWindow = yearSeq[1] - yearSeq[0]
+    offsets = years.values - yearSeq[0]
+    inBin = ~np.isnan(offsets) & (offsets % yearWindow != 0) & (offsets > 0) & (
+        offsets < yearSeq[-1] - yearSeq[0])
+    return(np.where(inBin, np.nan_to_num(offsets) // yearWindow, -1).astype(int))
+
+def allergyFrequencies(allergyYOB, yearSeq):
+    """ Share of patients in each year bin with each allergy (normalizeAllergyFrequencies)
+
+    Returns:
+        DataFrame of Year (bin start), Allergy, AllergyFreq
+    """
+    binned = allergyYOB.assign(Year = yearBins(allergyYOB.YOB, yearSeq))
+    binned = binned[binned.Year >= 0]
+    patients = binned.groupby('Year').ID.nunique()
+    withAllergy = binned[binned.Allergy.notnull()].groupby(['Year', 'Allergy'],
+        observed = True).ID.nunique().reset_index()
+    withAllergy['AllergyFreq'] = withAllergy.ID.values / patients.loc[
+        withAllergy.Year].values
+    withAllergy['Year'] = yearSeq[withAllergy.Year.values]
+    return(withAllergy[['Year', 'Allergy', 'AllergyFreq']])
+
+def allergyCounts(allergyYOB, yearSeq):
+    """ Share of patients in each year bin with 1, 2, 3 and more than 3 different
+        allergies (histoAllergyNum)
+
+    Returns:
+        DataFrame of Year (every edge of yearSeq) and the shares 1, 2, 3, >3
+    """
+    binned = allergyYOB.assign(Year = yearBins(allergyYOB.YOB, yearSeq))
+    binned = binned[binned.Year >= 0]
+    perPatient = binned.groupby(['Year', 'ID']).Allergy.nunique().reset_index()
+    perPatient['Count'] = pd.cut(perPatient.Allergy, [0, 1, 2, 3, np.inf],
+        labels = ['1', '2', '3', '>3'])
+    shares = pd.crosstab(perPatient.Year, perPatient.Count, dropna = False).div(
+        perPatient.groupby('Year').size(), axis = 0)
+    shares = shares.reindex(index = range(len(yearSeq)), columns = ['1', '2', '3',
+        '>3']).fillna(0)
+    shares.index = yearSeq
+    shares.index.name = 'Year'
+    return(shares.reset_index())
+
+#Lab regression
+
+def splineKnots(x, nKnots = 5):
+    """ Knots at the quantiles rms::rcs places them for nKnots knots
+    """
+    quantiles = {3: [.1, .5, .9], 4: [.05, .35, .65, .95],
+        5: [.05, .275, .5, .725, .95], 6: [.05, .23, .41, .59, .77, .95]}[nKnots]
+    return(np.unique(np.quantile(x, quantiles)))
+
+def splineBasis(x, knots):
+    """ Restricted cubic spline basis (linear beyond the outer knots), as rms::rcs:
+        x, then one term per inner knot, scaled by the squared knot span
+    """
+    x = np.asarray(x, dtype = float)
+    positive = lambda y: np.maximum(y, 0)**3
+    last, nextLast = knots[-1], knots[-2]
+    terms = [positive(x - k) - positive(x - nextLast)*(last - k)/(last - nextLast) +
+        positive(x - last)*(nextLast - k)/(last - nextLast) for k in knots[:-2]]
+    return(np.column_stack([x] + [y/(last - knots[0])**2 for y in terms]))
+
+def regressionDesign(frame, races, genders, knots):
+    """ Intercept, race and gender indicators (first level as reference) and spline
+        terms of Age
+    """
+    columns = [np.ones(len(frame))]
+    columns += [(frame.Race.values == x).astype(float) for x in races[1:]]
+    columns += [(frame.Gender.values == x).astype(float) for x in genders[1:]]
+    return(np.column_stack(columns + [splineBasis(frame.Age.values, knots)]))
+
+def labRegression(patientObs, vital, nKnots = 5):
+    """ Mean of a vital by age, race and gender among adults, with a 95% confidence
+        band (buildOrdinalModel). LabRegression.R fits an ordinal model and reports its
+        mean; this fits least squares on the same terms (race, gender, spline of age),
+        whose predictions are means directly
+
+    Args:
+        patientObs: From tables.patientObservations
+        vital: Observation DESCRIPTION, e.g. Creatinine
+        nKnots: Spline knots for age
+
+    Returns:
+        DataFrame of Age, Gender, Race, yhat, lower, upper, as rms::Predict gives
+    """
+    frame = patientObs.loc[(patientObs.DESCRIPTION == vital) &
+        patientObs.VALUE.notnull(), ['RACE', 'GENDER', 'AgeAtEncounter', 'VALUE']]
+    frame = frame[(frame.AgeAtEncounter >= 18) & (frame.RACE != 'native')]
+    frame = pd.DataFrame({'Race': frame.RACE.astype(str).str.capitalize().values,
+        'Gender': frame.GENDER.astype(str).map({'F': 'Female',
+        'M': 'Male'}).values, 'Age': frame.AgeAtEncounter.values,
+        'Value': np.round(frame.VALUE.values)})
+    frame = frame[frame.Gender.notnull()]
+    if not len(frame):
+        return(pd.DataFrame(columns = ['Age', 'Gender', 'Race', 'yhat', 'lower',
+            'upper']))
+
+    races = [x for x in ['Black', 'Hispanic', 'White', 'Asian'] if x in
+        set(frame.Race)]
+    frame = frame[frame.Race.isin(races)]
+    genders = [x for x in ['Male', 'Female'] if x in set(frame.Gender)]
+    knots = splineKnots(frame.Age.values, nKnots)
+
+    design = regressionDesign(frame, races, genders, knots)
+    coefs, _, rank, _ = np.linalg.lstsq(design, frame.Value.values, rcond = None)
+    residuals = frame.Value.values - design.dot(coefs)
+    variance = residuals.dot(residuals)/max(len(frame) - rank, 1)
+    covariance = variance*np.linalg.pinv(design.T.dot(design))
+
+    grid = pd.MultiIndex.from_product([np.arange(frame.Age.min(), frame.Age.max() + 1),
+        genders, races], names = ['Age', 'Gender', 'Race']).to_frame(index = False)
+    gridDesign = regressionDesign(grid, races, genders, knots)
+    grid['yhat'] = gridDesign.dot(coefs)
+    stdErr = np.sqrt(np.einsum('ij,jk,ik->i', gridDesign, covariance, gridDesign))
+    grid['lower'], grid['upper'] = grid.yhat - 1.96*stdErr, grid.yhat + 1.96*stdErr
+    return(grid)
+
+#Lab value PCA
+
+def labValueMatrix(patientObs, minPopTestNum):
+    """ One row per encounter, one column per test done more than minPopTestNum
+        times (trimByTests, sortByTestVals). Repeated tests of an encounter are
+        averaged
+    """
+    testCounts = patientObs.DESCRIPTION.value_counts()
+    keepTests = testCounts.index[testCounts > minPopTestNum]
+    if not len(keepTests):
+        raise ValueError('no test done more than {0} times'.format(minPopTestNum))
+    kept = patientObs[patientObs.DESCRIPTION.isin(keepTests)]
+    matrix = kept.groupby(['ID', 'ENCOUNTER', 'GENDER', 'RACE', 'AgeAtEncounter',
+        'Age', 'DESCRIPTION'], observed = True).VALUE.mean().unstack('DESCRIPTION')
+    matrix.columns = matrix.columns.astype(str)
+    return(matrix.reset_index())
+
+def fitPCA(values, method = 'auto', nComponents = 10, batchSize = 10000, seed = 4):
+    """ PCA of standardized values
+
+    Args:
+        values: (rows, variables) array, already centered and scaled
+        method: 'full' SVD, 'randomized' SVD of the leading components, or
+            'incremental', fit batchSize rows at a time. 'auto' is randomized past
+            100,000 rows, full below
+        nComponents: Most components kept
+
+    Returns:
+        pca: Fitted sklearn PCA or IncrementalPCA
+    """
+    from sklearn.decomposition import PCA, IncrementalPCA
+
+    nComponents = min(nComponents, values.shape[1], values.shape[0])
+    if method == 'auto':
+        method = 'randomized' if len(values) > 100000 else 'full'
+    if method == 'incremental':
+        return(IncrementalPCA(nComponents, batch_size = max(batchSize,
+            nComponents)).fit(values))
+    if method in ['full', 'randomized']:
+        return(PCA(nComponents, svd_solver = method, random_state = seed).fit(values))
+    raise ValueError('Unknown PCA method: {0}'.format(method))
+
+def standardize(values):
+    return((values - values.mean(axis = 0))/values.std(axis = 0, ddof = 1))
+
+def labPCA(matrix, conditions, outlierSDRemove = 3, method = 'auto',
+    dropTests = ('Body Mass Index', 'Body Height', 'Body Weight')):
+    """ PCA of adults' lab values, refit without outliers past outlierSDRemove
+        standard deviations on PC1 or PC2, with each encounter's age group and
+        diabetes history (plotPCARmOutliersAdultsBodyCompositionDiabetes)
+
+    Args:
+        matrix: From labValueMatrix
+        conditions: Conditions table, for diabetes histories. As in
+            QuantitativeDimReduction.R, 'Prediabetes' does not count
+        method: See fitPCA
+
+    Returns:
+        scores: Gender, Race, AgeAtEncounter, Age, Condition, PC1, PC2
+        loadings: Metric, PC1, PC2
+        varianceExplained: Percent of variance of PC1 and PC2
+    """
+    diabetic = set(conditions.PATIENT[conditions.DESCRIPTION.astype(str).str.contains(
+        'Diabetes')])
+    matrix = matrix.assign(Condition = np.where(matrix.ID.isin(diabetic), 'Diabetic',
+        'Non-diabetic'))
+    infoColumns = ['ID', 'ENCOUNTER', 'GENDER', 'RACE', 'AgeAtEncounter', 'Age',
+        'Condition']
+    matrix = matrix.loc[:, matrix.notnull().any()]
+    matrix = matrix[matrix.notnull().all(axis = 1) & (matrix.Age != '<18')]
+    tests = [x for x in matrix.columns if x not in infoColumns and x not in dropTests]
+    info = matrix[['GENDER', 'RACE', 'AgeAtEncounter', 'Age', 'Condition']].rename(
+        columns = {'GENDER': 'Gender', 'RACE': 'Race'}).reset_index(drop = True)
+    values = matrix[tests].values.astype(float)
+    if len(tests) < 2 or len(values) < 3:
+        raise ValueError('{0} tests of {1} encounters, too few for PCA'.format(
+            len(tests), len(values)))
+
+    pca = fitPCA(standardize(values), method)
+    scores = pca.transform(standardize(values))
+    sdev = np.sqrt(pca.explained_variance_)
+    keep = (np.abs(scores[:, 0]) <= outlierSDRemove*sdev[0]) & (np.abs(
+        scores[:, 1]) <= outlierSDRemove*sdev[1])
+
+    values, info = values[keep], info[keep].reset_index(drop = True)
+    pca = fitPCA(standardize(values), method)
+    scores = pca.transform(standardize(values))
+
+    scores = info.assign(PC1 = scores[:, 0], PC2 = scores[:, 1])
+    loadings = pd.DataFrame({'Metric': tests, 'PC1': pca.components_[0],
+        'PC2': pca.components_[1]})
+    varianceExplained = np.round(pca.explained_variance_ratio_[:2]*100, 2)
+    return(scores, loadings, varianceExplained)
+
+#Running analyses as independent tasks
+
+def analysisTasks(vitals, minPopTestNums):
+    """ Independent analyses: allergies, one regression per vital, one PCA per test
+        count threshold
+    """
+    return([('allergy', None)] + [('regression', x) for x in vitals] +
+        [('pca', x) for x in minPopTestNums])
+
+def runAnalysis(task, files, cacheDir = None, pcaMethod = 'auto', outlierSD = 3):
+    """ Run one task of analysisTasks on tables from tables.loadTable, which workers
+        forked after the tables were loaded already have in memory
+
+    Args:
+        task: (analysis, argument) from analysisTasks
+        files: Dictionary of csv files of patients, observations, conditions and
+            allergies
+
+    Returns:
+        Dictionary of result name to DataFrame
+    """
+    analysis, argument = task
+    if analysis == 'allergy':
+        allergyYOB = allergyYears(tables.loadTable('patients', files['patients'],
+            cacheDir), tables.loadTable('allergies', files['allergies'], cacheDir))
+        yearSeq = yearSequence(allergyYOB.YOB)
+        return({'AllergyFrequencies': allergyFrequencies(allergyYOB, yearSeq),
+            'AllergyCounts': allergyCounts(allergyYOB, yearSeq)})
+
+    patientObs = tables.patientObservations(files['patients'], files['observations'],
+        cacheDir)
+    if analysis == 'regression':
+        return({'LabRegression-{0}'.format(argument): labRegression(patientObs,
+            argument)})
+    if analysis == 'pca':
+        scores, loadings, varianceExplained = labPCA(labValueMatrix(patientObs,
+            argument), tables.loadTable('conditions', files['conditions'], cacheDir),
+            outlierSD, pcaMethod)
+        name = 'LabPCA-{0}'.format(argument)
+        return({name + '-scores': scores, name + '-loadings': loadings,
+            name + '-variance': pd.DataFrame({'Component': ['PC1', 'PC2'],
+            'VarianceExplained': varianceExplained})})
+    raise ValueError('Unknown analysis: {0}'.format(analysis))
+
+def timedAnalysis(task, files, cacheDir = None, pcaMethod = 'auto', outlierSD = 3):
+    """ runAnalysis, timed, with a task that cannot run on this data (ValueError)
+        reported rather than stopping the other tasks
+
+    Returns:
+        task, results (None if it could not run), seconds taken, error message
+    """
+    start = time.perf_counter()
+    try:
+        results, error = runAnalysis(task, files, cacheDir, pcaMethod, outlierSD), None
+    except ValueError as err:
+        results, error = None, str(err)
+    return(task, results, time.perf_counter() - start, error)
@@ -0,0 +1,127 @@
+
+import os, json
+import pandas as pd
+import numpy as np
+
+#Columns kept from each Synthea table, with their dtypes as read. Dates are read as
+#strings and parsed after, and observation values are made numeric
+tableColumns = {
+    'patients': {'ID': str, 'BIRTHDATE': str, 'DEATHDATE': str, 'RACE': 'category',
+        'ETHNICITY': 'category', 'GENDER': 'category'},
+    'observations': {'DATE': str, 'PATIENT': str, 'ENCOUNTER': str,
+        'CODE': 'category', 'DESCRIPTION': 'category', 'VALUE': str,
+        'UNITS': 'category', 'TYPE': 'category'},
+    'conditions': {'START': str, 'STOP': str, 'PATIENT': str, 'ENCOUNTER': str,
+        'CODE': 'category', 'DESCRIPTION': 'category'},
+    'allergies': {'START': str, 'STOP': str, 'PATIENT': str, 'ENCOUNTER': str,
+        'CODE': 'category', 'DESCRIPTION': 'category'}}
+
+dateColumns = ['BIRTHDATE', 'DEATHDATE', 'DATE', 'START', 'STOP']
+
+#Tables already loaded by this process (and inherited by forked workers)
+loadedTables = {}
+
+def parseDates(values):
+    """ Dates or timestamps (as in newer exports) to timezone-naive datetimes
+    """
+    return(pd.to_datetime(values, utc = True).dt.tz_localize(None))
+
+def readTableCsv(name, csvFile):
+    """ One Synthea table, with only the columns in tableColumns, in compact dtypes
+    """
+    columns = tableColumns[name]
+    table = pd.read_csv(csvFile, usecols = lambda x: x in columns, dtype = columns)
+    for column in table.columns.intersection(dateColumns):
+        table[column] = parseDates(table[column])
+    if 'VALUE' in table.columns:
+        table['VALUE'] = pd.to_numeric(table.VALUE, errors = 'coerce')
+    return(table)
+
+def sourceSignature(csvFile):
+    stat = os.stat(csvFile)
+    return({'source': os.path.abspath(csvFile), 'size': stat.st_size,
+        'mtime': stat.st_mtime_ns})
+
+def loadTable(name, csvFile, cacheDir = None):
+    """ A Synthea table, parsed once: kept in memory for the rest of the process, and
+        in a parquet cache that later runs read instead of the csv until the csv
+        changes
+
+    Args:
+        name: patients, observations, conditions or allergies
+        csvFile: The table's csv
+        cacheDir: Directory of the parquet cache, or None for no cache
+
+    Returns:
+        table: DataFrame with typed columns (categoricals, datetimes, numeric VALUE)
+    """
+    key = (name, os.path.abspath(csvFile))
+    if key in loadedTables:
+        return(loadedTables[key])
+
+    signature = sourceSignature(csvFile)
+    if cacheDir is not None:
+        cacheFile = os.path.join(cacheDir, name + '.parquet')
+        signatureFile = os.path.join(cacheDir, name + '.json')
+        cached = None
+        if os.path.exists(signatureFile) and os.path.exists(cacheFile):
+            with open(signatureFile) as fin:
+                cached = json.load(fin)
+        if cached == signature:
+            table = pd.read_parquet(cacheFile)
+        else:
+            table = readTableCsv(name, csvFile)
+            os.makedirs(cacheDir, exist_ok = True)
+            table.to_parquet(cacheFile, index = False)
+            with open(signatureFile, 'w') as fout:
+                json.dump(signature, fout)
+    else:
+        table = readTableCsv(name, csvFile)
+
+    loadedTables[key] = table
+    return(table)
+
+def ageAtEncounter(dates, birthDates):
+    """ Whole years at each date, as (date - birth date)/365 truncated, the way
+        calcAgeAtEncounter of the R analyses counts them
+    """
+    return(np.floor((dates - birthDates).dt.days / 365))
+
+def ageGroups(ages):
+    """ <18, 18-39, 40-59, 60-79 and 80+ groups of ages
+    """
+    return(pd.cut(ages, [-np.inf, 18, 40, 60, 80, np.inf], right = False,
+        labels = ['<18', '18-39', '40-59', '60-79', '80+']))
+
+def patientObservations(patientFile, observationFile, cacheDir = None):
+    """ Observations with each patient's race, ethnicity and gender and their age
+        (AgeAtEncounter, and its Age group), joined and aged once per process
+
+    Returns:
+        patientObs: DataFrame of ID, RACE, ETHNICITY, GENDER, DATE, ENCOUNTER, CODE,
+            DESCRIPTION, VALUE, UNITS, TYPE, AgeAtEncounter, Age
+    """
+    key = ('patientObservations', os.path.abspath(patientFile),
+        os.path.abspath(observationFile))
+    if key in loadedTables:
+        return(loadedTables[key])
+
+    patients = loadTable('patients', patientFile, cacheDir)
+    observations = loadTable('observations', observationFile, cacheDir)
+    patientObs = patients[['ID', 'BIRTHDATE', 'RACE', 'ETHNICITY', 'GENDER']].merge(
+        observations.rename(columns = {'PATIENT': 'ID'}), on = 'ID')
+    patientObs['AgeAtEncounter'] = ageAtEncounter(patientObs.DATE,
+        patientObs.BIRTHDATE)
+    patientObs['Age'] = ageGroups(patientObs.AgeAtEncounter)
+    patientObs = patientObs.drop(columns = 'BIRTHDATE')
+
+    loadedTables[key] = patientObs
+    return(patientObs)
+
+def readParams(paramFile):
+    """ Parameters of an R analysis, from its params_sr yaml file
+    """
+    import yaml
+
+    with open(paramFile) as fin:
+        return(yaml.safe_load(fin))
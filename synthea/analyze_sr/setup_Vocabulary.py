@@ -0,0 +1,147 @@
+
+import sys, os, json
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+oovKey = '<OOV>'
+
+#Vocabulary field, and the dictionary buildDictsSortHistories returns it as
+vocabularyFields = ['race', 'gender', 'zip', 'smoker', 'condition', 'procedure']
+
+def codeKey(value):
+    """ Canonical string for a code, so the same code matches whether it was read as
+        a string, int, or float (e.g. 430193006 and 430193006.0), and missing values
+        all match 'nan'
+    """
+    if value is None or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+        return('nan')
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return(str(int(value)))
+    return(str(value))
+
+class VocabularyDict(dict):
+    """ Code -> column dictionary, keyed by codeKey. Values that are not keys as given
+        are looked up by their codeKey, and codes that are not in the vocabulary at
+        all go to the out-of-vocabulary column
+    """
+    def __missing__(self, key):
+        return(dict.get(self, codeKey(key), dict.__getitem__(self, oovKey)))
+
+def fieldValues(patientRecs):
+    """ Values of each vocabulary field in sorted histories' records, ZIP already
+        formatted as in buildDictsSortHistories
+    """
+    smokers = patientRecs.OBSERVATION_DESCRIPTION == 'Tobacco smoking status NHIS'
+    return({'race': patientRecs.RACE, 'gender': patientRecs.GENDER,
+        'zip': patientRecs.ZIP, 'smoker': patientRecs.OBSERVATION_VALUE[smokers],
+        'condition': patientRecs.CONDITION_DESCRIPTION,
+        'procedure': patientRecs.PROCEDURE_CODE})
+
+def newVocabulary():
+    return({'version': 0, 'oovKey': oovKey,
+        'fields': {x: [oovKey] for x in vocabularyFields}})
+
+def updateVocabulary(vocabulary, patientRecs, extend = True):
+    """ Append the codes in the records that the vocabulary does not have yet. Existing
+        codes keep their columns, so feature rows built with an earlier version only
+        need their column blocks shifted (see remapBinaryColumns)
+
+    Args:
+        vocabulary: Vocabulary from newVocabulary or readVocabulary, updated in place
+        patientRecs: Patient records, ZIP already formatted
+        extend: If False, the vocabulary is left as it is and unseen codes go to the
+            out-of-vocabulary column
+
+    Returns:
+        nAdded: Number of codes appended
+    """
+    nAdded = 0
+    if not extend:
+        return(nAdded)
+
+    for field, values in fieldValues(patientRecs).items():
+        codes = vocabulary['fields'][field]
+        uniqueValues = pd.factorize(values if hasattr(values, 'cat') else values.values,
+            use_na_sentinel = False)[1]
+        newCodes = sorted(set(codeKey(x) for x in uniqueValues) - set(codes))
+        codes.extend(newCodes)
+        nAdded += len(newCodes)
+
+    if nAdded:
+        vocabulary['version'] += 1
+    return(nAdded)
+
+def vocabularyDicts(vocabulary):
+    """ raceDict, genderDict, zipDict, smokerDict, conditionDict, procedureDict for
+        the vocabulary, with each code's column being its position
+    """
+    return(tuple(VocabularyDict((code, i) for i, code in
+        enumerate(vocabulary['fields'][field])) for field in vocabularyFields))
+
+def dictCodes(codeDict):
+    """ Codes of a dictionary, in column order
+    """
+    return(sorted(codeDict, key = codeDict.get))
+
+def lookupCodes(codeDict, values):
+    """ Column of each value, with one dictionary lookup per unique value
+
+    Args:
+        codeDict: VocabularyDict, e.g. from vocabularyDicts
+        values: Codes to look up (array, Series, or categorical)
+
+    Returns:
+        columns: Float array of columns, aligned with values
+    """
+    values = pd.Series(values)
+    if not hasattr(values, 'cat'):
+        values = values.values
+    valueCodes, uniqueValues = pd.factorize(values, use_na_sentinel = True)
+    columns = np.array([codeDict[x] for x in uniqueValues] + [codeDict[np.nan]],
+        dtype = float)
+    return(columns[valueCodes])
+
+def extendsVocabulary(oldCodes, newCodes):
+    """ Whether every field of newCodes starts with the same field of oldCodes, i.e.
+        rows built with oldCodes can be remapped instead of rebuilt
+
+    Args:
+        oldCodes, newCodes: Lists of codes per dictionary, in column order
+    """
+    return(len(oldCodes) == len(newCodes) and all(y[:len(x)] == x for x, y in
+        zip(oldCodes, newCodes)))
+
+def remapBinaryColumns(binaryRows, oldSizes, newSizes):
+    """ Move the columns of side-by-side 0/1 blocks (e.g. conditions then procedures)
+        to where they are after codes were appended to each block
+
+    Args:
+        binaryRows: Sparse rows built with the old block sizes
+        oldSizes, newSizes: Number of columns in each block, before and after
+
+    Returns:
+        binaryRows: CSR rows with the new block sizes
+    """
+    binaryRows = binaryRows.tocsr()
+    oldStarts = np.concatenate([[0], np.cumsum(oldSizes)])
+    shifts = np.concatenate([[0], np.cumsum(newSizes)])[:-1] - oldStarts[:-1]
+    blocks = np.searchsorted(oldStarts, binaryRows.indices, side = 'right') - 1
+    return(sparse.csr_matrix((binaryRows.data, binaryRows.indices + shifts[blocks], 
+        binaryRows.indptr), shape = (binaryRows.shape[0], int(np.sum(newSizes)))))
+
+def readVocabulary(fileName):
+    """ Vocabulary saved by writeVocabulary, or a new empty one if there is none yet
+    """
+    if not os.path.exists(fileName):
+        return(newVocabulary())
+    with open(fileName) as fin:
+        return(json.load(fin))
+
+def writeVocabulary(vocabulary, fileName):
+    """ Save the vocabulary as JSON, atomically so a model's vocabulary is never left
+        half written
+    """
+    with open(fileName + '.tmp', 'w') as fout:
+        json.dump(vocabulary, fout, indent = 1)
+    os.replace(fileName + '.tmp', fileName)